@@ -22,7 +22,7 @@ except:
     raise ImportError('Could not import h5py, please install it if you need it.')
 
 
-def save_variables_to_hdf5(file_path, variables, mode='w', h5path='/'):
+def save_variables_to_hdf5(file_path, variables, mode='w', h5path='/', overwrite=False):
     """
     Parameters
     ----------
@@ -40,6 +40,9 @@ def save_variables_to_hdf5(file_path, variables, mode='w', h5path='/'):
         w-  Create file, fail if exists
         a   Read/write if exists, create otherwise (default)
 
+    overwrite: bool
+        If True, the nodes which already exist in the file with the same name will be replaced.
+
     Notes
     -----
     It is recommended to use numpy arrays as objects.
@@ -54,6 +57,11 @@ def save_variables_to_hdf5(file_path, variables, mode='w', h5path='/'):
     h5file  = h5py.File(file_path, mode=mode)
     h5group = h5file.require_group(h5path)
 
+    def set_node(name, value):
+        if overwrite and name in h5group:
+            del h5group[name]
+        h5group[name] = value
+
     for vn in variables:
         data = variables[vn]
 
@@ -67,18 +75,159 @@ def save_variables_to_hdf5(file_path, variables, mode='w', h5path='/'):
                 #h5group.create_dataset(str(key))
                 #import ipdb
                 #ipdb.set_trace()
-                h5group[str(key)] = data[key]
+                set_node(str(key), data[key])
 
         elif isinstance(data, list):
             for idx, item in enumerate(data):
                 #h5group.create_dataset(str(idx))
-                h5group[str(idx)] = item
+                set_node(str(idx), item)
         else:
-            h5group[vn] = data
+            set_node(vn, data)
 
     h5file.close()
 
 
+def save_rows_to_hdf5(file_path, rows, row_shape, dtype, n_rows=0, dsname='data', mode='w', h5path='/'):
+    """Write the arrays in `rows` one by one into a chunked and resizable dataset,
+    so only one row has to be in memory at a time.
+
+    Parameters
+    ----------
+    file_path: str
+
+    rows: iterable of numpy.ndarray
+        Each item is one row of the dataset, with shape `row_shape`.
+
+    row_shape: tuple of int
+
+    dtype: numpy.dtype
+        Type of the dataset
+
+    n_rows: int
+        Expected number of rows. The dataset will be resized if `rows` has a different length.
+
+    dsname: str
+        Name of the dataset
+
+    mode: str
+        HDF5 file access mode. See `save_variables_to_hdf5`.
+
+    h5path: str
+        HDF5 group path where the dataset will be created.
+
+    Returns
+    -------
+    n_rows: int
+        Number of rows written.
+    """
+    row_shape = tuple(row_shape)
+
+    with h5py.File(file_path, mode=mode) as h5file:
+        h5group = h5file.require_group(h5path)
+        dataset = h5group.create_dataset(dsname, shape=(n_rows, ) + row_shape, dtype=dtype,
+                                         maxshape=(None, ) + row_shape,
+                                         chunks=(1, ) + row_shape)
+
+        idx = 0
+        for row in rows:
+            if idx >= dataset.shape[0]:
+                dataset.resize(idx + 1, axis=0)
+            dataset[idx] = row
+            idx += 1
+
+        if idx != dataset.shape[0]:
+            dataset.resize(idx, axis=0)
+
+    return idx
+
+
+def update_rows_in_hdf5(file_path, row_keys, get_rows, row_shape, dtype, dsname='data',
+                        keys_dsname='row_keys', checks=None, h5path='/'):
+    """Update a dataset written by `save_rows_to_hdf5`, with its row keys in the dataset `keys_dsname`,
+    to have one row for each key in `row_keys`. The rows of the keys already in the dataset are kept,
+    only the rows of the new keys are requested to `get_rows`.
+
+    Parameters
+    ----------
+    file_path: str
+
+    row_keys: list of str
+        Key of each row of the updated dataset, in order.
+
+    get_rows: function
+        Called with the list of indices in `row_keys` of the new rows,
+        must return an iterable with these rows in the same order.
+
+    row_shape: tuple of int
+
+    dtype: numpy.dtype
+
+    dsname: str
+        Name of the dataset
+
+    keys_dsname: str
+        Name of the dataset with the row keys.
+
+    checks: dict
+        Dataset name -> value that must be equal to the content of the dataset
+        for the file to be updated.
+
+    h5path: str
+        HDF5 group path of the datasets.
+
+    Returns
+    -------
+    n_new_rows: int or None
+        Number of rows written, None if the file can not be updated because it does not have
+        the datasets, or they have a different row shape, type or content in `checks`.
+    """
+    row_shape = tuple(row_shape)
+
+    with h5py.File(file_path, mode='a') as h5file:
+        h5group = h5file.require_group(h5path)
+        if dsname not in h5group or keys_dsname not in h5group:
+            return None
+
+        dataset = h5group[dsname]
+        if dataset.shape[1:] != row_shape or dataset.dtype != np.dtype(dtype):
+            return None
+
+        for name, value in (checks or {}).items():
+            if name not in h5group or not np.array_equal(h5group[name][()], value):
+                return None
+
+        old_keys = [key.decode() if isinstance(key, bytes) else key for key in h5group[keys_dsname][()]]
+        old_rows = {key: idx for idx, key in enumerate(old_keys)}
+        old_idx  = [old_rows.get(key, -1) for key in row_keys]
+        new_idx  = [idx for idx, old in enumerate(old_idx) if old < 0]
+        new_rows = iter(get_rows(new_idx))
+
+        n_old = len(old_keys)
+        if old_idx[:n_old] == list(range(n_old)) and dataset.shape[0] == n_old and dataset.maxshape[0] is None:
+            # only appended rows
+            dataset.resize(len(row_keys), axis=0)
+            for idx in new_idx:
+                dataset[idx] = next(new_rows)
+        else:
+            tmpname = dsname + '_tmp'
+            if tmpname in h5group:
+                del h5group[tmpname]
+
+            newset = h5group.create_dataset(tmpname, shape=(len(row_keys), ) + row_shape, dtype=dtype,
+                                            maxshape=(None, ) + row_shape,
+                                            chunks=(1, ) + row_shape)
+            for idx, old in enumerate(old_idx):
+                newset[idx] = dataset[old] if old >= 0 else next(new_rows)
+
+            del h5group[dsname]
+            h5group.move(tmpname, dsname)
+
+        del h5group[keys_dsname]
+        h5group[keys_dsname] = np.array(row_keys, dtype=h5py.special_dtype(vlen=str))
+
+    return len(new_idx)
+
+
 # -------------------------------------------------------------------------
 # HDF5 helpers
 # -------------------------------------------------------------------------
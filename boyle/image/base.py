@@ -16,8 +16,9 @@ import numpy                as np
 
 from   ..nifti.read          import get_data
 from   ..nifti.check         import check_img_compatibility, repr_imgs
-from   ..nifti.mask          import load_mask, _apply_mask_to_4d_data, vector_to_volume, matrix_to_4dvolume
-from   ..nifti.smooth        import _smooth_data_array
+from   ..nifti.mask          import (load_mask, _apply_mask_to_4d_data, vector_to_volume, matrix_to_4dvolume,
+                                     CompactMask)
+from   ..nifti.smooth        import _smooth_data_array, has_smoothing
 from   ..nifti.storage       import save_niigz
 
 from .utils import _check_medimg
@@ -155,6 +156,7 @@ class MedicalImage(ImageContainer):
 
     def zeroe(self):
         self._smooth_fwhm    = 0
+        self._smooth_threads = 1
         self._is_data_masked = False
         self._is_data_smooth = False
 
@@ -176,7 +178,7 @@ class MedicalImage(ImageContainer):
 
     @smooth_fwhm.setter
     def smooth_fwhm(self, fwhm):
-        """ Set a smoothing Gaussian kernel given its FWHM in mm.  """
+        """ Set a smoothing Gaussian kernel given its FWHM in mm, or 'fast' for a [0.2, 1, 0.2] filter.  """
         if fwhm != self._smooth_fwhm:
             self._is_data_smooth = False
         self._smooth_fwhm = fwhm
@@ -223,9 +225,12 @@ class MedicalImage(ImageContainer):
             data = self.img.get_data(caching=self._caching)
 
         is_smoothed = False
-        if smoothed and self._smooth_fwhm > 0:
+        if smoothed and has_smoothing(self._smooth_fwhm):
+            # if the data will be masked, smooth only around the mask
+            mask_data = self.mask.get_data() if masked and self.has_mask() else None
             try:
-                data = _smooth_data_array(data, self.get_affine(), self._smooth_fwhm, copy=False)
+                data = _smooth_data_array(data, self.get_affine(), self._smooth_fwhm, copy=False, mask=mask_data,
+                                          n_threads=self._smooth_threads)
             except ValueError as ve:
                 raise ValueError('Error smoothing image {} with a {}mm FWHM '
                                  'kernel.'.format(self.img, self._smooth_fwhm)) from ve
@@ -256,6 +261,12 @@ class MedicalImage(ImageContainer):
 
         return np.where(self.mask.get_data())
 
+    def get_compact_mask(self):
+        """Return the mask as a boyle.nifti.mask.CompactMask."""
+        self._check_for_mask()
+
+        return CompactMask.from_array(self.mask.get_data())
+
     def apply_mask(self, mask_img):
         """First set_mask and the get_masked_data.
 
@@ -329,20 +340,29 @@ class MedicalImage(ImageContainer):
         else:
             raise ValueError('Cannot mask {} with {} dimensions using mask {}.'.format(self, self.ndim, self.mask))
 
-    def apply_smoothing(self, smooth_fwhm):
+    def apply_smoothing(self, smooth_fwhm, n_threads=1):
         """Set self._smooth_fwhm and then smooths the data.
         See boyle.nifti.smooth.smooth_imgs.
 
+        Parameters
+        ----------
+        smooth_fwhm: scalar or numpy.ndarray
+            Smoothing kernel size, as Full-Width at Half Maximum (FWHM) in millimeters.
+
+        n_threads: int
+            Number of threads to smooth the data, also used when the data is smoothed again.
+
         Returns
         -------
         the smoothed data deepcopied.
 
         """
-        if smooth_fwhm <= 0:
+        if not has_smoothing(smooth_fwhm):
             return
 
-        old_smooth_fwhm   = self._smooth_fwhm
-        self._smooth_fwhm = smooth_fwhm
+        old_smooth_fwhm      = self._smooth_fwhm
+        self._smooth_fwhm    = smooth_fwhm
+        self._smooth_threads = n_threads
         try:
             data = self.get_data(smoothed=True, masked=True, safe_copy=True)
         except ValueError as ve:
@@ -19,11 +19,8 @@ from   six                  import string_types
 
 from   ..files.names         import get_extension
 
-from   ..nifti.neuroimage    import NiftiImage
-from   ..mhd.read            import load_raw_data_with_mhd
-
 from   ..nifti.read          import get_data
-from   ..nifti.check         import check_img_compatibility, repr_imgs, is_img, _make_it_3d
+from   ..nifti.check         import check_img_compatibility, repr_imgs, is_img, _make_it_3d, check_img
 from   ..nifti.mask          import load_mask, _apply_mask_to_4d_data, vector_to_volume, matrix_to_4dvolume
 from   ..nifti.smooth        import _smooth_data_array
 from   ..nifti.storage       import save_niigz
@@ -56,9 +53,10 @@ def open_volume_file(filepath):
 
     # define helper functions
     def open_nifti_file(filepath):
-        return NiftiImage(filepath)
+        return check_img(filepath)
 
     def open_mhd_file(filepath):
+        from ..mhd.read import load_raw_data_with_mhd
         return MedicalImage(filepath)
         vol_data, hdr_data = load_raw_data_with_mhd(filepath)
         # TODO: convert vol_data and hdr_data into MedicalImage
@@ -84,7 +82,7 @@ def open_volume_file(filepath):
     # find the loader from `ext`
     loader = None
     for e in filext_loader:
-        if ext in e:
+        if e in ext:
             loader = filext_loader[e]
 
     if loader is None:
@@ -125,7 +123,7 @@ def _check_medimg(image, make_it_3d=True):
 
         return img
 
-    elif isinstance(image, np.array):
+    elif isinstance(image, np.ndarray):
         return nib.Nifti2Image(image, affine=np.eye(image.ndim + 1))
 
     elif isinstance(image, nib.Nifti1Image) or is_img(image):
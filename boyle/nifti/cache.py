@@ -0,0 +1,226 @@
+# coding=utf-8
+"""
+Cache of decompressed copies of .nii.gz files, so they are inflated only once
+and can be memory-mapped in later reads.
+"""
+# ------------------------------------------------------------------------------
+# Author: Alexandre Manhaes Savio <alexsavio@gmail.com>
+#
+# 2016, Alexandre Manhaes Savio
+# Use this at your own risk!
+# ------------------------------------------------------------------------------
+
+import os
+import gzip
+import shutil
+import hashlib
+import logging
+import tempfile
+import os.path as op
+
+import numpy   as np
+import nibabel as nib
+
+
+log = logging.getLogger(__name__)
+
+# the NiftiCache used by check_img, None if disabled
+_nifti_cache = None
+
+
+class NiftiCache(object):
+    """A directory with uncompressed .nii copies of .nii.gz files.
+
+    Each copy is keyed by the absolute path, size and modification time of its source file,
+    so a modified source file gets a new copy and the old one is eventually evicted.
+    The copies are written to a temporary file and then renamed, and a removed copy stays
+    readable for the processes which already opened it, so several processes can share
+    the same cache directory.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Path to the cache directory. It will be created if it does not exist.
+
+    max_size: int
+        Maximum size in bytes of the cache directory. When it is exceeded, the least
+        recently used copies are removed. If None, the cache has no size limit.
+    """
+    extension = '.nii'
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = op.abspath(cache_dir)
+        self.max_size  = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def is_cacheable(file_path):
+        """Return True if `file_path` is a gzipped Nifti file."""
+        return file_path.lower().endswith('.nii.gz')
+
+    def get_key(self, file_path):
+        """Return the cache key of `file_path`, from its absolute path, size and modification time."""
+        file_path = op.abspath(file_path)
+        stat = os.stat(file_path)
+        key  = '{}:{}:{}'.format(file_path, stat.st_size, stat.st_mtime_ns)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get_cache_path(self, file_path):
+        """Return the path of the cached copy of `file_path`, it may not exist."""
+        return op.join(self.cache_dir, self.get_key(file_path) + self.extension)
+
+    def get_file(self, file_path):
+        """Return the path to the uncompressed copy of `file_path`, creating it if needed.
+
+        Parameters
+        ----------
+        file_path: str
+            Path to a .nii.gz file.
+
+        Returns
+        -------
+        cache_path: str
+        """
+        cache_path = self.get_cache_path(file_path)
+        try:
+            # mark it as recently used
+            os.utime(cache_path, None)
+        except FileNotFoundError:
+            self._add_file(file_path, cache_path)
+            self.evict(keep=cache_path)
+
+        return cache_path
+
+    def load(self, file_path):
+        """Return the image in `file_path` read from its uncompressed copy, with memory-mapped data.
+
+        Parameters
+        ----------
+        file_path: str
+            Path to a .nii.gz file.
+
+        Returns
+        -------
+        img: nibabel.Nifti1Image or nibabel.Nifti2Image
+            Of the same class as the image in `file_path`.
+            Its file name is `file_path`, not the one of the cached copy.
+        """
+        cache_path = self.get_file(file_path)
+        try:
+            return self._open(cache_path, file_path)
+        except FileNotFoundError:
+            # evicted by another process in the meantime
+            self._add_file(file_path, cache_path)
+            return self._open(cache_path, file_path)
+
+    @staticmethod
+    def _open(cache_path, file_path=None):
+        """Return the image in `cache_path` with memory-mapped data, with `file_path` as file name if given.
+        Data without scale factors is mapped before returning. Scaled data is kept in the array proxy,
+        which reads and scales it from the mapped file when it is accessed, and keeps the file open,
+        so in both cases the data can still be read if the file is evicted."""
+        img   = nib.load(cache_path, mmap=True, keep_file_open=True)
+        proxy = img.dataobj
+        if getattr(proxy, 'slope', 1) == 1 and getattr(proxy, 'inter', 0) == 0:
+            img = img.__class__(np.asanyarray(proxy), img.affine, img.header)
+        else:
+            # read the first voxel to open the file now, the proxy keeps it open
+            proxy[(0, ) * len(proxy.shape)]
+        if file_path is not None:
+            img.set_filename(file_path)
+        return img
+
+    def _add_file(self, file_path, cache_path):
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            with gzip.open(file_path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+            os.replace(tmp_path, cache_path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def _get_entries(self):
+        """Return a list of (last use time, size, path) of the cached copies."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.extension):
+                continue
+
+            path = op.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        return entries
+
+    @property
+    def size(self):
+        """Total size in bytes of the cached copies."""
+        return sum(size for _, size, _ in self._get_entries())
+
+    def evict(self, keep=None):
+        """Remove the least recently used copies until the cache size is under `max_size`.
+
+        Parameters
+        ----------
+        keep: str
+            Path of a cached copy that must not be removed.
+        """
+        if self.max_size is None:
+            return
+
+        entries = sorted(self._get_entries())
+        total   = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+
+            if path == keep:
+                continue
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            else:
+                log.debug('Removed {} from the Nifti cache.'.format(path))
+            total -= size
+
+    def clear(self):
+        """Remove all the cached copies."""
+        for _, _, path in self._get_entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def set_nifti_cache(cache_dir, max_size=None):
+    """Enable the cache of uncompressed .nii.gz files used by boyle.nifti.check_img.
+    Once enabled, the .nii.gz file paths given to check_img (and read_img) are read
+    from their uncompressed copies, with memory-mapped data.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Path to the cache directory. If None, the cache is disabled.
+
+    max_size: int
+        Maximum size in bytes of the cache directory. If None, the cache has no size limit.
+
+    Returns
+    -------
+    cache: NiftiCache or None
+    """
+    global _nifti_cache
+    _nifti_cache = NiftiCache(cache_dir, max_size=max_size) if cache_dir is not None else None
+    return _nifti_cache
+
+
+def get_nifti_cache():
+    """Return the NiftiCache used by boyle.nifti.check_img, None if it is disabled."""
+    return _nifti_cache
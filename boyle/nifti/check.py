@@ -24,6 +24,7 @@ import nibabel      as     nib
 from   six          import string_types
 
 from   ..exceptions import FileNotFound, NiftiFilesNotCompatible
+from   .cache       import get_nifti_cache
 
 
 log = logging.getLogger(__name__)
@@ -169,6 +170,43 @@ def check_img_compatibility(one_img, another_img, only_check_3d=False):
             raise NiftiFilesNotCompatible(repr_imgs(one_img), repr_imgs(another_img), message=msg)
 
 
+def check_imgs_compatibility(images, ref_img=None, only_check_3d=False):
+    """Check that all the images in `images` are compatible with `ref_img`.
+    The images are loaded with check_img, which for file paths only reads the headers,
+    so no image data is read here. The Nifti cache is not used.
+
+    Parameters
+    ----------
+    images: list of img-like objects or str
+        See check_img.
+
+    ref_img: img-like object or str
+        The reference image. If None will use the first image of `images`.
+
+    only_check_3d: bool
+        If True will check only the 3D part of the shapes and affine matrices.
+
+    Returns
+    -------
+    imgs: list of img-like objects
+        The loaded `images`, in the same order. Their files are not read from the Nifti cache,
+        give the file paths to check_img to read their data.
+
+    Raises
+    ------
+    NiftiFilesNotCompatible
+    """
+    imgs = [check_img(image, use_cache=False) for image in images]
+    if not imgs:
+        return imgs
+
+    ref_img = imgs[0] if ref_img is None else check_img(ref_img, use_cache=False)
+    for img in imgs:
+        check_img_compatibility(img, ref_img, only_check_3d=only_check_3d)
+
+    return imgs
+
+
 def have_same_affine(one_img, another_img, only_check_3d=False):
     """Return True if the affine matrix of one_img is close to the affine matrix of another_img.
     False otherwise.
@@ -191,8 +229,8 @@ def have_same_affine(one_img, another_img, only_check_3d=False):
     ValueError
 
     """
-    img1 = check_img(one_img)
-    img2 = check_img(another_img)
+    img1 = check_img(one_img, use_cache=False)
+    img2 = check_img(another_img, use_cache=False)
 
     ndim1 = len(img1.shape)
     ndim2 = len(img2.shape)
@@ -247,7 +285,7 @@ def _make_it_3d(img):
         raise TypeError("A 3D image is expected, but an image with a shape of {} was given.".format(shape))
 
 
-def check_img(image, make_it_3d=False):
+def check_img(image, make_it_3d=False, use_cache=True):
     """Check that image is a proper img. Turn filenames into objects.
 
     Parameters
@@ -259,10 +297,16 @@ def check_img(image, make_it_3d=False):
         If niimg is a string, consider it as a path to Nifti image and
         call nibabel.load on it. If it is an object, check if get_data()
         and get_affine() methods are present, raise TypeError otherwise.
+        If the Nifti cache is enabled (see boyle.nifti.cache.set_nifti_cache),
+        .nii.gz files are read from their uncompressed copy in the cache.
 
     make_it_3d: boolean, optional
         If True, check if the image is a 3D image and raise an error if not.
 
+    use_cache: boolean, optional
+        If False, the Nifti cache is not used. For the callers which only need the header,
+        so the .nii.gz files are not inflated into the cache.
+
     Returns
     -------
     result: nifti-like
@@ -275,7 +319,12 @@ def check_img(image, make_it_3d=False):
             raise FileNotFound(image)
 
         try:
-            img = nib.load(image)
+            cache = get_nifti_cache()
+            if use_cache and cache is not None and cache.is_cacheable(image):
+                img = cache.load(image)
+            else:
+                img = nib.load(image)
+
             if make_it_3d:
                 img = _make_it_3d(img)
         except Exception as exc:
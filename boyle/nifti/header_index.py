@@ -0,0 +1,196 @@
+# coding=utf-8
+"""
+Persistent index of Nifti header information, to check the compatibility
+of many image files without opening them each time.
+"""
+# ------------------------------------------------------------------------------
+# Author: Alexandre Manhaes Savio <alexsavio@gmail.com>
+#
+# 2016, Alexandre Manhaes Savio
+# Use this at your own risk!
+# ------------------------------------------------------------------------------
+
+import os
+import json
+import sqlite3
+import logging
+import os.path as op
+
+import numpy   as np
+import nibabel as nib
+from   six     import string_types
+
+from   .check       import check_img, repr_imgs
+from   ..exceptions import FileNotFound, NiftiFilesNotCompatible
+
+
+log = logging.getLogger(__name__)
+
+
+class HeaderIndex(object):
+    """An SQLite database with the shape, affine matrix, data type and voxel sizes
+    of Nifti files, keyed by their absolute path.
+
+    Each record also stores the size and modification time of its file, only the files
+    which changed since they were indexed are read again.
+
+    Parameters
+    ----------
+    db_path: str
+        Path to the SQLite database file. It will be created if it does not exist.
+        Use ':memory:' for an index that is not stored.
+
+    timeout: float
+        Seconds to wait for other processes to release the database.
+    """
+    _max_vars = 900
+
+    def __init__(self, db_path, timeout=60):
+        self.db_path = db_path
+        self._conn   = sqlite3.connect(db_path, timeout=timeout)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS headers ('
+                               'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                               'shape TEXT, affine BLOB, dtype TEXT, zooms TEXT)')
+
+    def close(self):
+        self._conn.close()
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM headers').fetchone()[0]
+
+    @staticmethod
+    def _read_header(file_path, stat):
+        img = nib.load(file_path)
+        return (file_path, stat.st_size, stat.st_mtime_ns,
+                json.dumps(list(img.shape)),
+                np.asarray(img.affine, dtype=np.float64).tobytes(),
+                np.dtype(img.get_data_dtype()).str,
+                json.dumps([float(z) for z in img.header.get_zooms()]))
+
+    @staticmethod
+    def _to_header(row):
+        return {'path':   row[0],
+                'shape':  tuple(json.loads(row[3])),
+                'affine': np.frombuffer(row[4], dtype=np.float64).reshape((4, 4)),
+                'dtype':  np.dtype(row[5]),
+                'zooms':  tuple(json.loads(row[6])),
+                }
+
+    def _select(self, file_paths):
+        rows = {}
+        for i in range(0, len(file_paths), self._max_vars):
+            chunk = file_paths[i:i + self._max_vars]
+            query = 'SELECT * FROM headers WHERE path IN ({})'.format(','.join('?' * len(chunk)))
+            rows.update((row[0], row) for row in self._conn.execute(query, chunk))
+        return rows
+
+    def get_headers(self, file_paths):
+        """Return the header information of the files in `file_paths`,
+        reading only the files that are not indexed or changed since they were indexed.
+
+        Parameters
+        ----------
+        file_paths: list of str
+
+        Returns
+        -------
+        headers: list of dict
+            One dict for each file, in the same order, with the keys:
+            'path', 'shape', 'affine', 'dtype' and 'zooms'.
+
+        Raises
+        ------
+        FileNotFound
+        """
+        file_paths = [op.abspath(fp) for fp in file_paths]
+        rows = self._select(list(set(file_paths)))
+
+        new_rows = []
+        for file_path in set(file_paths):
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                raise FileNotFound(file_path)
+
+            row = rows.get(file_path)
+            if row is None or row[1] != stat.st_size or row[2] != stat.st_mtime_ns:
+                try:
+                    row = self._read_header(file_path, stat)
+                except Exception as exc:
+                    raise Exception('Error reading header of file {}.'.format(file_path)) from exc
+                rows[file_path] = row
+                new_rows.append(row)
+
+        if new_rows:
+            log.debug('Indexing the headers of {} files.'.format(len(new_rows)))
+            with self._conn:
+                self._conn.executemany('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?, ?)', new_rows)
+
+        return [self._to_header(rows[file_path]) for file_path in file_paths]
+
+    def check_compatibility(self, file_paths, ref_img=None, only_check_3d=False, check_affine=True):
+        """Check that all the files in `file_paths` are compatible with `ref_img`,
+        i.e., they have the same shape and affine matrix.
+
+        Parameters
+        ----------
+        file_paths: list of str
+
+        ref_img: img-like object or str
+            The reference image. If None will use the first file of `file_paths`.
+            Files are looked up in this index, see boyle.nifti.check_img for other objects.
+
+        only_check_3d: bool
+            If True will check only the 3D part of the shapes and affine matrices.
+
+        check_affine: bool
+            If False will check only the shapes.
+
+        Returns
+        -------
+        headers: list of dict
+            See get_headers.
+
+        Raises
+        ------
+        NiftiFilesNotCompatible
+        """
+        headers = self.get_headers(file_paths)
+        if not headers:
+            return headers
+
+        if ref_img is None:
+            ref_path, ref_shape, ref_affine = headers[0]['path'], headers[0]['shape'], headers[0]['affine']
+        elif isinstance(ref_img, string_types):
+            ref_hdr  = self.get_headers([ref_img])[0]
+            ref_path, ref_shape, ref_affine = ref_hdr['path'], ref_hdr['shape'], ref_hdr['affine']
+        else:
+            ref_img  = check_img(ref_img, use_cache=False)
+            ref_path, ref_shape, ref_affine = repr_imgs(ref_img), ref_img.shape, ref_img.get_affine()
+
+        nd = 3 if only_check_3d else None
+        ref_shape = tuple(ref_shape)[:nd]
+        for hdr in headers:
+            if hdr['shape'][:nd] != ref_shape:
+                msg = 'Shape of the first image: \n{}\n is different from second one: \n{}'.format(hdr['shape'],
+                                                                                                   ref_shape)
+                raise NiftiFilesNotCompatible(hdr['path'], ref_path, message=msg)
+
+        if not check_affine:
+            return headers
+
+        # compare all the affine matrices at once
+        affines    = np.array([hdr['affine'] for hdr in headers])
+        ref_affine = np.asarray(ref_affine)
+        if only_check_3d:
+            affines, ref_affine = affines[:, :3, :3], ref_affine[:3, :3]
+
+        close = np.all(np.isclose(affines, ref_affine), axis=tuple(range(1, affines.ndim)))
+        if not np.all(close):
+            hdr = headers[int(np.argmin(close))]
+            msg = 'Affine matrix of the first image: \n{}\n is different ' \
+                  'from second one:\n{}'.format(hdr['affine'], ref_affine)
+            raise NiftiFilesNotCompatible(hdr['path'], ref_path, message=msg)
+
+        return headers
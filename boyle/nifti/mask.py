@@ -13,10 +13,12 @@ import logging as log
 import numpy   as np
 import nibabel as nib
 
-from .read              import get_img_data
-from ..exceptions       import NiftiFilesNotCompatible
-from .check             import (are_compatible_imgs, check_img, repr_imgs,
-                                check_img_compatibility, get_data)
+from six                import string_types
+
+from .read              import (get_img_data, get_img_data_dtype, get_img_data_box,
+                                ImagePrefetcher, get_img_sources)
+from .check             import (check_img, repr_imgs, check_img_compatibility,
+                                check_imgs_compatibility, get_data)
 from ..utils.numpy_conversions  import as_ndarray
 
 
@@ -86,6 +88,296 @@ def load_mask_data(image, allow_empty=True):
     return get_img_data(mask), mask.get_affine()
 
 
+def get_bounding_box(mask_data):
+    """Return the slices of the smallest box that contains all the non-zero voxels of `mask_data`.
+
+    Parameters
+    ----------
+    mask_data: numpy.ndarray
+        Mask volume.
+
+    Returns
+    -------
+    slices: tuple of slices
+        One slice for each dimension of `mask_data`. If the mask is empty, the slices are empty.
+    """
+    slices = []
+    for axis in range(mask_data.ndim):
+        other_axes = tuple(a for a in range(mask_data.ndim) if a != axis)
+        nonzero    = np.flatnonzero(np.any(mask_data, axis=other_axes))
+        if len(nonzero) == 0:
+            return tuple(slice(0, 0) for _ in range(mask_data.ndim))
+
+        slices.append(slice(int(nonzero[0]), int(nonzero[-1]) + 1))
+
+    return tuple(slices)
+
+
+class CompactMask(object):
+    """A mask stored as the sorted runs of consecutive voxels in it, in the C order of its volume.
+
+    It takes 8 bytes per run (4 for the start and 4 for the stop of each run in the flattened volume,
+    or 16 for volumes with more than 2**31 voxels), instead of 1 byte per voxel of a boolean volume
+    or 24 bytes per voxel of the np.where indices. The masked data is in the same order as
+    `volume[mask_data]` gives it. apply and unmask use the flat indices of the voxels in the mask,
+    which are computed once and take 4 bytes per voxel, and 4 more for the Fortran ordered data
+    of Nifti files, see uncache.
+
+    Parameters
+    ----------
+    starts: numpy.ndarray
+        Flat index of the first voxel of each run.
+
+    stops: numpy.ndarray
+        Flat index of the last voxel + 1 of each run.
+
+    shape: tuple of int
+        Shape of the mask volume.
+
+    Examples
+    --------
+    >>> mask = CompactMask.from_img('brain_mask.nii.gz')
+    >>> vector = mask.apply(get_img_data('subject.nii.gz'))
+    >>> volume = mask.unmask(vector)
+    """
+    def __init__(self, starts, stops, shape):
+        self.shape  = tuple(int(n) for n in shape)
+        dtype       = np.int32 if self.size <= np.iinfo(np.int32).max else np.int64
+        self.starts = np.asarray(starts, dtype=dtype)
+        self.stops  = np.asarray(stops,  dtype=dtype)
+        if self.starts.shape != self.stops.shape:
+            raise ValueError('Expected the same number of run starts and stops, '
+                             'got {} and {}.'.format(len(self.starts), len(self.stops)))
+
+        # computed on the first apply or unmask, 4 bytes per voxel
+        self._flat_indices    = None
+        self._fortran_indices = None
+
+    @classmethod
+    def from_array(cls, mask_data):
+        """Return the CompactMask of the non-zero voxels of `mask_data`."""
+        mask_data = np.asarray(mask_data)
+        flat      = np.concatenate([[False], mask_data.ravel() != 0, [False]])
+        edges     = np.flatnonzero(flat[1:] != flat[:-1])
+        return cls(edges[0::2], edges[1::2], mask_data.shape)
+
+    @classmethod
+    def from_img(cls, image, allow_empty=True):
+        """Return the CompactMask of the Nifti mask volume `image`. See load_mask."""
+        return cls.from_array(load_mask_data(image, allow_empty=allow_empty)[0])
+
+    @classmethod
+    def from_indices(cls, indices, shape):
+        """Return the CompactMask of the voxels in `indices`.
+
+        Parameters
+        ----------
+        indices: tuple of numpy.ndarray or numpy.ndarray
+            The coordinates of the voxels, as returned by np.where, or their flat indices.
+
+        shape: tuple of int
+            Shape of the mask volume.
+        """
+        if isinstance(indices, tuple):
+            indices = np.ravel_multi_index(indices, shape)
+
+        flat   = np.unique(indices)
+        breaks = np.flatnonzero(np.diff(flat) != 1)
+        starts = flat[np.concatenate([[0], breaks + 1])] if len(flat) else flat
+        stops  = flat[np.concatenate([breaks, [len(flat) - 1]])] + 1 if len(flat) else flat
+        return cls(starts, stops, shape)
+
+    @classmethod
+    def from_runs(cls, runs, shape):
+        """Return the CompactMask of the (n_runs, 2) array `runs`, see the `runs` property."""
+        runs = np.asarray(runs).reshape((-1, 2))
+        return cls(runs[:, 0], runs[:, 1], shape)
+
+    @property
+    def runs(self):
+        """(n_runs, 2) array with the start and stop of each run. See from_runs."""
+        return np.stack([self.starts, self.stops], axis=1)
+
+    @property
+    def size(self):
+        """Number of voxels of the mask volume."""
+        return int(np.prod(self.shape))
+
+    @property
+    def n_runs(self):
+        return len(self.starts)
+
+    @property
+    def n_voxels(self):
+        """Number of voxels in the mask."""
+        return int(np.sum(self.stops - self.starts, dtype=np.int64))
+
+    def __len__(self):
+        return self.n_voxels
+
+    @property
+    def nbytes(self):
+        """Number of bytes of the runs, without the cached flat indices."""
+        return self.starts.nbytes + self.stops.nbytes
+
+    def uncache(self):
+        """Remove the cached flat indices."""
+        self._flat_indices    = None
+        self._fortran_indices = None
+
+    @property
+    def flat_indices(self):
+        """Flat indices of the voxels in the mask, sorted."""
+        if self._flat_indices is None:
+            if not self.n_runs:
+                self._flat_indices = self.starts.copy()
+            else:
+                # steps of 1 inside the runs and jumps to the start of the next run
+                steps = np.ones(self.n_voxels, dtype=self.starts.dtype)
+                steps[0] = self.starts[0]
+                steps[np.cumsum(self.stops[:-1] - self.starts[:-1])] = self.starts[1:] - self.stops[:-1] + 1
+                self._flat_indices = np.cumsum(steps, dtype=self.starts.dtype)
+        return self._flat_indices
+
+    @property
+    def fortran_indices(self):
+        """Flat indices of the voxels in the mask in the Fortran order of the volume,
+        in the same order as flat_indices."""
+        if self._fortran_indices is None:
+            self._fortran_indices = np.ravel_multi_index(self.indices, self.shape,
+                                                         order='F').astype(self.starts.dtype)
+        return self._fortran_indices
+
+    @property
+    def indices(self):
+        """Coordinates of the voxels in the mask, the same as np.where(mask_data)."""
+        return np.unravel_index(self.flat_indices, self.shape)
+
+    def to_array(self):
+        """Return the mask as a boolean volume."""
+        marks = np.zeros(self.size + 1, dtype=np.int8)
+        marks[self.starts] = 1
+        marks[self.stops] -= 1
+        return np.cumsum(marks[:-1], dtype=np.int8).astype(bool).reshape(self.shape)
+
+    def _check_data_shape(self, data):
+        if tuple(data.shape[:len(self.shape)]) != self.shape:
+            raise ValueError('Expected data with the shape {} in its first dimensions, '
+                             'got {}.'.format(self.shape, data.shape))
+
+    def apply(self, data):
+        """Return the voxels of `data` in the mask, the same as `data[mask_data]`.
+
+        Parameters
+        ----------
+        data: numpy.ndarray
+            Volume with the shape of the mask, or with more dimensions, e.g., a 4D timeseries.
+
+        Returns
+        -------
+        masked_data: numpy.ndarray
+            With shape (n_voxels, ) + data.shape[3:]
+        """
+        data = np.asarray(data)
+        self._check_data_shape(data)
+
+        # flatten the volume in its own memory order, so it is a view and not a copy
+        flat_shape = (self.size, ) + data.shape[len(self.shape):]
+        if data.flags.c_contiguous:
+            return data.reshape(flat_shape)[self.flat_indices]
+        if data.flags.f_contiguous:
+            return data.reshape(flat_shape, order='F')[self.fortran_indices]
+        return data[self.indices]
+
+    def unmask(self, arr):
+        """Return a volume with the values of `arr` in the voxels of the mask and 0 elsewhere.
+        This is the inverse of `apply`, see also vector_to_volume and matrix_to_4dvolume.
+
+        Parameters
+        ----------
+        arr: numpy.ndarray
+            A (n_voxels, ) vector or a (n_voxels, n_samples) matrix.
+
+        Returns
+        -------
+        volume: numpy.ndarray
+            With shape self.shape + arr.shape[1:]
+        """
+        arr = np.asarray(arr)
+        if arr.ndim < 1 or arr.shape[0] != self.n_voxels:
+            raise ValueError('Expected arr of shape ({}, ...). Got {}.'.format(self.n_voxels, arr.shape))
+
+        volume = np.zeros((self.size, ) + arr.shape[1:], dtype=arr.dtype)
+        volume[self.flat_indices] = arr
+        return volume.reshape(self.shape + arr.shape[1:])
+
+    def _check_other(self, other):
+        if not isinstance(other, CompactMask):
+            raise TypeError('Expected a CompactMask, got {}.'.format(type(other)))
+
+        if other.shape != self.shape:
+            raise ValueError('Expected a mask with the shape {}, got {}.'.format(self.shape, other.shape))
+
+    def _combine(self, other, min_count):
+        """Return the voxels in at least `min_count` of `self` and `other`, merging their runs."""
+        self._check_other(other)
+
+        # +1 at the start and -1 at the stop of each run, the sum of the changes up to a position
+        # is the number of masks that contain it
+        bounds = np.concatenate([self.starts, other.starts, self.stops, other.stops])
+        change = np.concatenate([np.ones(self.n_runs + other.n_runs, dtype=np.int8),
+                                 -np.ones(self.n_runs + other.n_runs, dtype=np.int8)])
+        if not len(bounds):
+            return CompactMask(bounds, bounds, self.shape)
+
+        order  = np.argsort(bounds, kind='stable')
+        bounds = bounds[order]
+        first  = np.flatnonzero(np.concatenate([[True], bounds[1:] != bounds[:-1]]))
+        bounds = bounds[first]
+        change = np.add.reduceat(change[order], first)
+
+        inside = np.cumsum(change) >= min_count
+        before = np.concatenate([[False], inside[:-1]])
+        return CompactMask(bounds[inside & ~before], bounds[~inside & before], self.shape)
+
+    def union(self, other):
+        """Return the CompactMask of the voxels in this mask or in `other`."""
+        return self._combine(other, 1)
+
+    def intersection(self, other):
+        """Return the CompactMask of the voxels in this mask and in `other`."""
+        return self._combine(other, 2)
+
+    def difference(self, other):
+        """Return the CompactMask of the voxels in this mask but not in `other`."""
+        self._check_other(other)
+        return self.intersection(~other)
+
+    def invert(self):
+        """Return the CompactMask of the voxels of the volume not in this mask."""
+        starts = np.concatenate([[0], self.stops])
+        stops  = np.concatenate([self.starts, [self.size]])
+        keep   = stops > starts
+        return CompactMask(starts[keep], stops[keep], self.shape)
+
+    __or__     = union
+    __and__    = intersection
+    __sub__    = difference
+    __invert__ = invert
+
+    def __eq__(self, other):
+        return isinstance(other, CompactMask) and self.shape == other.shape and \
+               np.array_equal(self.starts, other.starts) and np.array_equal(self.stops, other.stops)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<CompactMask shape={} {} voxels in {} runs>'.format(self.shape, self.n_voxels, self.n_runs)
+
+
 def binarise(image, threshold=0):
     """Binarise image with the given threshold
 
@@ -110,13 +402,118 @@ def binarise(image, threshold=0):
     return img.get_data() > threshold
 
 
-def union_mask(filelist):
+def _get_count_dtype(n_imgs):
+    """Return the smallest unsigned integer type that can count up to `n_imgs`."""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if n_imgs <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def combine_masks(filelist, rule='union', min_count=None, threshold=0, n_threads=2, header_index=None):
+    """Return a binarised mask combining the masks in filelist, i.e., with the voxels which are
+    above `threshold` in at least `min_count` of them.
+
+    The compatibility of the files is checked from their headers only, and they are read in a
+    background thread pool and added one by one to a boolean or small integer accumulator,
+    so only a few of them are in memory at a time.
+
+    Parameters
+    ----------
+    filelist: list of img-like object or boyle.nifti.NeuroImage or str or boyle.nifti.read.ImagePrefetcher
+        List of paths to the volume files containing the ROIs.
+        If an ImagePrefetcher is given, its settings will be used to read the files.
+        See union_mask.
+
+    rule: str
+        How the masks are combined, if `min_count` is not given.
+        Choices: 'union'        the voxels in any of the masks,
+                 'intersection' the voxels in all the masks,
+                 'majority'     the voxels in more than half of the masks.
+
+    min_count: int
+        If given, the voxels in at least `min_count` of the masks. `rule` is not used.
+
+    threshold: float
+        The voxels of each mask with values higher than `threshold` are considered in it. See binarise.
+
+    n_threads: int
+        Number of reading threads.
+
+    header_index: boyle.nifti.header_index.HeaderIndex
+        If given and all the images are file paths, their compatibility is checked
+        with the headers in the index, reading only the files not indexed yet.
+
+    Returns
+    -------
+    ndarray of bools
+        Mask volume
+
+    Raises
+    ------
+    ValueError
+    """
+    images = list(get_img_sources(filelist))
+    if not images:
+        raise ValueError('Expected a non-empty filelist, got {}.'.format(repr_imgs(filelist)))
+
+    n_imgs = len(images)
+    if min_count is None:
+        if rule == 'union':
+            min_count = 1
+        elif rule == 'intersection':
+            min_count = n_imgs
+        elif rule == 'majority':
+            min_count = n_imgs // 2 + 1
+        else:
+            raise ValueError("Expected 'union', 'intersection' or 'majority' as rule, got {}.".format(rule))
+    elif min_count < 1:
+        raise ValueError('Expected `min_count` to be at least 1, got {}.'.format(min_count))
+
+    try:
+        if header_index is not None and all(isinstance(image, string_types) for image in images):
+            header_index.check_compatibility(images)
+        else:
+            check_imgs_compatibility(images)
+    except Exception as exc:
+        raise ValueError('Error joining masks {}.'.format(repr_imgs(images))) from exc
+
+    if isinstance(filelist, ImagePrefetcher):
+        imgs = filelist.with_images(images)
+    else:
+        imgs = ImagePrefetcher(images, n_prefetch=max(n_threads, 1), n_threads=n_threads)
+
+    # count the masks of each voxel only if needed
+    count = min_count != 1 and min_count != n_imgs
+    accum = None
+    idx   = 0
+    try:
+        for idx, img in enumerate(imgs):
+            in_mask = np.asarray(img.get_data()) > threshold
+            if accum is None:
+                accum = in_mask.astype(_get_count_dtype(n_imgs)) if count else in_mask
+            elif count:
+                accum += in_mask
+            elif min_count == 1:
+                accum |= in_mask
+            else:
+                accum &= in_mask
+    except Exception as exc:
+        raise ValueError('Error joining mask {} and {}.'.format(repr_imgs(images[0]),
+                                                                repr_imgs(images[idx]))) from exc
+
+    if count:
+        return accum >= min_count
+    return accum
+
+
+def union_mask(filelist, n_threads=2):
     """
     Creates a binarised mask with the union of the files in filelist.
 
     Parameters
     ----------
-    filelist: list of img-like object or boyle.nifti.NeuroImage or str
+    filelist: list of img-like object or boyle.nifti.NeuroImage or str or boyle.nifti.read.ImagePrefetcher
         List of paths to the volume files containing the ROIs.
         Can either be:
         - a file path to a Nifti image
@@ -125,6 +522,9 @@ def union_mask(filelist):
         call nibabel.load on it. If it is an object, check if get_data()
         and get_affine() methods are present, raise TypeError otherwise.
 
+    n_threads: int
+        Number of reading threads. See combine_masks.
+
     Returns
     -------
     ndarray of bools
@@ -134,19 +534,7 @@ def union_mask(filelist):
     ------
     ValueError
     """
-    firstimg = check_img(filelist[0])
-    mask     = np.zeros_like(firstimg.get_data())
-
-    # create space for all features and read from subjects
-    try:
-        for volf in filelist:
-            roiimg = check_img(volf)
-            check_img_compatibility(firstimg, roiimg)
-            mask  += get_img_data(roiimg)
-    except Exception as exc:
-        raise ValueError('Error joining mask {} and {}.'.format(repr_imgs(firstimg), repr_imgs(volf))) from exc
-    else:
-        return as_ndarray(mask > 0, dtype=bool)
+    return combine_masks(filelist, rule='union', n_threads=n_threads)
 
 
 def apply_mask(image, mask_img):
@@ -354,6 +742,9 @@ def niftilist_mask_to_array(img_filelist, mask_file=None, outdtype=None):
     """From the list of absolute paths to nifti files, creates a Numpy array
     with the masked data.
 
+    The shapes and affines of all the files are checked against the mask first,
+    reading only their headers. Then only the bounding box of the mask is read from each file.
+
     Parameters
     ----------
     img_filelist: list of str
@@ -381,24 +772,24 @@ def niftilist_mask_to_array(img_filelist, mask_file=None, outdtype=None):
         Tuple with shape of the volumes, for reshaping.
 
     """
-    img = check_img(img_filelist[0])
-    if not outdtype:
-        outdtype = img.dtype
+    mask      = load_mask(mask_file)
+    mask_data = mask.get_data()
 
-    mask_data, _ = load_mask_data(mask_file)
-    indices      = np.where      (mask_data)
+    # check all the headers before reading any data
+    imgs = check_imgs_compatibility(img_filelist, ref_img=mask)
 
-    mask = check_img(mask_file)
+    if not outdtype:
+        outdtype = get_img_data_dtype(imgs[0])
 
-    outmat = np.zeros((len(img_filelist), np.count_nonzero(mask_data)),
+    outmat = np.zeros((len(imgs), np.count_nonzero(mask_data)),
                       dtype=outdtype)
 
-    for i, img_item in enumerate(img_filelist):
-        img = check_img(img_item)
-        if not are_compatible_imgs(img, mask):
-            raise NiftiFilesNotCompatible(repr_imgs(img), repr_imgs(mask_file))
+    # read only the bounding box of the mask from each file
+    mask_box = get_bounding_box(mask_data)
+    box_mask = mask_data[mask_box]
 
-        vol = get_img_data(img)
-        outmat[i, :] = vol[indices]
+    # the data is read from the Nifti cache, if enabled
+    for i, image in enumerate(img_filelist):
+        outmat[i, :] = get_img_data_box(image, mask_box)[box_mask]
 
     return outmat, mask_data
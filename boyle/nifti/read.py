@@ -14,12 +14,20 @@ Nifti file access utilities.
 
 import os
 import copy
+import logging
 import operator
+import tempfile
+import os.path           as op
+from   collections       import deque
+from   concurrent.futures import ThreadPoolExecutor
+
 import numpy   as np
 import nibabel as nib
+from   nibabel.fileholders import FileHolder
 from   distutils.version import LooseVersion
 
-from .check import check_img, repr_imgs, get_data
+from .check import check_img, repr_imgs, get_data, check_imgs_compatibility
+from .cache import get_nifti_cache
 from ..exceptions import FileNotFound
 from ..utils import as_ndarray
 from ..utils.compat import _basestring
@@ -27,6 +35,11 @@ from ..utils.compat import _basestring
 
 import warnings
 
+log = logging.getLogger(__name__)
+
+# extension of the seekable gzip index files stored next to the .nii.gz files
+GZIP_INDEX_EXT = '.gzidx'
+
 
 def read_img(img_file):
     """Return a representation of the image, either a nibabel.Nifti1Image or the same object as img_file.
@@ -143,14 +156,341 @@ def load_nipy_img(nii_file):
         raise Exception('Reading file {0}.'.format(repr_imgs(nii_file))) from exc
 
 
+def get_img_data_dtype(image):
+    """Return the type of the data array that get_img_data would return for `image`,
+    reading only the header and the first voxel of the file.
+
+    Parameters
+    ----------
+    image: img-like object or str
+        See get_img_data.
+
+    Returns
+    -------
+    dtype: numpy.dtype
+    """
+    img = check_img(image, use_cache=False)
+    if not hasattr(img, 'dataobj') or isinstance(img.dataobj, np.ndarray):
+        return img.get_data().dtype
+
+    # the proxy applies the header scaling also to a single voxel
+    return np.asanyarray(img.dataobj[(0, ) * len(img.shape)]).dtype
+
+
+def _get_img_array(img):
+    """Return the data array of `img` without caching it in `img`.
+    For uncompressed files without scaling this is a numpy.memmap of the file.
+    """
+    if getattr(img, 'in_memory', False):
+        return img.get_data()
+    if hasattr(img, 'dataobj'):
+        return np.asanyarray(img.dataobj)
+    return get_data(img)
+
+
+def get_img_data_box(image, slices):
+    """Return the voxel data of `image` within `slices`.
+    If `image` has a data proxy (e.g., a file loaded with nibabel), only the data
+    within `slices` is read from the file.
+
+    Parameters
+    ----------
+    image: img-like object or str
+        See get_img_data.
+
+    slices: tuple of slices
+        Defines the box to be read, e.g., (slice(20, 200), slice(40, 150), slice(0, 100)).
+        If slices has less entries than image has dimensions,
+        the slices will be applied to the first len(slices) dimensions.
+
+    Returns
+    -------
+    box_data: numpy.ndarray
+    """
+    img    = check_img(image)
+    slices = tuple(slices)
+    try:
+        if hasattr(img, 'dataobj') and not getattr(img, 'in_memory', False):
+            return np.asanyarray(img.dataobj[slices])
+        return img.get_data()[slices]
+    except Exception as exc:
+        raise Exception('Error when reading file {0}.'.format(repr_imgs(image))) from exc
+
+
+def _import_indexed_gzip():
+    try:
+        import indexed_gzip
+    except:
+        raise ImportError('Could not import indexed_gzip, please install it if you need it.')
+    return indexed_gzip
+
+
+def _is_gzip_index_fresh(file_path, index_file):
+    return op.exists(index_file) and op.getmtime(index_file) >= op.getmtime(file_path)
+
+
+def build_gzip_index(file_path, index_file=None, spacing=1048576):
+    """Build a seekable index of the .nii.gz file `file_path` and store it in `index_file`.
+    With this index any part of the file can be decompressed without inflating the file from the start.
+    This needs the indexed_gzip package.
+
+    Parameters
+    ----------
+    file_path: str
+        Path to a .nii.gz file.
+
+    index_file: str
+        Path to the index file. If None, will be `file_path + GZIP_INDEX_EXT`.
+
+    spacing: int
+        Number of bytes of uncompressed data between the index points.
+
+    Returns
+    -------
+    index_file: str
+    """
+    igzip = _import_indexed_gzip()
+    if index_file is None:
+        index_file = file_path + GZIP_INDEX_EXT
+
+    fobj = igzip.IndexedGzipFile(file_path, spacing=spacing)
+    try:
+        fobj.build_full_index()
+
+        # write and rename, so other processes never read a half written index
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=op.dirname(op.abspath(index_file)))
+        os.close(fd)
+        try:
+            fobj.export_index(tmp_path)
+            os.replace(tmp_path, index_file)
+        except:
+            os.remove(tmp_path)
+            raise
+    finally:
+        fobj.close()
+
+    return index_file
+
+
+def _load_indexed_gzip_img(file_path, build_index=True):
+    """Return the image in the .nii.gz file `file_path` opened through its seekable gzip index,
+    building and storing the index next to the file if needed.
+    The image keeps the index file object open, close it with _close_indexed_gzip_img.
+    Return None if the index can't be used.
+    """
+    try:
+        igzip = _import_indexed_gzip()
+    except ImportError:
+        return None
+
+    index_file = file_path + GZIP_INDEX_EXT
+    if not _is_gzip_index_fresh(file_path, index_file):
+        if not build_index:
+            return None
+
+        try:
+            build_gzip_index(file_path, index_file)
+        except Exception:
+            log.exception('Error building the gzip index of {}.'.format(file_path))
+            return None
+
+    fobj = igzip.IndexedGzipFile(file_path)
+    try:
+        fobj.import_index(index_file)
+
+        img_class = type(nib.load(file_path))
+        file_map  = {'image': FileHolder(filename=file_path, fileobj=fobj)}
+        return img_class.from_file_map(file_map)
+    except:
+        fobj.close()
+        raise
+
+
+def _close_indexed_gzip_img(img):
+    """Close the index file object of an image returned by _load_indexed_gzip_img."""
+    img.file_map['image'].fileobj.close()
+
+
+def get_img_volumes(image, start=0, stop=None, build_index=True):
+    """Return the volumes from `start` to `stop` (not included) of the 4D image `image`.
+    Only the requested volumes are read. For .nii.gz file paths, if the indexed_gzip package
+    is installed, a seekable gzip index is used and stored next to the file the first time,
+    so the file is not inflated from its start.
+
+    Parameters
+    ----------
+    image: img-like object or str
+        4D image. See check_img.
+
+    start: int
+        Index of the first volume.
+
+    stop: int
+        Index after the last volume. If None, will read until the last volume.
+
+    build_index: bool
+        If True and the gzip index of a .nii.gz file does not exist or is older than the file,
+        it will be built. If False and there is no valid index, the file will be inflated from its start.
+
+    Returns
+    -------
+    vols: numpy.ndarray
+        4D array with the volumes.
+    """
+    img = None
+    if isinstance(image, _basestring) and image.lower().endswith('.gz') and get_nifti_cache() is None:
+        if not op.exists(image):
+            raise FileNotFound(image)
+        img = _load_indexed_gzip_img(image, build_index=build_index)
+
+    if img is None:
+        return _read_img_volumes(check_img(image), start, stop)
+
+    try:
+        return _read_img_volumes(img, start, stop)
+    finally:
+        _close_indexed_gzip_img(img)
+
+
+def _read_img_volumes(img, start=0, stop=None):
+    """Return the volumes from `start` to `stop` (not included) of the 4D image `img`, see get_img_volumes."""
+    if len(img.shape) != 4:
+        raise AttributeError('Volume in {} does not have 4 dimensions.'.format(repr_imgs(img)))
+
+    n_vols = img.shape[3]
+    if stop is None:
+        stop = n_vols
+
+    if not 0 <= start < stop <= n_vols:
+        raise IndexError('IndexError: 4th dimension in volume {} has {} volumes, '
+                         'can not read volumes {} to {}.'.format(repr_imgs(img), n_vols, start, stop))
+
+    return get_img_data_box(img, (slice(None), slice(None), slice(None), slice(start, stop)))
+
+
+def _load_img(image):
+    """Return the image with its data loaded and cached in memory."""
+    img = check_img(image)
+    img.get_data()
+    return img
+
+
+def _get_img_nbytes(image):
+    """Return the number of bytes the data of `image` will take in memory, reading only its header."""
+    img = check_img(image, use_cache=False)
+    if getattr(img, 'in_memory', False):
+        return 0
+
+    dtype = np.dtype(img.get_data_dtype())
+    slope, inter = img.header.get_slope_inter() if hasattr(img.header, 'get_slope_inter') else (None, None)
+    if slope is not None or inter is not None:
+        # the data will be scaled to floats
+        dtype = np.dtype(np.float64)
+
+    return int(np.prod(img.shape)) * dtype.itemsize
+
+
+class ImagePrefetcher(object):
+    """Iterate over a list of images, reading and decompressing the next ones in a
+    background thread pool while the current one is processed.
+
+    Iterating yields the images, checked with check_img, with their data already loaded in memory.
+    Indexing and len() work on the given list of images, without loading any data.
+
+    Parameters
+    ----------
+    images: list of img-like objects or str
+        See boyle.nifti.check_img.
+
+    n_prefetch: int
+        Maximum number of images loaded ahead of the current one.
+
+    n_threads: int
+        Number of reading threads.
+
+    max_memory: int
+        Maximum number of bytes of the images loaded ahead, estimated from their headers.
+        At least one image is always loaded ahead. If None, only `n_prefetch` bounds the memory.
+
+    Examples
+    --------
+    >>> outmat, vol_shape = niftilist_to_array(ImagePrefetcher(img_files, n_prefetch=4))
+    """
+    def __init__(self, images, n_prefetch=4, n_threads=2, max_memory=None):
+        if n_prefetch < 1:
+            raise ValueError('Expected `n_prefetch` to be at least 1, got {}.'.format(n_prefetch))
+
+        self.images     = list(images)
+        self.n_prefetch = n_prefetch
+        self.n_threads  = n_threads
+        self.max_memory = max_memory
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, item):
+        return self.images[item]
+
+    def __iter__(self):
+        executor  = ThreadPoolExecutor(max_workers=self.n_threads)
+        pending   = deque()
+        next_idx  = 0
+        in_memory = 0
+        try:
+            while True:
+                while next_idx < len(self.images) and len(pending) < self.n_prefetch:
+                    nbytes = _get_img_nbytes(self.images[next_idx])
+                    if pending and self.max_memory is not None and in_memory + nbytes > self.max_memory:
+                        break
+
+                    pending.append((executor.submit(_load_img, self.images[next_idx]), nbytes, next_idx))
+                    in_memory += nbytes
+                    next_idx  += 1
+
+                if not pending:
+                    break
+
+                future, nbytes, idx = pending.popleft()
+                try:
+                    img = future.result()
+                except Exception as exc:
+                    raise Exception('Error reading image {}.'.format(repr_imgs(self.images[idx]))) from exc
+
+                yield img
+                in_memory -= nbytes
+        finally:
+            for future, _, _ in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def with_images(self, images):
+        """Return a new ImagePrefetcher of `images` with the same settings as this one."""
+        return ImagePrefetcher(images, n_prefetch=self.n_prefetch, n_threads=self.n_threads,
+                               max_memory=self.max_memory)
+
+    def __repr__(self):
+        return '<ImagePrefetcher> ' + repr_imgs(self.images)
+
+
+def get_img_sources(images):
+    """Return the list of images given to `images` if it is an ImagePrefetcher,
+    `images` otherwise. Useful to check the headers of the images without loading their data.
+    """
+    if isinstance(images, ImagePrefetcher):
+        return images.images
+    return images
+
+
 def niftilist_to_array(img_filelist, outdtype=None):
     """
     From the list of absolute paths to nifti files, creates a Numpy array
     with the data.
 
+    The shapes and affines of all the files are checked first, reading only their headers.
+
     Parameters
     ----------
-    img_filelist:  list of str
+    img_filelist:  list of str or ImagePrefetcher
         List of absolute file paths to nifti files. All nifti files must have
         the same shape.
 
@@ -166,25 +506,35 @@ def niftilist_to_array(img_filelist, outdtype=None):
     vol_shape: Tuple with shape of the volumes, for reshaping.
 
     """
+    if not len(img_filelist) > 0:
+        raise ValueError('Expected a non-empty img_filelist, got {}.'.format(repr_imgs(img_filelist)))
+
+    sources = get_img_sources(img_filelist)
     try:
-        first_img = img_filelist[0]
-        vol       = get_img_data(first_img)
-    except IndexError as ie:
-        raise Exception('Error getting the first item of img_filelis: {}'.format(repr_imgs(img_filelist[0]))) from ie
+        imgs = check_imgs_compatibility(sources)
+    except Exception as exc:
+        raise Exception('Error checking the headers of {}.'.format(repr_imgs(img_filelist))) from exc
 
+    vol_shape = imgs[0].shape
     if not outdtype:
-        outdtype = vol.dtype
+        outdtype = get_img_data_dtype(imgs[0])
+
+    outmat = np.zeros((len(imgs), np.prod(vol_shape)), dtype=outdtype)
 
-    outmat = np.zeros((len(img_filelist), np.prod(vol.shape)), dtype=outdtype)
+    # read the data from the prefetcher, if given, or from the Nifti cache, if enabled
+    if isinstance(img_filelist, ImagePrefetcher):
+        imgs = img_filelist
+    else:
+        imgs = sources
 
     try:
-        for i, img_file in enumerate(img_filelist):
-            vol = get_img_data(img_file)
-            outmat[i, :] = vol.flatten()
+        for i, img in enumerate(imgs):
+            # the row is C-contiguous, so this is a view and the data is copied only once
+            outmat[i, :].reshape(vol_shape)[...] = _get_img_array(check_img(img))
     except Exception as exc:
-        raise Exception('Error on reading file {0}.'.format(img_file)) from exc
+        raise Exception('Error on reading file {0}.'.format(repr_imgs(img))) from exc
 
-    return outmat, vol.shape
+    return outmat, vol_shape
 
 
 def _crop_img_to(image, slices, copy=True):
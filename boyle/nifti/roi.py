@@ -9,17 +9,38 @@
 # Use this at your own risk!
 # -------------------------------------------------------------------------------
 
+import os
+import logging
+import tempfile
+import os.path          as op
+
 import numpy            as np
 import nibabel          as nib
 import scipy.ndimage    as scn
+import scipy.sparse     as sparse
 from   collections      import OrderedDict
+from   multiprocessing import Pool
+from   concurrent.futures import ThreadPoolExecutor
+
+from   six              import string_types
 
 from   .check           import check_img_compatibility, repr_imgs, check_img
-from   .read            import read_img, get_img_data, get_img_info
+from   .read            import read_img, get_img_data, get_img_info, get_img_volumes
 from   .mask            import binarise, load_mask
+from   ..parallel       import get_n_jobs, create_shared_memmap, open_shared_memmap, remove_shared_memmap
+from   ..storage        import ExportData
 from   ..utils.strings  import search_list
 
 
+log = logging.getLogger(__name__)
+
+# extension of the AtlasIndex files next to their atlas file
+ATLAS_INDEX_EXT = '.atlasidx.npz'
+
+# state of the partition_timeseries_many worker processes, set by _init_partition_worker
+_worker = {}
+
+
 def drain_rois(img):
     """Find all the ROIs in img and returns a similar volume with the ROIs
     emptied, keeping only their border voxels.
@@ -43,19 +64,20 @@ def drain_rois(img):
     """
     img_data = get_img_data(img)
 
-    out = np.zeros(img_data.shape, dtype=img_data.dtype)
-
-    krn_dim = [3] * img_data.ndim
-    kernel  = np.ones(krn_dim, dtype=int)
+    # a voxel is inside its ROI if all its neighbours, in a 3x..x3 neighbourhood, have its same value,
+    # i.e., the minimum and the maximum of the neighbourhood are equal
+    inner  = scn.minimum_filter(img_data, size=3, mode='nearest') == \
+             scn.maximum_filter(img_data, size=3, mode='nearest')
 
-    vals = np.unique(img_data)
-    vals = vals[vals != 0]
+    # the voxels on the borders of the volume are never inside, as in binary_hit_or_miss
+    for axis in range(img_data.ndim):
+        index = [slice(None)] * img_data.ndim
+        index[axis] = [0, -1]
+        inner[tuple(index)] = False
 
-    for i in vals:
-        roi  = img_data == i
-        hits = scn.binary_hit_or_miss(roi, kernel)
-        roi[hits] = 0
-        out[roi > 0] = i
+    out = np.zeros(img_data.shape, dtype=img_data.dtype)
+    border = np.logical_and(img_data != 0, np.logical_not(inner))
+    out[border] = img_data[border]
 
     return out
 
@@ -84,12 +106,50 @@ def pick_rois(rois_img, roi_values, bg_val=0):
     else:
         out = np.ones(img_data.shape, dtype=img_data.dtype) * bg_val
 
-    for r in roi_values:
-        out[img_data == r] = r
+    picked = _isin_values(img_data, roi_values)
+    out[picked] = img_data[picked]
 
     return nib.Nifti2Image(out, affine=img.affine, header=img.header)
 
 
+def _isin_values(arr, values):
+    """Return a boolean array, True where the value of `arr` is in `values`.
+    For integer arrays with a range of values not much larger than the array,
+    uses a lookup table indexed by value, otherwise np.isin.
+
+    Parameters
+    ----------
+    arr: numpy.ndarray
+
+    values: list of int or float
+
+    Returns
+    -------
+    isin: numpy.ndarray
+        Boolean array with the shape of `arr`.
+    """
+    values = np.asarray(values)
+    if arr.dtype.kind not in 'iub' or arr.size == 0 or values.size == 0:
+        return np.isin(arr, values)
+
+    vmin, vmax = int(arr.min()), int(arr.max())
+    if vmax - vmin > max(arr.size, 65536):
+        return np.isin(arr, values)
+
+    # only the integer values within the range of arr can be found
+    values = values[(values >= vmin) & (values <= vmax)]
+    values = values[values == np.floor(values)].astype(np.int64)
+
+    lut = np.zeros(vmax - vmin + 1, dtype=bool)
+    lut[values - vmin] = True
+
+    # integer indices, a boolean arr would be taken as a mask of lut
+    indices = arr.astype(np.intp, copy=False)
+    if vmin != 0:
+        indices = indices - vmin
+    return lut[indices]
+
+
 def largest_connected_component(volume):
     """Return the largest connected component of a 3D array.
 
@@ -138,15 +198,12 @@ def large_clusters_mask(volume, min_cluster_size):
     """
     labels, num_labels = scn.label(volume)
 
-    labels_to_keep = set([i for i in range(num_labels)
-                         if np.sum(labels == i) >= min_cluster_size])
-
-    clusters_mask = np.zeros_like(volume, dtype=int)
-    for l in range(num_labels):
-        if l in labels_to_keep:
-            clusters_mask[labels == l] = 1
+    # the size of each connected component, the label 0 is the background
+    sizes = np.bincount(labels.ravel(), minlength=num_labels + 1)
+    keep  = sizes >= min_cluster_size
+    keep[0] = False
 
-    return clusters_mask
+    return keep[labels].astype(int)
 
 
 def create_rois_mask(roislist, filelist):
@@ -191,6 +248,9 @@ def get_unique_nonzeros(arr):
     -------
     list of items of arr.
     """
+    if isinstance(arr, AtlasIndex):
+        return arr.roi_values.copy()
+
     rois = np.unique(arr)
     rois = rois[np.nonzero(rois)]
     rois.sort()
@@ -222,6 +282,9 @@ def get_roilist_from_atlas(atlas_img):
     ----
     The roi with value 0 will be considered background so will be removed.
     """
+    if isinstance(atlas_img, AtlasIndex):
+        return get_unique_nonzeros(atlas_img)
+
     return get_unique_nonzeros(check_img(atlas_img).get_data())
 
 
@@ -230,7 +293,7 @@ def get_rois_centers_of_mass(vol):
 
     Parameters
     ----------
-    vol: numpy ndarray
+    vol: numpy ndarray or AtlasIndex
         Volume with different values for each ROI.
 
     Returns
@@ -238,6 +301,9 @@ def get_rois_centers_of_mass(vol):
     OrderedDict
         Each entry in the dict has the ROI value as key and the center_of_mass coordinate as value.
     """
+    if isinstance(vol, AtlasIndex):
+        return OrderedDict((r, tuple(center)) for r, center in zip(vol.roi_values, vol.centers))
+
     from scipy.ndimage.measurements import center_of_mass
 
     roisvals = np.unique(vol)
@@ -265,7 +331,7 @@ def partition_timeseries(image, roi_img, mask_img=None, zeroe=True, roi_values=N
     image: img-like object or str
         4D timeseries volume
 
-    roi_img: img-like object or str
+    roi_img: img-like object, str or AtlasIndex
         3D volume defining different ROIs.
 
     mask_img: img-like object or str
@@ -296,11 +362,12 @@ def partition_timeseries(image, roi_img, mask_img=None, zeroe=True, roi_values=N
     check_img_compatibility(img, rois, only_check_3d=True)
 
     # check if rois has all roi_values
-    roi_data = rois.get_data()
+    roi_data = rois if isinstance(rois, AtlasIndex) else rois.get_data()
     if roi_values is not None:
-        for rv in roi_values:
-            if not np.any(roi_data == rv):
-                raise ValueError('Could not find value {} in rois_img {}.'.format(rv, repr_imgs(roi_img)))
+        found = np.isin(roi_values, roi_data.roi_values if isinstance(rois, AtlasIndex) else roi_data)
+        if not np.all(found):
+            rv = roi_values[int(np.argmin(found))]
+            raise ValueError('Could not find value {} in rois_img {}.'.format(rv, repr_imgs(roi_img)))
     else:
         roi_values = get_unique_nonzeros(roi_data)
 
@@ -320,7 +387,7 @@ def partition_timeseries(image, roi_img, mask_img=None, zeroe=True, roi_values=N
 
     # extract data and return it
     try:
-        return extract_data(img.get_data(), rois.get_data(), mask_data,
+        return extract_data(img.get_data(), roi_data, mask_data,
                             roi_values=roi_values, zeroe=zeroe)
     except:
         raise
@@ -331,6 +398,175 @@ def partition_volume(*args, **kwargs):
     return partition_timeseries(*args, **kwargs)
 
 
+def _init_partition_worker(voxels_file, n_voxels, offsets, shape, affine, zeroe):
+    """Open the shared voxel indices of the ROIs once for each worker process."""
+    _worker['voxels']  = {'C': open_shared_memmap(voxels_file, (n_voxels, ), np.int64, mode='r')}
+    _worker['offsets'] = offsets
+    _worker['shape']   = shape
+    _worker['zeroe']   = zeroe
+    # an image with the shape and affine of the ROIs to check the compatibility of the subjects,
+    # its data is a broadcast scalar, so it takes no memory
+    _worker['rois']    = nib.Nifti1Image(np.broadcast_to(np.int8(0), shape), affine)
+
+
+def _get_partition_voxels(order):
+    """Return the flat indices of the voxels of the ROIs in `order` ('C' or 'F') of the worker process."""
+    voxels = _worker['voxels']
+    if order not in voxels:
+        shape = _worker['shape']
+        voxels[order] = np.ravel_multi_index(np.unravel_index(voxels['C'], shape), shape, order=order)
+    return voxels[order]
+
+
+def _partition_subject(args):
+    """Return the index of the image, its list of ROI timeseries and None,
+    or the index, None and the error message if it could not be partitioned."""
+    idx, image = args
+    try:
+        img = check_img(image)
+        check_img_compatibility(img, _worker['rois'], only_check_3d=True)
+
+        # flatten the volume in its memory order, usually Fortran for Nifti files, so it is not copied
+        vol     = get_img_data(img, copy=False)
+        order   = 'F' if vol.flags.f_contiguous and not vol.flags.c_contiguous else 'C'
+        data    = vol.reshape((-1, ) + vol.shape[3:], order=order)
+        voxels  = _get_partition_voxels(order)
+        offsets = _worker['offsets']
+
+        ts_list = []
+        for start, stop in zip(offsets[:-1], offsets[1:]):
+            # the same as _get_roi_data on the flattened volume
+            ts = data[voxels[start:stop]]
+            if _worker['zeroe'] and vol.ndim == 4:
+                ts = ts[ts.sum(axis=1) != 0, :]
+
+            if len(ts) == 0:
+                ts = np.zeros(vol.shape[-1])
+
+            ts_list.append(ts)
+
+    except Exception as exc:
+        return idx, None, '{}: {}'.format(exc.__class__.__name__, exc)
+
+    return idx, ts_list, None
+
+
+def partition_timeseries_many(images, roi_img, output_file, mask_img=None, zeroe=True, roi_values=None,
+                              n_jobs=1):
+    """Partition the timeseries of each image in `images` according to the ROIs in `roi_img`,
+    as partition_timeseries does, and save them in the HDF5 file `output_file`.
+
+    The ROIs and mask are read once, their voxel indices are shared with the `n_jobs` worker processes,
+    and the timeseries of each subject are written to the file as soon as they are ready.
+    The images which can not be read or are not compatible with `roi_img` are skipped and reported.
+
+    The ROI timeseries of the image `images[i]` are the datasets '/timeseries/<i>/<roi value>' of the file,
+    which also has the datasets 'roi_values', 'image_files' (if all the images are file paths),
+    'failed' with the indices of the skipped images, and 'errors' with their error messages.
+
+    Parameters
+    ----------
+    images: list of img-like objects or str
+        4D timeseries volumes or 3D volumes to be partitioned.
+
+    roi_img: img-like object, str or AtlasIndex
+        3D volume defining different ROIs.
+
+    output_file: str
+        Path to the .hdf5 or .h5 output file.
+
+    mask_img: img-like object or str
+        3D mask volume
+
+    zeroe: bool
+        If true will remove the null timeseries voxels.
+
+    roi_values: list of ROI values (int?)
+        List of the values of the ROIs to indicate the
+        order and which ROIs will be processed.
+
+    n_jobs: int
+        Number of worker processes, see boyle.parallel.get_n_jobs.
+
+    Returns
+    -------
+    errors: OrderedDict
+        The error message of each image that could not be partitioned, by image index.
+    """
+    from ..hdf5 import save_variables_to_hdf5
+
+    images = list(images)
+    rois   = read_img(roi_img)
+    if len(rois.shape) != 3:
+        raise ValueError('Expected a 3D ROIs volume, got {} with shape {}.'.format(repr_imgs(roi_img), rois.shape))
+
+    roi_data = rois if isinstance(rois, AtlasIndex) else rois.get_data()
+    if roi_values is not None:
+        found = np.isin(roi_values, roi_data.roi_values if isinstance(rois, AtlasIndex) else roi_data)
+        if not np.all(found):
+            rv = roi_values[int(np.argmin(found))]
+            raise ValueError('Could not find value {} in rois_img {}.'.format(rv, repr_imgs(roi_img)))
+    else:
+        roi_values = get_unique_nonzeros(roi_data)
+
+    mask_data = None
+    if mask_img is not None:
+        mask = load_mask(mask_img)
+        check_img_compatibility(rois, mask, only_check_3d=True)
+        mask_data = mask.get_data()
+
+    # the flat voxel indices of all the ROIs, one ROI after the other
+    rois_indices = _get_rois_indices(roi_data, roi_values, mask_data)
+    offsets = np.concatenate([[0], np.cumsum([len(indices[0]) for indices in rois_indices])]).astype(int)
+    shape   = tuple(int(n) for n in rois.shape)
+    voxels, voxels_file = create_shared_memmap((max(int(offsets[-1]), 1), ), np.int64)
+    if offsets[-1]:
+        voxels[:] = np.concatenate([np.ravel_multi_index(indices, shape) for indices in rois_indices])
+    voxels.flush()
+
+    content = {'roi_values': np.asarray(roi_values)}
+    if all(isinstance(image, string_types) for image in images):
+        content['image_files'] = np.array(images)
+    save_variables_to_hdf5(output_file, content, mode='w')
+
+    n_jobs   = min(get_n_jobs(n_jobs), max(len(images), 1))
+    initargs = (voxels_file, len(voxels), offsets, shape, np.asarray(rois.get_affine()), zeroe)
+    errors   = OrderedDict()
+    pool     = None
+    try:
+        if n_jobs > 1:
+            pool    = Pool(processes=n_jobs, initializer=_init_partition_worker, initargs=initargs)
+            results = pool.imap_unordered(_partition_subject, enumerate(images))
+        else:
+            _init_partition_worker(*initargs)
+            results = map(_partition_subject, enumerate(images))
+
+        for n_done, (idx, ts_list, error) in enumerate(results, 1):
+            if error is not None:
+                errors[idx] = error
+                log.error('Error partitioning image {} ({}/{}): {}'.format(repr_imgs(images[idx]), n_done,
+                                                                           len(images), error))
+                continue
+
+            save_variables_to_hdf5(output_file, OrderedDict((str(r), ts) for r, ts in zip(roi_values, ts_list)),
+                                   mode='a', h5path='/timeseries/{}'.format(idx))
+            log.info('Partitioned image {} ({}/{}).'.format(repr_imgs(images[idx]), n_done, len(images)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _worker.clear()
+        remove_shared_memmap(voxels_file)
+
+    errors  = OrderedDict(sorted(errors.items()))
+    content = {'failed': np.array(list(errors.keys()), dtype=int)}
+    if errors:
+        content['errors'] = np.array(list(errors.values()))
+    save_variables_to_hdf5(output_file, content, mode='a')
+
+    return errors
+
+
 def _check_for_partition(datavol, roivol, maskvol=None):
     if datavol.ndim != 4 and datavol.ndim != 3:
         raise AttributeError('Expected a volume with 3 or 4 dimensions. '
@@ -347,6 +583,62 @@ def _check_for_partition(datavol, roivol, maskvol=None):
                                                                                              maskvol.shape))
 
 
+def _get_rois_indices(roivol, roi_values, maskvol=None):
+    """Return the indices of the voxels of each ROI in `roi_values`.
+
+    The voxels are sorted by their ROI value once, so the voxels of each ROI are a contiguous
+    range of the sorted voxels, instead of comparing the whole `roivol` with each ROI value.
+
+    Parameters
+    ----------
+    roivol: numpy.ndarray or AtlasIndex
+        3D ROIs volume
+
+    roi_values: list of ROI values
+
+    maskvol: numpy.ndarray
+        3D mask volume. If given, the voxels outside of it are excluded.
+
+    Returns
+    -------
+    rois_indices: list of tuple of numpy.ndarray
+        For each ROI value, the indices of its voxels in `roivol` as returned by np.where,
+        in the same order as `roivol == roivalue` would give them.
+    """
+    if isinstance(roivol, AtlasIndex):
+        return roivol.get_rois_indices(roi_values, maskvol)
+
+    labels = np.asarray(roivol).ravel()
+    voxels = None
+    if maskvol is not None:
+        voxels = np.flatnonzero(np.asarray(maskvol).ravel() > 0)
+        labels = labels[voxels]
+
+    # a stable sort keeps the voxels of each ROI in C order
+    order  = np.argsort(labels, kind='stable')
+    labels = labels[order]
+    if voxels is not None:
+        order = voxels[order]
+
+    coords = np.unravel_index(order, roivol.shape)
+    starts = np.searchsorted(labels, roi_values, side='left')
+    stops  = np.searchsorted(labels, roi_values, side='right')
+
+    return [tuple(c[start:stop] for c in coords) for start, stop in zip(starts, stops)]
+
+
+def _get_roi_data(datavol, indices, zeroe=True):
+    """Return the values of `datavol` in the voxel `indices`, see _partition_data."""
+    ts = datavol[indices]
+
+    # remove zeroed time series
+    if zeroe:
+        if datavol.ndim == 4:
+            ts = ts[ts.sum(axis=1) != 0, :]
+
+    return ts
+
+
 def _partition_data(datavol, roivol, roivalue, maskvol=None, zeroe=True):
     """ Extracts the values in `datavol` that are in the ROI with value `roivalue` in `roivol`.
     The ROI can be masked by `maskvol`.
@@ -356,7 +648,7 @@ def _partition_data(datavol, roivol, roivalue, maskvol=None, zeroe=True):
     datavol: numpy.ndarray
         4D timeseries volume or a 3D volume to be partitioned
 
-    roivol: numpy.ndarray
+    roivol: numpy.ndarray or AtlasIndex
         3D ROIs volume
 
     roivalue: int or float
@@ -381,17 +673,7 @@ def _partition_data(datavol, roivol, roivalue, maskvol=None, zeroe=True):
         # get all time series within this roi r
         indices = roivol == roivalue
 
-    if datavol.ndim == 4:
-        ts = datavol[indices, :]
-    else:
-        ts = datavol[indices]
-
-    # remove zeroed time series
-    if zeroe:
-        if datavol.ndim == 4:
-            ts = ts[ts.sum(axis=1) != 0, :]
-
-    return ts
+    return _get_roi_data(datavol, indices, zeroe)
 
 
 def _extract_timeseries_dict(tsvol, roivol, maskvol=None, roi_values=None, zeroe=True):
@@ -403,7 +685,7 @@ def _extract_timeseries_dict(tsvol, roivol, maskvol=None, roi_values=None, zeroe
     tsvol: numpy.ndarray
         4D timeseries volume or a 3D volume to be partitioned
 
-    roivol: numpy.ndarray
+    roivol: numpy.ndarray or AtlasIndex
         3D ROIs volume
 
     maskvol: numpy.ndarray
@@ -428,8 +710,8 @@ def _extract_timeseries_dict(tsvol, roivol, maskvol=None, roi_values=None, zeroe
         roi_values = get_unique_nonzeros(roivol)
 
     ts_dict = OrderedDict()
-    for r in roi_values:
-        ts = _partition_data(tsvol, roivol, r, maskvol, zeroe)
+    for r, indices in zip(roi_values, _get_rois_indices(roivol, roi_values, maskvol)):
+        ts = _get_roi_data(tsvol, indices, zeroe)
 
         if len(ts) == 0:
             ts = np.zeros(tsvol.shape[-1])
@@ -448,7 +730,7 @@ def _extract_timeseries_list(tsvol, roivol, maskvol=None, roi_values=None, zeroe
     tsvol: numpy.ndarray
         4D timeseries volume or a 3D volume to be partitioned
 
-    roivol: numpy.ndarray
+    roivol: numpy.ndarray or AtlasIndex
         3D ROIs volume
 
     maskvol: numpy.ndarray
@@ -472,8 +754,8 @@ def _extract_timeseries_list(tsvol, roivol, maskvol=None, roi_values=None, zeroe
         roi_values = get_unique_nonzeros(roivol)
 
     ts_list = []
-    for r in roi_values:
-        ts = _partition_data(tsvol, roivol, r, maskvol, zeroe)
+    for indices in _get_rois_indices(roivol, roi_values, maskvol):
+        ts = _get_roi_data(tsvol, indices, zeroe)
 
         if len(ts) == 0:
             ts = np.zeros(tsvol.shape[-1])
@@ -483,6 +765,451 @@ def _extract_timeseries_list(tsvol, roivol, maskvol=None, roi_values=None, zeroe
     return ts_list
 
 
+class ROISummarizer(object):
+    """Summarize the time series of each ROI of an atlas into its mean or median time series,
+    for many subjects.
+
+    The voxels of each ROI are found once, and the mean is computed as the product of a sparse
+    ROIs x voxels matrix with the data of each subject.
+    The result is the same as the mean or median over the first axis of each
+    set of timeseries returned by partition_timeseries.
+
+    Parameters
+    ----------
+    roi_img: img-like object, str or AtlasIndex
+        3D volume defining different ROIs.
+
+    mask_img: img-like object or str
+        3D mask volume. If given, the voxels outside of it are excluded.
+
+    roi_values: list of ROI values
+        The values of the ROIs to summarize, in this order. If None, all the non-zero values of `roi_img`.
+
+    strategy: str
+        'mean' or 'median'.
+
+    zeroe: bool
+        If True will exclude the voxels with null timeseries from each subject.
+
+    Examples
+    --------
+    >>> summarizer = ROISummarizer('atlas.nii.gz', mask_img='brain_mask.nii.gz')
+    >>> summarizer.to_file(subject_files, 'rois_timeseries.h5', n_jobs=4)
+    """
+    def __init__(self, roi_img, mask_img=None, roi_values=None, strategy='mean', zeroe=True):
+        if strategy not in ('mean', 'median'):
+            raise ValueError("Expected 'mean' or 'median' as strategy, got {}.".format(strategy))
+
+        self.roi_img  = read_img(roi_img)
+        self.strategy = strategy
+        self.zeroe    = zeroe
+
+        roi_data  = self.roi_img if isinstance(self.roi_img, AtlasIndex) else self.roi_img.get_data()
+        mask_data = None
+        if mask_img is not None:
+            mask = load_mask(mask_img)
+            check_img_compatibility(self.roi_img, mask, only_check_3d=True)
+            mask_data = mask.get_data()
+
+        if roi_values is None:
+            roi_values = get_unique_nonzeros(roi_data)
+        self.roi_values = np.asarray(roi_values)
+
+        # the voxels of all the ROIs, grouped by ROI
+        rois_indices = _get_rois_indices(roi_data, self.roi_values, mask_data)
+        self.roi_sizes = np.array([len(indices[0]) for indices in rois_indices], dtype=int)
+        self.voxels    = tuple(np.concatenate([indices[axis] for indices in rois_indices]) for axis in range(3))
+        self._bounds   = np.concatenate([[0], np.cumsum(self.roi_sizes)])
+
+        n_voxels = int(self._bounds[-1])
+        roi_rows = np.repeat(np.arange(len(self.roi_values)), self.roi_sizes)
+        self.operator = sparse.csr_matrix((np.ones(n_voxels), (roi_rows, np.arange(n_voxels))),
+                                          shape=(len(self.roi_values), n_voxels))
+
+        # (memory order, dtype) -> flat indices of the voxels sorted and the operator for them
+        self._operators = {}
+
+    @property
+    def n_rois(self):
+        return len(self.roi_values)
+
+    def _get_operator(self, order, dtype):
+        """Return the flat indices of the voxels in `order` ('C' or 'F') sorted, so they are read
+        sequentially, and self.operator of `dtype` with its columns in the same order."""
+        key = (order, np.dtype(dtype).char)
+        if key not in self._operators:
+            flat = np.ravel_multi_index(self.voxels, self.roi_img.shape[:3], order=order)
+            perm = np.argsort(flat)
+            self._operators[key] = (flat[perm], self.operator[:, perm].astype(dtype).tocsr())
+        return self._operators[key]
+
+    def summarize(self, data):
+        """Return the summary of each ROI from `data`, the values of the voxels in self.voxels.
+
+        Parameters
+        ----------
+        data: numpy.ndarray
+            A (n_voxels, n_vols) matrix or a vector of n_voxels.
+
+        Returns
+        -------
+        summary: numpy.ndarray
+            A (n_rois, n_vols) matrix or a vector of n_rois.
+        """
+        return self._summarize(data, self.operator)
+
+    def _summarize(self, data, operator):
+        """Return the summary of each ROI from `data`, the values of the voxels in the
+        order of the columns of `operator`. The median needs the order of self.voxels."""
+        flat = data.reshape((len(data), -1))
+
+        # the voxels with null time series, see _get_roi_data
+        nonnull = None
+        if self.zeroe and data.ndim == 2:
+            nonnull = flat.sum(axis=1) != 0
+
+        if self.strategy == 'mean':
+            if nonnull is None:
+                counts = self.roi_sizes.astype(np.float64)
+            else:
+                # drop the columns of the null voxels, their values may not be all zero
+                operator = operator.multiply(nonnull.astype(operator.dtype)).tocsr()
+                counts   = np.asarray(operator.sum(axis=1), dtype=np.float64).ravel()
+
+            sums = operator.dot(flat.astype(operator.dtype, copy=False)).astype(np.float64, copy=False)
+
+            summary = np.zeros(sums.shape)
+            np.divide(sums, counts[:, np.newaxis], out=summary, where=counts[:, np.newaxis] > 0)
+        else:
+            summary = np.zeros((self.n_rois, flat.shape[1]))
+            for roi_idx, (start, stop) in enumerate(zip(self._bounds[:-1], self._bounds[1:])):
+                ts = flat[start:stop]
+                if nonnull is not None:
+                    ts = ts[nonnull[start:stop]]
+
+                if len(ts):
+                    summary[roi_idx] = np.median(ts, axis=0)
+
+        return summary.reshape((self.n_rois, ) + data.shape[1:])
+
+    def transform(self, image):
+        """Return the summary of each ROI in `image`.
+
+        Parameters
+        ----------
+        image: img-like object or str
+            3D or 4D volume with the same 3D shape and affine as the atlas.
+
+        Returns
+        -------
+        summary: numpy.ndarray
+            A (n_rois, n_vols) matrix for 4D images or a vector of n_rois for 3D images.
+        """
+        img = check_img(image)
+        check_img_compatibility(img, self.roi_img, only_check_3d=True)
+        try:
+            data = get_img_data(img)
+            if self.strategy == 'median':
+                return self.summarize(data[self.voxels])
+
+            # read the voxels in the memory order of data, usually Fortran for Nifti files
+            order = 'F' if data.flags.f_contiguous and not data.flags.c_contiguous else 'C'
+            dtype = np.float32 if data.dtype == np.float32 else np.float64
+            voxels, operator = self._get_operator(order, dtype)
+            return self._summarize(data.reshape((-1, ) + data.shape[3:], order=order)[voxels], operator)
+        except Exception as exc:
+            raise Exception('Error summarizing the ROIs of {}.'.format(repr_imgs(image))) from exc
+
+    def iter_transform(self, images, n_jobs=1):
+        """Yield the summary of each ROI of each image in `images`, in the same order.
+        With `n_jobs` > 1, the images are read and summarized in a pool of threads.
+        """
+        n_jobs = get_n_jobs(n_jobs)
+        if n_jobs == 1:
+            for image in images:
+                yield self.transform(image)
+            return
+
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            for summary in executor.map(self.transform, images):
+                yield summary
+
+    def transform_many(self, images, n_jobs=1):
+        """Return the summary of each ROI of each image in `images`.
+
+        Parameters
+        ----------
+        images: list of img-like objects or str
+            The subject images, all with the same shape.
+
+        n_jobs: int
+            Number of threads, see boyle.parallel.get_n_jobs.
+
+        Returns
+        -------
+        summaries: numpy.ndarray
+            A (n_subjects, n_rois, n_vols) array.
+        """
+        return np.array(list(self.iter_transform(images, n_jobs=n_jobs)))
+
+    def to_file(self, images, output_file, n_jobs=1):
+        """Save the summary of each ROI of each image in `images` in an HDF5 file,
+        one subject at a time, as the (n_subjects, n_rois, n_vols) 'data' dataset.
+        The file also has the 'roi_values' and 'roi_sizes' datasets.
+
+        Parameters
+        ----------
+        images: list of img-like objects or str
+            The subject images, all with the same shape.
+
+        output_file: str
+            Path to the .hdf5 or .h5 output file.
+
+        n_jobs: int
+            Number of threads, see boyle.parallel.get_n_jobs.
+        """
+        images    = list(images)
+        row_shape = (self.n_rois, ) + tuple(check_img(images[0], use_cache=False).shape[3:]) if images else (self.n_rois, )
+        content   = {'roi_values': self.roi_values,
+                     'roi_sizes':  self.roi_sizes, }
+
+        try:
+            ExportData.save_rows(output_file, self.iter_transform(images, n_jobs=n_jobs), row_shape,
+                                 np.float64, n_rows=len(images), variables=content)
+        except Exception as exc:
+            raise Exception('Error saving ROI summaries to file {}.'.format(output_file)) from exc
+
+    def __repr__(self):
+        return '<ROISummarizer {} ROIs strategy={}>'.format(self.n_rois, self.strategy)
+
+
+class AtlasIndex(object):
+    """The voxels, sizes, bounding boxes and centers of mass of the ROIs of an atlas,
+    computed once and saved next to the atlas file.
+
+    The voxels are stored CSR-style: the flat indices (in C order) of the voxels of all the
+    ROIs sorted by ROI value, and the offsets of each ROI in them.
+
+    An AtlasIndex has get_data() and get_affine() methods, so it can be given in place of the atlas
+    image to the functions of this module. The ones that only need the ROI values, voxels or centers
+    of mass use the index directly, the others rebuild the atlas volume from it.
+
+    Parameters
+    ----------
+    roi_values: numpy.ndarray
+        Sorted non-zero values of the atlas.
+
+    voxels: numpy.ndarray
+        Flat indices of the voxels of each ROI, one ROI after the other.
+
+    offsets: numpy.ndarray
+        The voxels of the ROI `roi_values[i]` are `voxels[offsets[i]:offsets[i+1]]`.
+
+    shape: tuple of 3 int
+
+    affine: numpy.ndarray
+
+    bboxes: numpy.ndarray
+        (n_rois, 3, 2) array with the first and last + 1 voxel coordinates of each ROI along each axis.
+
+    centers: numpy.ndarray
+        (n_rois, 3) array with the center of mass of each ROI, in voxel coordinates.
+
+    source: tuple
+        (path, size, modification time) of the atlas file, to check if the index is outdated.
+
+    Examples
+    --------
+    >>> atlas = AtlasIndex.for_file('atlas.nii.gz')
+    >>> partition_timeseries('func.nii.gz', atlas)
+    """
+    def __init__(self, roi_values, voxels, offsets, shape, affine, bboxes, centers, source=None):
+        self.roi_values = np.asarray(roi_values)
+        self.voxels     = np.asarray(voxels)
+        self.offsets    = np.asarray(offsets)
+        self.shape      = tuple(int(n) for n in shape)
+        self.affine     = np.asarray(affine)
+        self.bboxes     = np.asarray(bboxes)
+        self.centers    = np.asarray(centers)
+        self.source     = source
+        self._volume    = None
+
+    @classmethod
+    def from_img(cls, atlas_img):
+        """Return the AtlasIndex of `atlas_img`.
+
+        Parameters
+        ----------
+        atlas_img: img-like object or str
+            3D volume defining different ROIs. The value 0 is the background.
+
+        Returns
+        -------
+        atlas_index: AtlasIndex
+        """
+        img  = check_img(atlas_img)
+        data = np.asarray(img.get_data())
+        if data.ndim != 3:
+            raise ValueError('Expected a 3D atlas volume, got {} with {} dimensions.'.format(repr_imgs(img),
+                                                                                            data.ndim))
+
+        flat   = data.ravel()
+        voxels = np.flatnonzero(flat)
+        labels = flat[voxels]
+
+        # a stable sort keeps the voxels of each ROI in C order
+        order  = np.argsort(labels, kind='stable')
+        voxels = voxels[order]
+        roi_values, starts, sizes = np.unique(labels[order], return_index=True, return_counts=True)
+        offsets = np.append(starts, len(voxels))
+
+        if len(roi_values):
+            coords  = np.stack(np.unravel_index(voxels, data.shape), axis=1)
+            centers = np.add.reduceat(coords, starts, axis=0) / sizes[:, np.newaxis].astype(np.float64)
+            bboxes  = np.stack([np.minimum.reduceat(coords, starts, axis=0),
+                                np.maximum.reduceat(coords, starts, axis=0) + 1], axis=2)
+        else:
+            centers = np.zeros((0, 3))
+            bboxes  = np.zeros((0, 3, 2), dtype=int)
+
+        source = None
+        if isinstance(atlas_img, string_types):
+            stat   = os.stat(atlas_img)
+            source = (op.abspath(atlas_img), stat.st_size, stat.st_mtime_ns)
+
+        index_dtype = np.int32 if data.size < np.iinfo(np.int32).max else np.int64
+        return cls(roi_values, voxels.astype(index_dtype), offsets.astype(index_dtype), data.shape,
+                   img.get_affine(), bboxes, centers, source=source)
+
+    @classmethod
+    def load(cls, file_path):
+        """Return the AtlasIndex saved in `file_path`, see save."""
+        with np.load(file_path, allow_pickle=False) as npz:
+            source = None
+            if npz['source_path'].size:
+                source = (str(npz['source_path']), int(npz['source_stat'][0]), int(npz['source_stat'][1]))
+
+            return cls(npz['roi_values'], npz['voxels'], npz['offsets'], npz['shape'], npz['affine'],
+                       npz['bboxes'], npz['centers'], source=source)
+
+    def save(self, file_path):
+        """Save the index in the .npz file `file_path`.
+        It is written to a temporary file and then renamed."""
+        source_path, source_stat = '', np.zeros(2, dtype=np.int64)
+        if self.source is not None:
+            source_path, source_stat = self.source[0], np.array(self.source[1:], dtype=np.int64)
+
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=op.dirname(op.abspath(file_path)))
+        try:
+            with os.fdopen(fd, 'wb') as fileobj:
+                np.savez_compressed(fileobj, roi_values=self.roi_values, voxels=self.voxels, offsets=self.offsets,
+                                    shape=np.array(self.shape), affine=self.affine, bboxes=self.bboxes,
+                                    centers=self.centers, source_path=np.array(source_path),
+                                    source_stat=source_stat)
+            os.replace(tmp_path, file_path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def for_file(cls, atlas_file, index_file=None):
+        """Return the AtlasIndex of `atlas_file`, read from `index_file` if it is up to date,
+        otherwise computed and saved in `index_file`.
+
+        Parameters
+        ----------
+        atlas_file: str
+            Path to the atlas Nifti file.
+
+        index_file: str
+            Path to the index file. If None, `atlas_file` + ATLAS_INDEX_EXT.
+
+        Returns
+        -------
+        atlas_index: AtlasIndex
+        """
+        if index_file is None:
+            index_file = atlas_file + ATLAS_INDEX_EXT
+
+        if op.exists(index_file):
+            try:
+                atlas_index = cls.load(index_file)
+            except Exception as exc:
+                log.warning('Error reading the atlas index {}: {}'.format(index_file, exc))
+            else:
+                if atlas_index.is_fresh(atlas_file):
+                    return atlas_index
+
+        atlas_index = cls.from_img(atlas_file)
+        try:
+            atlas_index.save(index_file)
+        except OSError as exc:
+            log.warning('Could not save the atlas index {}: {}'.format(index_file, exc))
+
+        return atlas_index
+
+    def is_fresh(self, atlas_file):
+        """Return True if this index was computed from `atlas_file` as it is now."""
+        if self.source is None:
+            return False
+
+        stat = os.stat(atlas_file)
+        return self.source == (op.abspath(atlas_file), stat.st_size, stat.st_mtime_ns)
+
+    @property
+    def n_rois(self):
+        return len(self.roi_values)
+
+    @property
+    def sizes(self):
+        """Number of voxels of each ROI."""
+        return np.diff(self.offsets)
+
+    @property
+    def header(self):
+        return None
+
+    def get_affine(self):
+        return self.affine
+
+    def get_filename(self):
+        return self.source[0] if self.source is not None else None
+
+    def get_data(self):
+        """Return the atlas volume, rebuilt from the index."""
+        if self._volume is None:
+            volume = np.zeros(self.shape, dtype=self.roi_values.dtype)
+            volume.flat[self.voxels] = np.repeat(self.roi_values, self.sizes)
+            self._volume = volume
+        return self._volume
+
+    def uncache(self):
+        self._volume = None
+
+    def get_roi_voxels(self, roi_value):
+        """Return the flat indices of the voxels of the ROI `roi_value`, empty if it is not in the atlas."""
+        idx = int(np.searchsorted(self.roi_values, roi_value))
+        if idx >= self.n_rois or self.roi_values[idx] != roi_value:
+            return self.voxels[:0]
+        return self.voxels[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def get_rois_indices(self, roi_values, maskvol=None):
+        """Return the indices of the voxels of each ROI in `roi_values`, see _get_rois_indices."""
+        mask_flat = None if maskvol is None else np.asarray(maskvol).ravel() > 0
+
+        rois_indices = []
+        for roi_value in roi_values:
+            voxels = self.get_roi_voxels(roi_value)
+            if mask_flat is not None:
+                voxels = voxels[mask_flat[voxels]]
+            rois_indices.append(np.unravel_index(voxels, self.shape))
+
+        return rois_indices
+
+    def __repr__(self):
+        return '<AtlasIndex {} ROIs shape={} source={}>'.format(self.n_rois, self.shape, self.get_filename())
+
+
 def get_3D_from_4D(image, vol_idx=0):
     """Pick one 3D volume from a 4D nifti image file
 
@@ -499,6 +1226,8 @@ def get_3D_from_4D(image, vol_idx=0):
 
     vol_idx: int
         Index of the 3D volume to be extracted from the 4D volume.
+        For .nii.gz files, only the part of the file up to the volume is inflated,
+        or only the volume itself if indexed_gzip is installed, see get_img_volumes.
 
     Returns
     -------
@@ -515,8 +1244,8 @@ def get_3D_from_4D(image, vol_idx=0):
         raise IndexError('IndexError: 4th dimension in volume {} has {} volumes, '
                          'not {}.'.format(repr_imgs(img), img.shape[3], vol_idx))
 
-    img_data = img.get_data()
-    new_vol  = img_data[:, :, :, vol_idx].copy()
+    # read only the requested volume, see get_img_volumes
+    new_vol = np.array(get_img_volumes(image, vol_idx, vol_idx + 1)[:, :, :, 0])
 
     hdr.set_data_shape(hdr.get_data_shape()[:3])
 
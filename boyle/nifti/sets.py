@@ -12,45 +12,406 @@ A class to manage sets of neuroimage files.
 
 import os
 import logging
+import hashlib
 import numpy                         as np
+from   functools                     import partial
+from   multiprocessing               import Pool
 from   six                           import string_types
 
-from   .read              import load_nipy_img, get_img_data, repr_imgs
-from   .mask              import load_mask
-from   .check             import check_img_compatibility
-from   ..files.names      import get_abspath
+from   .read              import (load_nipy_img, get_img_data, get_img_data_box, repr_imgs,
+                                  ImagePrefetcher, get_img_sources)
+from   .mask              import load_mask, get_bounding_box, CompactMask
+from   .check             import check_img_compatibility, check_img
+from   .smooth            import (_smooth_data_array, get_smoothing_box, SmoothingBuffer,
+                                 get_smoothing_cache, set_smoothing_cache)
+from   .header_index      import HeaderIndex
+from   ..files.names      import get_abspath, get_extension
+from   ..image.base       import MedicalImage
+from   ..image.utils      import _check_medimg
 from   ..more_collections import ItemSet
+from   ..utils.cache_mixin import CacheMixin
+from   ..utils.quantize    import quantize_array, QuantizedArray
 from   ..storage          import ExportData
-from   ..exceptions       import FileNotFound
+from   ..exceptions       import FileNotFound, NiftiFilesNotCompatible
+from   ..parallel         import (get_n_jobs, create_shared_memmap,
+                                  open_shared_memmap, remove_shared_memmap)
 
 log = logging.getLogger(__name__)
 
+# state of the to_matrix worker processes, set by _init_matrix_worker
+_worker = {}
 
-class NeuroImageSet(ItemSet):
+
+def _get_img_source(image):
+    """Return the file path of `image` if it has one, the image otherwise.
+    This is what is sent to the worker processes, to avoid pickling the image data."""
+    if isinstance(image, string_types):
+        return image
+
+    for img in (image, getattr(image, 'img', None)):
+        if hasattr(img, 'get_filename') and img.get_filename() is not None:
+            return img.get_filename()
+
+    return getattr(image, 'img', image)
+
+
+def _get_img_key(image):
+    """Return the key of the row of `image` in the data matrix:
+    its absolute file path if it has one, its object id otherwise."""
+    source = _get_img_source(image)
+    if isinstance(source, string_types):
+        return os.path.abspath(source)
+    return id(image)
+
+
+def _get_file_stat(file_path):
+    """Return the absolute path, size and modification time of the file in `file_path`."""
+    file_path = os.path.abspath(file_path)
+    stat      = os.stat(file_path)
+    return file_path, stat.st_size, stat.st_mtime_ns
+
+
+def _get_file_fingerprint(file_path):
+    """Return a cheap fingerprint of the image file in `file_path`:
+    its absolute path, size, modification time and a hash of its header."""
+    file_path, size, mtime_ns = _get_file_stat(file_path)
+    hdr_hash  = hashlib.sha1(check_img(file_path, use_cache=False).header.binaryblock).hexdigest()
+    return file_path, size, mtime_ns, hdr_hash
+
+
+def _get_row_key(image):
+    """Return the key of the row of `image` in the last data matrix built by NeuroImageSet.to_matrix:
+    the absolute path, size and modification time of its file if it has one, so a rewritten file
+    is read again, the image itself otherwise, so it is not garbage-collected while its row can be reused."""
+    source = _get_img_source(image)
+    if isinstance(source, string_types):
+        return _get_file_stat(source)
+    return image
+
+
+def _get_mask_key(mask):
+    """Return the cache key of a mask image: the fingerprint of its file if it has one,
+    a hash of its data otherwise. None if `mask` is None."""
+    if mask is None:
+        return None
+
+    source = _get_img_source(mask)
+    if isinstance(source, string_types):
+        return _get_file_fingerprint(source)
+
+    mask_data = np.ascontiguousarray(get_img_data(mask))
+    return mask_data.shape, hashlib.sha1(mask_data.view(np.uint8)).hexdigest()
+
+
+def _get_subject_row(get_row, fingerprint, mask_key, smooth_fwhm, outdtype):
+    """Return the data matrix row returned by `get_row()` as an array of type `outdtype`.
+    `get_row` is ignored by the cache, the other arguments are the cache key of the row."""
+    return np.asarray(get_row(), dtype=outdtype)
+
+
+def _get_subjects_matrix(image_set, get_row, fingerprints, mask_key, smooth_fwhm, outdtype):
+    """Return the data matrix of `image_set`, where the row `i` is `get_row(i)`.
+    `image_set` and `get_row` are ignored by the cache, the other arguments are the cache key
+    of the matrix. The rows are also cached one by one if `image_set.memory_level` is 2 or higher.
+    """
+    get_subject_row = image_set._cache(_get_subject_row, func_memory_level=2, ignore=['get_row'])
+
+    outmat = None
+    for idx, fingerprint in enumerate(fingerprints):
+        row = get_subject_row(partial(get_row, idx), fingerprint, mask_key, smooth_fwhm, outdtype)
+        if outmat is None:
+            outmat = np.zeros((len(fingerprints), ) + row.shape, dtype=outdtype)
+        outmat[idx] = row
+
+    return outmat
+
+
+def _get_cached_matrix(image_set, get_row, file_paths, mask, smooth_fwhm, outdtype):
+    """Return the data matrix of `image_set` from the cache in `image_set.memory`,
+    building it with `get_row` if it is not there. See _get_subjects_matrix.
+    Return None if not all the subjects are files, because the cache keys are built from file fingerprints.
+    """
+    if any(not isinstance(file_path, string_types) for file_path in file_paths):
+        return None
+
+    fingerprints = [_get_file_fingerprint(file_path) for file_path in file_paths]
+    get_matrix   = image_set._cache(_get_subjects_matrix, func_memory_level=1, ignore=['image_set', 'get_row'])
+    return get_matrix(image_set, get_row, fingerprints, _get_mask_key(mask), smooth_fwhm, np.dtype(outdtype).str)
+
+
+# quantization mode -> axis of the matrix along which the scale factors change
+_QUANTIZE_AXES = {'subject': 0,
+                  'voxel':   1, }
+
+
+def _get_quantize_dtype(quantize, outdtype=None):
+    """Return the integer type for the quantized data matrix, int16 if `outdtype` is None.
+
+    Raises
+    ------
+    ValueError
+        If `quantize` is not a valid mode or `outdtype` is not an integer type.
+    """
+    if quantize not in _QUANTIZE_AXES:
+        raise ValueError('Expected `quantize` to be one of ({}), got {}.'.format(set(_QUANTIZE_AXES.keys()),
+                                                                                quantize))
+
+    dtype = np.dtype(outdtype or np.int16)
+    if dtype.kind not in 'iu':
+        raise ValueError('Expected an integer `outdtype` for a quantized matrix, got {}.'.format(dtype))
+
+    return dtype
+
+
+def _iter_quantized_rows(rows, dtype, variables):
+    """Yield each row in `rows` quantized into `dtype` with its own scale factors.
+    Once all the rows have been yielded, the scale factors are set in the `variables` dict,
+    as 'scl_slope' and 'scl_inter'."""
+    slopes, inters = [], []
+    for row in rows:
+        qrow, slope, inter = quantize_array(row, dtype)
+        slopes.append(slope)
+        inters.append(inter)
+        yield qrow
+
+    variables['scl_slope'] = np.array(slopes)
+    variables['scl_inter'] = np.array(inters)
+
+
+def _quantize_rows(rows, n_rows, row_shape, dtype):
+    """Return a QuantizedArray with the rows in `rows`, each one quantized with its own scale factors."""
+    row_shape = tuple(row_shape)
+    data      = np.zeros((n_rows, ) + row_shape, dtype=dtype)
+    slopes    = np.ones ((n_rows, ) + (1, ) * len(row_shape))
+    inters    = np.zeros((n_rows, ) + (1, ) * len(row_shape))
+    for i, row in enumerate(rows):
+        _, slopes[i], inters[i] = quantize_array(row, dtype, out=data[i])
+
+    return QuantizedArray(data, slopes, inters)
+
+
+def _quantize_voxels(get_rows, n_rows, row_shape, dtype):
+    """Return a QuantizedArray with the rows in `get_rows()`, with one slope and intercept for each voxel,
+    i.e., for each index of the first axis of the rows.
+    `get_rows` is called twice, to get the range of each voxel and to quantize the rows, so the
+    float matrix is not built."""
+    row_shape   = tuple(row_shape)
+    reduce_axes = tuple(range(1, len(row_shape)))
+    vmin = np.full((row_shape[0], ) + (1, ) * len(reduce_axes),  np.inf)
+    vmax = np.full((row_shape[0], ) + (1, ) * len(reduce_axes), -np.inf)
+    for row in get_rows():
+        # fmin and fmax ignore the NaNs
+        np.fmin(vmin, np.fmin.reduce(row, axis=reduce_axes, keepdims=True), out=vmin)
+        np.fmax(vmax, np.fmax.reduce(row, axis=reduce_axes, keepdims=True), out=vmax)
+
+    vmin[~np.isfinite(vmin)] = 0
+    vmax[~np.isfinite(vmax)] = 0
+
+    data  = np.zeros((n_rows, ) + row_shape, dtype=dtype)
+    slope = inter = None
+    for i, row in enumerate(get_rows()):
+        _, slope, inter = quantize_array(row, dtype, vmin=vmin, vmax=vmax, out=data[i])
+
+    if slope is None:
+        _, slope, inter = quantize_array(vmin, dtype, vmin=vmin, vmax=vmax)
+
+    return QuantizedArray(data, slope[np.newaxis], inter[np.newaxis])
+
+
+def _flatten_img(image, mask_data=None, smooth_fwhm=0, mask_box=None, buffer=None):
+    """Return the smoothed, masked and flattened data of `image`.
+    This is the same as what `MedicalImage.mask_and_flatten` returns.
+
+    Parameters
+    ----------
+    image: str or img-like object.
+
+    mask_data: numpy.ndarray
+        3D boolean mask array. If None, the whole volume will be flattened.
+
+    smooth_fwhm: int
+        Size of the FWHM Gaussian smoothing kernel.
+
+    mask_box: tuple of slices
+        Bounding box of `mask_data`, see boyle.nifti.mask.get_bounding_box.
+        If given and there is no smoothing, only this box will be read from the file.
+
+    buffer: boyle.nifti.smooth.SmoothingBuffer
+        Array reused to smooth the images, to avoid allocating one for each image.
+        Only used when there is smoothing and `mask_data`.
+
+    Returns
+    -------
+    flat_data: numpy.ndarray
+        A vector for 3D images, a (n_voxels, n_vols) matrix for 4D images.
+        If the smoothing cache is enabled (see boyle.nifti.smooth.set_smoothing_cache) and `image`
+        is a file path, its smoothed data is read from the cache.
+    """
+    cache = get_smoothing_cache()
+    if smooth_fwhm > 0 and cache is not None and cache.is_cacheable(image):
+        # the whole volume is smoothed and cached, its values in the mask are the same
+        image, smooth_fwhm = cache.smooth(image, smooth_fwhm), 0
+        if mask_data is not None and mask_box is None:
+            mask_box = get_bounding_box(mask_data)
+
+    if mask_box is not None and mask_data is not None and smooth_fwhm <= 0:
+        return get_img_data_box(image, mask_box)[mask_data[mask_box]]
+
+    img = check_img(image)
+    if mask_data is not None and smooth_fwhm > 0:
+        # read and smooth only the part of the volume that affects the voxels in the mask
+        box  = get_smoothing_box(mask_data, img.get_affine(), smooth_fwhm)
+        data = _smooth_data_array(get_img_data_box(img, box), img.get_affine(), smooth_fwhm,
+                                  copy=buffer is not None, buffer=buffer)
+        return data[mask_data[box]]
+
+    data = get_img_data(img)
+    if smooth_fwhm > 0:
+        data = _smooth_data_array(data, img.get_affine(), smooth_fwhm, copy=False)
+
+    if mask_data is not None:
+        return data[mask_data]
+
+    return data.reshape((-1, ) + data.shape[3:])
+
+
+def _init_matrix_worker(outmat_file, outmat_shape, outdtype, mask_data, smooth_fwhm, smoothing_cache=None):
+    """Open the shared output matrix once for each worker process."""
+    if smoothing_cache is not None:
+        set_smoothing_cache(smoothing_cache.cache_dir, max_size=smoothing_cache.max_size)
+
+    _worker['outmat']      = open_shared_memmap(outmat_file, outmat_shape, outdtype)
+    _worker['mask_data']   = mask_data
+    _worker['mask_box']    = get_bounding_box(mask_data) if mask_data is not None else None
+    _worker['smooth_fwhm'] = smooth_fwhm
+    _worker['buffer']      = SmoothingBuffer()
+
+
+def _fill_matrix_row(args):
+    """Write the flattened data of the image into its row of the shared output matrix."""
+    row_idx, image = args
+    try:
+        _worker['outmat'][row_idx] = _flatten_img(image, _worker['mask_data'], _worker['smooth_fwhm'],
+                                                  mask_box=_worker['mask_box'], buffer=_worker['buffer'])
+    except Exception as exc:
+        raise Exception('Error flattening file {0}'.format(repr_imgs(image))) from exc
+
+
+def _get_mask_runs(mask_data):
+    """Return the runs of the non-zero voxels of the mask volume `mask_data`, as saved in the output files,
+    None if there is no mask. See boyle.nifti.mask.CompactMask.from_runs."""
+    if mask_data is None:
+        return None
+    return CompactMask.from_array(mask_data).runs
+
+
+class _IndexedImage(MedicalImage):
+    """A MedicalImage of a file checked with a HeaderIndex.
+    Its shape, data type and affine matrix are the ones in the index, the file is opened
+    only when its image object is needed, e.g., to read its data or full header.
+
+    Parameters
+    ----------
+    header: dict
+        The header information of the file, see boyle.nifti.header_index.HeaderIndex.get_headers.
+    """
+    def __init__(self, header):
+        self._img     = None
+        self._info    = header
+        self._caching = 'fill'
+        self.mask     = None
+        self.zeroe()
+
+    @property
+    def img(self):
+        if self._img is None:
+            self._img = _check_medimg(self._info['path'], make_it_3d=False)
+        return self._img
+
+    @img.setter
+    def img(self, image):
+        self._img = image
+
+    def has_data_loaded(self):
+        return self._img is not None and self._img.in_memory
+
+    def clear_data(self):
+        if self._img is not None:
+            self._img.uncache()
+
+    @property
+    def shape(self):
+        return self._info['shape']
+
+    @property
+    def dtype(self):
+        return self._info['dtype']
+
+    @property
+    def affine(self):
+        return self._info['affine']
+
+    def get_filename(self):
+        return self._info['path']
+
+    def __repr__(self):
+        return '<MedicalImage> ' + self._info['path']
+
+
+def _get_header_index(header_index):
+    """Return a HeaderIndex from a HeaderIndex or the path to its database, None if None."""
+    if header_index is None or isinstance(header_index, HeaderIndex):
+        return header_index
+    return HeaderIndex(header_index)
+
+
+class NeuroImageSet(ItemSet, CacheMixin):
     """A set of NeuroImage samples where each subject is represented by a 3D Nifti file path.
 
-    Each subject image is a boyle.nifti.neuroimage.Neuroimage.
+    Each subject image is a boyle.image.base.MedicalImage.
 
     Parameters
     ----------
-    images: list of str or img-like object.
-        See NeuroImage constructor docstring.
+    images: list of str or img-like object or boyle.nifti.read.ImagePrefetcher
+        See boyle.image.base.MedicalImage constructor docstring.
+        If an ImagePrefetcher is given, its settings will be used to read the subject
+        files in background threads when building the data matrix.
 
     mask: str or img-like object.
-        See NeuroImage constructor docstring.
+        See boyle.image.base.MedicalImage constructor docstring.
 
     labels: list or tuple of str or int or float.
         This list shoule have the same length as images.
 
     all_compatible: bool
         True if all the subject files must have the same shape and affine.
+
+    header_index: boyle.nifti.header_index.HeaderIndex or str
+        Index of header information, or the path to its database file.
+        If given and all the images are file paths, their compatibility is checked
+        with the headers in the index, reading only the files not indexed yet.
+
+    memory: joblib.Memory or str
+        Cache for the data matrices built by to_matrix, or the path to its directory.
+        The cache keys are the size, modification time and header of the subject and mask files,
+        so an unchanged set of files is read from the cache. Only used if all images are files.
+
+    memory_level: int
+        1 to cache the whole matrices, 2 or higher to also cache the row of each subject,
+        so a matrix of a set which shares subjects with a cached one reads these rows from the cache.
     """
-    def __init__(self, images, mask=None, labels=None, all_compatible=True):
+    def __init__(self, images, mask=None, labels=None, all_compatible=True, header_index=None,
+                 memory=None, memory_level=1):
         self.items  = []
         self.labels = []
         self.others = {}
+        self.memory = memory
+        self.memory_level = memory_level
+        self._prefetcher  = None
+        self._last_matrix = None
         self._mask  = load_mask(mask) if mask is not None else None
         self.all_compatible = all_compatible
+        self.header_index   = _get_header_index(header_index)
         try:
             self._load_images_and_labels(images, list(labels))
         except Exception as exc:
@@ -75,7 +436,7 @@ class NeuroImageSet(ItemSet):
         Parameters
         ----------
         image: str or img-like object.
-            See NeuroImage constructor docstring.
+            See boyle.image.base.MedicalImage constructor docstring.
         """
         if image is None:
             self._mask = None
@@ -96,16 +457,17 @@ class NeuroImageSet(ItemSet):
     def clear_caches(self):
         for img in self.items:
             img.clear_data()
+        self._last_matrix = None
 
     def check_compatibility(self, one_img, another_img=None):
         """
         Parameters
         ----------
         one_img: str or img-like object.
-            See NeuroImage constructor docstring.
+            See boyle.image.base.MedicalImage constructor docstring.
 
         anoter_img: str or img-like object.
-            See NeuroImage constructor docstring.
+            See boyle.image.base.MedicalImage constructor docstring.
             If None will use the first image of self.images, if there is any.
 
         Raises
@@ -131,11 +493,34 @@ class NeuroImageSet(ItemSet):
         except:
             raise
 
+    def _check_index_compatibility(self, file_paths):
+        """Check the compatibility of the files in `file_paths` as in check_compatibility,
+        using self.header_index.
+
+        Returns
+        -------
+        headers: list of dict
+            The header information of the files, see boyle.nifti.header_index.HeaderIndex.get_headers.
+
+        Raises
+        ------
+        NiftiFilesNotCompatible
+        """
+        headers = None
+        if self.all_compatible:
+            headers = self.header_index.check_compatibility(file_paths)
+        if self.mask is not None:
+            headers = self.header_index.check_compatibility(file_paths, ref_img=self.mask, only_check_3d=True)
+        if headers is None:
+            headers = self.header_index.get_headers(file_paths)
+        return headers
+
     def append_image(self, image, label=None):
 
         if self.labels and label is None:
             raise ValueError('Label for image {} should be given, but None given.'.format(repr_imgs(image)))
 
+        image = MedicalImage(image)
         if self.all_compatible:
             try:
                 self.check_compatibility(image)
@@ -146,6 +531,23 @@ class NeuroImageSet(ItemSet):
         if label is not None:
             self.labels.append(label)
 
+    def remove_image(self, idx):
+        """Remove the image in the position `idx` of this set, and its label.
+
+        Parameters
+        ----------
+        idx: int
+
+        Returns
+        -------
+        image
+            The removed image.
+        """
+        image = self.items.pop(idx)
+        if isinstance(self.labels, list) and len(self.labels) > idx:
+            self.labels.pop(idx)
+        return image
+
     def set_labels(self, labels):
         """
         Parameters
@@ -166,6 +568,10 @@ class NeuroImageSet(ItemSet):
 
     def _load_images_and_labels(self, images, labels=None):
         """Read the images, load them into self.items and set the labels."""
+        if isinstance(images, ImagePrefetcher):
+            self._prefetcher = images
+            images = get_img_sources(images)
+
         if not isinstance(images, (list, tuple)):
             raise ValueError('Expected an iterable (list or tuple) of strings or img-like objects. '
                              'Got a {}.'.format(type(images)))
@@ -178,15 +584,23 @@ class NeuroImageSet(ItemSet):
             raise ValueError('Expected the same length for image set ({}) and '
                              'labels list ({}).'.format(len(images), len(labels)))
 
+        if self.header_index is not None and all(isinstance(image, string_types) for image in images):
+            # check all the headers at once, then there is no need to compare the images one by one
+            # the files are opened only when their data is read
+            headers = self._check_index_compatibility(images)
+            self.items.extend(_IndexedImage(header) for header in headers)
+            self.set_labels(labels)
+            return
+
         first_file = images[0]
         if first_file:
-            first_img = NeuroImage(first_file)
+            first_img = MedicalImage(first_file)
         else:
             raise('Error reading image {}.'.format(repr_imgs(first_file)))
 
         for idx, image in enumerate(images):
             try:
-                img = NeuroImage(image)
+                img = MedicalImage(image)
                 self.check_compatibility(img, first_img)
             except:
                 log.exception('Error reading image {}.'.format(repr_imgs(image)))
@@ -196,7 +610,7 @@ class NeuroImageSet(ItemSet):
 
         self.set_labels(labels)
 
-    def to_matrix(self, smooth_fwhm=0, outdtype=None):
+    def to_matrix(self, smooth_fwhm=0, outdtype=None, n_jobs=1, quantize=None):
         """Return numpy.ndarray with the masked or flatten image data and
            the relevant information (mask indices and volume shape).
 
@@ -210,16 +624,120 @@ class NeuroImageSet(ItemSet):
             Type of the elements of the array, if None will obtain the dtype from
             the first nifti file.
 
+        n_jobs: int
+            Number of worker processes to read the subject files.
+            Each worker writes its rows directly into a memory-mapped output
+            matrix, so the results are not sent back to this process.
+            If -1, all the CPUs will be used. If 1 (default), no worker process is used.
+
+        quantize: str
+            If not None, the matrix will be stored in the integer type `outdtype` (int16 by default)
+            with linear scale factors, as the Nifti scl_slope and scl_inter fields.
+            'subject': one slope and intercept for each subject. The rows are quantized as they are read.
+            'voxel': one slope and intercept for each voxel. The files are read twice, first for the
+                     range of each voxel, so the float matrix is not built.
+
         Returns
         -------
         outmat, mask_indices, vol_shape
 
         outmat: Numpy array with shape N x prod(vol.shape)
                 containing the N files as flat vectors.
+                A boyle.utils.quantize.QuantizedArray if `quantize` is given.
 
         mask_indices: matrix with indices of the voxels in the mask
 
         vol_shape: Tuple with shape of the volumes, for reshaping.
+
+        Notes
+        -----
+        The set keeps a copy of the last returned matrix. If this function is called again
+        with the same `smooth_fwhm`, `outdtype` and mask, after appending or removing images,
+        the rows of the subjects in the last matrix are copied from it and only the new subjects
+        and the files modified since then are read. Call clear_caches to drop it.
+        """
+        if quantize is not None:
+            return self._to_quantized_matrix(smooth_fwhm, outdtype, quantize)
+
+        outdtype, mask, mask_shape, subj_flat_shape = self._get_matrix_info(outdtype)
+        row_keys = [_get_row_key(image) for image in self.items]
+
+        # create and fill the big matrix
+        n_jobs = get_n_jobs(n_jobs)
+        outmat = self._update_last_matrix(row_keys, smooth_fwhm, outdtype, subj_flat_shape)
+        if outmat is None and self.memory is not None:
+            outmat = _get_cached_matrix(self, partial(self._get_flat_row, smooth_fwhm=smooth_fwhm),
+                                        [_get_img_source(image) for image in self.items],
+                                        self.mask, smooth_fwhm, outdtype)
+
+        if outmat is None and n_jobs > 1:
+            mask_data = self.mask.get_data() if self.has_mask else None
+            outmat    = self._fill_matrix_parallel((self.n_subjs, ) + subj_flat_shape, outdtype,
+                                                   mask_data, smooth_fwhm, n_jobs)
+        elif outmat is None:
+            outmat = np.zeros((self.n_subjs, ) + subj_flat_shape, dtype=outdtype)
+            for i, flat_data in enumerate(self._iter_flat_rows(smooth_fwhm)):
+                outmat[i, :] = flat_data
+
+        # a copy, the caller may modify the returned matrix
+        self._last_matrix = {'outmat':      np.array(outmat),
+                             'row_keys':    row_keys,
+                             'smooth_fwhm': smooth_fwhm,
+                             'outdtype':    np.dtype(outdtype),
+                             'mask':        self.mask, }
+
+        return outmat, mask.indices if mask is not None else None, mask_shape
+
+    def _to_quantized_matrix(self, smooth_fwhm, outdtype, quantize):
+        """Return the quantized data matrix, see to_matrix."""
+        qdtype = _get_quantize_dtype(quantize, outdtype)
+        _, mask, mask_shape, subj_flat_shape = self._get_matrix_info(qdtype)
+        if quantize == 'voxel':
+            outmat = _quantize_voxels(partial(self._iter_flat_rows, smooth_fwhm), self.n_subjs,
+                                      subj_flat_shape, qdtype)
+        else:
+            outmat = _quantize_rows(self._iter_flat_rows(smooth_fwhm), self.n_subjs, subj_flat_shape, qdtype)
+        return outmat, mask.indices if mask is not None else None, mask_shape
+
+    def _update_last_matrix(self, row_keys, smooth_fwhm, outdtype, subj_flat_shape):
+        """Return a new data matrix with the rows of `row_keys` copied from the last matrix
+        built by to_matrix and the rows of the new subjects and modified files read from their files.
+        Return None if there is no last matrix built with the same parameters.
+        """
+        last = self._last_matrix
+        if last is None or last['smooth_fwhm'] != smooth_fwhm or last['outdtype'] != np.dtype(outdtype) or \
+           last['mask'] is not self.mask or last['outmat'].shape[1:] != subj_flat_shape:
+            return None
+
+        old_rows = {key: idx for idx, key in enumerate(last['row_keys'])}
+        old_idx  = [old_rows.get(key, -1) for key in row_keys]
+        new_rows = self._iter_flat_rows(smooth_fwhm, items=[image for image, old in zip(self.items, old_idx)
+                                                            if old < 0])
+
+        log.debug('Reusing {} rows of the last data matrix.'.format(sum(old >= 0 for old in old_idx)))
+
+        outmat = np.zeros((len(row_keys), ) + subj_flat_shape, dtype=outdtype)
+        for i, old in enumerate(old_idx):
+            outmat[i, :] = last['outmat'][old] if old >= 0 else next(new_rows)
+
+        return outmat
+
+    def _get_matrix_info(self, outdtype=None):
+        """Return the information needed to build the data matrix of this set.
+
+        Parameters
+        ----------
+        outdtype: dtype
+            Type of the elements of the array, if None will obtain the dtype from
+            the first nifti file.
+
+        Returns
+        -------
+        outdtype, mask, mask_shape, subj_flat_shape
+
+        mask: boyle.nifti.mask.CompactMask with the voxels of the mask, None if there is no mask.
+
+        subj_flat_shape: Tuple with the shape of one flattened subject, i.e., one row of the matrix.
         """
         if not self.all_compatible:
             raise ValueError("`self.all_compatible` must be True in order to use this function.")
@@ -228,20 +746,18 @@ class NeuroImageSet(ItemSet):
             outdtype = self.items[0].dtype
 
         # extract some info from the mask
-        n_voxels     = None
-        mask_indices = None
-        mask_shape   = self.items[0].shape[:3]
+        n_voxels   = None
+        mask       = None
+        mask_shape = self.items[0].shape[:3]
         if self.has_mask:
-            mask_arr     = self.mask.get_data()
-            mask_indices = np.nonzero(mask_arr)
-            mask_shape   = self.mask.shape
-            n_voxels     = np.count_nonzero(mask_arr)
+            mask       = CompactMask.from_array(self.mask.get_data())
+            mask_shape = self.mask.shape
+            n_voxels   = mask.n_voxels
 
         # if the mask is empty will use the whole image
         if n_voxels is None:
             log.debug('Non-zero voxels have not been found in mask {}'.format(self.mask))
-            n_voxels     = np.prod(mask_shape)
-            mask_indices = None
+            n_voxels = np.prod(mask_shape)
 
         # get the shape of the flattened subject data
         ndims = self.items[0].ndim
@@ -253,33 +769,83 @@ class NeuroImageSet(ItemSet):
             raise NotImplementedError('The subject images have {} dimensions. '
                                       'Still have not implemented t_matrix for this shape.'.format(ndims))
 
-        # create and fill the big matrix
-        outmat = np.zeros((self.n_subjs, ) + subj_flat_shape, dtype=outdtype)
-        try:
-            for i, image in enumerate(self.items):
-                if smooth_fwhm > 0:
-                    image.fwhm = smooth_fwhm
+        return outdtype, mask, mask_shape, subj_flat_shape
+
+    def _get_flat_row(self, idx, smooth_fwhm=0):
+        """Return the smoothed, masked and flattened data of the subject `idx`."""
+        return next(self._iter_flat_rows(smooth_fwhm, items=[self.items[idx]]))
+
+    def _iter_flat_rows(self, smooth_fwhm=0, items=None):
+        """Yield the smoothed, masked and flattened data of each subject, one at a time.
+        The rows are the same as the ones of the worker processes, see _fill_matrix_row.
+
+        Parameters
+        ----------
+        smooth_fwhm: int
+            Integer indicating the size of the FWHM Gaussian smoothing kernel
+            to smooth the subject volumes.
+
+        items: list
+            The subject images to read. If None, will use self.items.
+        """
+        if items is None:
+            items = self.items
 
-                if self.has_mask:
-                    image.set_mask(self.mask)
+        # without smoothing, only the bounding box of the mask is read from the files
+        mask_data, mask_box = None, None
+        if self.has_mask:
+            mask_data = self.mask.get_data()
+            mask_box  = get_bounding_box(mask_data)
 
-                outmat[i, :], _, _ = image.mask_and_flatten()
-                image.clear_data()
+        # the smoothed images in the smoothing cache are read from their file paths
+        sources = [_get_img_source(image) for image in items]
+        if self._prefetcher is not None and (smooth_fwhm <= 0 or get_smoothing_cache() is None):
+            sources = self._prefetcher.with_images(sources)
 
+        buffer = SmoothingBuffer()
+        try:
+            for image in sources:
+                yield _flatten_img(image, mask_data, smooth_fwhm, mask_box=mask_box, buffer=buffer)
         except Exception as exc:
-            raise Exception('Error flattening file {0}'.format(image)) from exc
-        else:
-            return outmat, mask_indices, mask_shape
+            raise Exception('Error flattening file {0}'.format(repr_imgs(image))) from exc
+
+    def _fill_matrix_parallel(self, outmat_shape, outdtype, mask_data, smooth_fwhm, n_jobs):
+        """Create the output matrix as a temporary memmap and fill it with `n_jobs` processes.
+
+        Returns
+        -------
+        outmat: numpy.memmap
+            The file backing the memmap is removed before returning, the data stays valid
+            while outmat is referenced.
+        """
+        outmat, outmat_file = create_shared_memmap(outmat_shape, outdtype)
+        try:
+            pool = Pool(processes=n_jobs,
+                        initializer=_init_matrix_worker,
+                        initargs=(outmat_file, outmat_shape, outdtype, mask_data, smooth_fwhm,
+                                  get_smoothing_cache()))
+            try:
+                pool.map(_fill_matrix_row, enumerate(_get_img_source(img) for img in self.items))
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            remove_shared_memmap(outmat_file)
+
+        return outmat
 
-    def to_file(self, output_file, smooth_fwhm=0, outdtype=None):
+    def to_file(self, output_file, smooth_fwhm=0, outdtype=None, n_jobs=1, stream=False, update=False,
+                quantize=None):
         """Save the Numpy array created from to_matrix function to the output_file.
 
-        Will save into the file: outmat, mask_indices, vol_shape and self.others (put here whatever you want)
+        Will save into the file: outmat, mask_runs, vol_shape and self.others (put here whatever you want)
+        If all the subjects are files, will also save their paths in 'row_keys' and `smooth_fwhm`.
 
             data: Numpy array with shape N x prod(vol.shape)
                   containing the N files as flat vectors.
 
-            mask_indices: matrix with indices of the voxels in the mask
+            mask_runs: (n_runs, 2) matrix with the first and last + 1 flat indices of the runs of voxels
+                       in the mask, see boyle.nifti.mask.CompactMask.from_runs
 
             vol_shape: Tuple with shape of the volumes, for reshaping.
 
@@ -298,47 +864,151 @@ class NeuroImageSet(ItemSet):
         outdtype: dtype
             Type of the elements of the array, if None will obtain the dtype from
             the first nifti file.
+
+        n_jobs: int
+            Number of worker processes. See `to_matrix`.
+
+        stream: bool
+            If True, each subject row will be written into a chunked and resizable dataset
+            in `output_file` as soon as it is read, instead of building the whole matrix
+            in memory first. Only for HDF5 output files, `n_jobs` is not used in this case.
+
+        update: bool
+            If True and `output_file` is an HDF5 file previously written by this function
+            with the same `smooth_fwhm`, `outdtype` and mask, the rows of the subjects already
+            in the file are kept and only the new subjects are read and written.
+            Otherwise the file is written from scratch. Not used with `quantize`.
+
+        quantize: str
+            If not None, 'data' will be stored quantized, with its scale factors in 'scl_slope' and
+            'scl_inter', so data ~= data * scl_slope + scl_inter. See `to_matrix`.
+            Only 'subject' can be used with `stream`.
         """
-        outmat, mask_indices, mask_shape = self.to_matrix(smooth_fwhm, outdtype)
+        if quantize is not None:
+            outdtype = _get_quantize_dtype(quantize, outdtype)
+            if stream and quantize != 'subject':
+                raise ValueError("Only the 'subject' quantization can be used with `stream`, "
+                                 "got {}.".format(quantize))
+
+        outdtype, mask, mask_shape, subj_flat_shape = self._get_matrix_info(outdtype)
+        row_keys = [_get_img_key(image) for image in self.items]
 
         exporter = ExportData()
-        content = {'data':         outmat,
-                   'labels':       self.labels,
-                   'mask_indices': mask_indices,
+        content = {'labels':       np.asarray(self.labels),
+                   'mask_runs':    mask.runs if mask is not None else None,
                    'mask_shape':   mask_shape, }
 
+        if all(isinstance(key, string_types) for key in row_keys):
+            content['row_keys']    = np.array(row_keys)
+            content['smooth_fwhm'] = smooth_fwhm
+
         if self.others:
             content.update(self.others)
 
+        if update and quantize is None and 'row_keys' in content and os.path.exists(output_file):
+            if self._update_file(output_file, content, subj_flat_shape, outdtype):
+                return
+
+        if not stream:
+            outmat, _, _ = self.to_matrix(smooth_fwhm, outdtype, n_jobs=n_jobs, quantize=quantize)
+            if quantize is not None:
+                content['scl_slope'] = outmat.slope
+                content['scl_inter'] = outmat.inter
+                outmat = outmat.data
+
         log.debug('Creating content in file {}.'.format(output_file))
         try:
-            exporter.save_variables(output_file, content)
+            if stream:
+                rows = self._iter_flat_rows(smooth_fwhm)
+                if quantize is not None:
+                    rows = _iter_quantized_rows(rows, outdtype, content)
+
+                exporter.save_rows(output_file, rows, subj_flat_shape, outdtype,
+                                   n_rows=self.n_subjs, variables=content)
+            else:
+                content['data'] = outmat
+                exporter.save_variables(output_file, content)
         except Exception as exc:
             raise Exception('Error saving variables to file {}.'.format(output_file)) from exc
 
+    def _update_file(self, output_file, content, subj_flat_shape, outdtype):
+        """Update the HDF5 `output_file` written by to_file to contain the subjects of this set,
+        reading only the subjects that are not in the file.
+
+        Returns
+        -------
+        updated: bool
+            False if `output_file` is not an HDF5 file or it has not been written with the same parameters.
+        """
+        ext = get_extension(output_file).lower()
+        if ext != '.hdf5' and ext != '.h5':
+            return False
+
+        from ..hdf5 import update_rows_in_hdf5, save_variables_to_hdf5
+
+        row_keys    = list(content['row_keys'])
+        smooth_fwhm = content['smooth_fwhm']
+        checks      = {'smooth_fwhm': smooth_fwhm}
+        if content['mask_runs'] is not None:
+            checks['mask_runs'] = content['mask_runs']
+
+        def get_rows(row_idx):
+            return self._iter_flat_rows(smooth_fwhm, items=[self.items[idx] for idx in row_idx])
+
+        try:
+            n_new_rows = update_rows_in_hdf5(output_file, row_keys, get_rows, subj_flat_shape, outdtype,
+                                             dsname='data', keys_dsname='row_keys', checks=checks)
+            if n_new_rows is None:
+                return False
+
+            log.debug('Updated file {} with {} new subjects.'.format(output_file, n_new_rows))
+            save_variables_to_hdf5(output_file, {vn: content[vn] for vn in content if vn != 'row_keys'},
+                                   mode='a', overwrite=True)
+        except Exception as exc:
+            raise Exception('Error updating variables in file {}.'.format(output_file)) from exc
+
+        return True
 
-class NiftiSubjectsSet(ItemSet):
+
+class NiftiSubjectsSet(ItemSet, CacheMixin):
     """A set of subjects where each subject is represented by a 3D Nifti file path.
 
     Each subject image is a nipy.image.
 
     Parameters
     ----------
-    subj_files: list or dict of str
+    subj_files: list or dict of str or boyle.nifti.read.ImagePrefetcher
         file_path -> int/str
+        If an ImagePrefetcher of file paths is given, its settings will be used to read the subject
+        files in background threads when building the data matrix.
 
     mask_file: str
 
     all_same_size: bool
         True if all the subject files must have the same shape
+
+    header_index: boyle.nifti.header_index.HeaderIndex or str
+        Index of header information, or the path to its database file.
+        If given, the shapes of the subject files are checked with the headers in the index.
+
+    memory: joblib.Memory or str
+        Cache for the data matrices built by to_matrix. See NeuroImageSet.
+
+    memory_level: int
+        See NeuroImageSet.
     """
 
-    def __init__(self, subj_files, mask_file=None, all_same_shape=True):
+    def __init__(self, subj_files, mask_file=None, all_same_shape=True, header_index=None,
+                 memory=None, memory_level=1):
         self.items          = []
         self.labels         = []
         self.all_same_shape = all_same_shape
         self.others         = {}
         self.mask_file      = mask_file
+        self.memory         = memory
+        self.memory_level   = memory_level
+        self.header_index   = _get_header_index(header_index)
+        self._prefetcher    = None
 
         self._init_subj_data(subj_files)
 
@@ -349,9 +1019,13 @@ class NiftiSubjectsSet(ItemSet):
         """
         Parameters
         ----------
-        subj_files: list or dict of str
+        subj_files: list or dict of str or boyle.nifti.read.ImagePrefetcher
             file_path -> int/str
         """
+        if isinstance(subj_files, ImagePrefetcher):
+            self._prefetcher = subj_files
+            subj_files = get_img_sources(subj_files)
+
         try:
             if isinstance(subj_files, list):
                 self.from_list(subj_files)
@@ -366,6 +1040,20 @@ class NiftiSubjectsSet(ItemSet):
     def _check_subj_shapes(self):
         """
         """
+        if self.header_index is not None:
+            file_paths = [img.file_path for img in self.items]
+            try:
+                self.header_index.check_compatibility(file_paths, check_affine=False)
+            except NiftiFilesNotCompatible as exc:
+                raise ValueError('Shape mismatch in the subject files.') from exc
+
+            if self.mask_file is not None:
+                try:
+                    self.header_index.check_compatibility(file_paths, ref_img=self.mask_file, check_affine=False)
+                except NiftiFilesNotCompatible as exc:
+                    raise ValueError('Shape mismatch in the subject files with mask {}.'.format(self.mask_file)) from exc
+            return
+
         shape      = self.items[0].shape
         mask_shape = self.get_mask_shape()
 
@@ -479,7 +1167,7 @@ class NiftiSubjectsSet(ItemSet):
 
         self.labels = subj_labels
 
-    def to_matrix(self, smooth_fwhm=0, outdtype=None):
+    def to_matrix(self, smooth_fwhm=0, outdtype=None, quantize=None):
         """Create a Numpy array with the data and return the relevant information (mask indices and volume shape).
 
         Parameters
@@ -492,18 +1180,62 @@ class NiftiSubjectsSet(ItemSet):
             Type of the elements of the array, if None will obtain the dtype from
             the first nifti file.
 
+        quantize: str
+            'subject' or 'voxel' to store the matrix quantized in the integer type `outdtype`.
+            See NeuroImageSet.to_matrix.
+
         Returns
         -------
         outmat, mask_indices, vol_shape
 
         outmat: Numpy array with shape N x prod(vol.shape)
                 containing the N files as flat vectors.
+                A boyle.utils.quantize.QuantizedArray if `quantize` is given.
 
         mask_indices: matrix with indices of the voxels in the mask
 
         vol_shape: Tuple with shape of the volumes, for reshaping.
         """
+        if quantize is not None:
+            qdtype = _get_quantize_dtype(quantize, outdtype)
+            _, mask_indices, mask_shape, n_voxels = self._get_matrix_info(qdtype)
+            if quantize == 'voxel':
+                outmat = _quantize_voxels(partial(self._iter_flat_rows, smooth_fwhm, mask_indices), self.n_subjs,
+                                          (n_voxels, ), qdtype)
+            else:
+                outmat = _quantize_rows(self._iter_flat_rows(smooth_fwhm, mask_indices), self.n_subjs,
+                                        (n_voxels, ), qdtype)
+            return outmat, mask_indices, mask_shape
+
+        outdtype, mask_indices, mask_shape, n_voxels = self._get_matrix_info(outdtype)
+
+        if self.memory is not None:
+            get_row = partial(self._get_flat_row, smooth_fwhm=smooth_fwhm, mask_indices=mask_indices)
+            outmat  = _get_cached_matrix(self, get_row, [nipy_img.file_path for nipy_img in self.items],
+                                         self.mask_file, smooth_fwhm, outdtype)
+            return outmat, mask_indices, mask_shape
+
+        outmat = np.zeros((self.n_subjs, n_voxels), dtype=outdtype)
+        for i, flat_data in enumerate(self._iter_flat_rows(smooth_fwhm, mask_indices)):
+            outmat[i, :] = flat_data
+
+        return outmat, mask_indices, mask_shape
+
+    def _get_matrix_info(self, outdtype=None):
+        """Return the information needed to build the data matrix of this set.
+
+        Parameters
+        ----------
+        outdtype: dtype
+            Type of the elements of the array, if None will obtain the dtype from
+            the first nifti file.
+
+        Returns
+        -------
+        outdtype, mask_indices, mask_shape, n_voxels
 
+        n_voxels: Number of voxels of one flattened subject, i.e., the length of one row of the matrix.
+        """
         vol = self.items[0].get_data()
         if not outdtype:
             outdtype = vol.dtype
@@ -522,28 +1254,69 @@ class NiftiSubjectsSet(ItemSet):
             log.debug('Non-zero voxels have not been found in mask {}'.format(self.mask_file))
             n_voxels = np.prod(vol.shape)
 
-        outmat = np.zeros((self.n_subjs, n_voxels), dtype=outdtype)
+        return outdtype, mask_indices, mask_shape, n_voxels
+
+    def _get_flat_row(self, idx, smooth_fwhm=0, mask_indices=None):
+        """Return the smoothed, masked and flattened data of the subject `idx`."""
+        return next(self._iter_flat_rows(smooth_fwhm, mask_indices, items=[self.items[idx]]))
+
+    def _iter_flat_rows(self, smooth_fwhm=0, mask_indices=None, items=None):
+        """Yield the smoothed, masked and flattened data of each subject, one at a time.
+
+        Parameters
+        ----------
+        smooth_fwhm: int
+            Integer indicating the size of the FWHM Gaussian smoothing kernel
+            to smooth the subject volumes.
+
+        mask_indices: tuple of numpy.ndarray
+            Indices of the voxels in the mask. If None, the whole volumes will be flattened.
+
+        items: list
+            The subject images to read. If None, will use self.items.
+        """
+        if items is None:
+            items = self.items
+
+        # without smoothing, only the bounding box of the mask is read from the files
+        box, box_indices = None, None
+        if mask_indices is not None and smooth_fwhm <= 0 and len(mask_indices[0]) > 0:
+            box         = tuple(slice(idx.min(), idx.max() + 1) for idx in mask_indices)
+            box_indices = tuple(idx - sl.start for idx, sl in zip(mask_indices, box))
+
+        sources = [nipy_img.file_path for nipy_img in items]
+        if self._prefetcher is not None:
+            sources = self._prefetcher.with_images(sources)
+
         try:
-            for i, nipy_img in enumerate(self.items):
+            for nipy_img, image in zip(items, sources):
+                if box is not None:
+                    yield get_img_data_box(image, box)[box_indices]
+                    continue
+
+                if not isinstance(image, string_types):
+                    # delayed import because could not install nipy on Python 3 on OSX
+                    from nipy.io.nifti_ref import nifti2nipy
+                    nipy_img = nifti2nipy(image)
+
                 vol = self._smooth_img(nipy_img, smooth_fwhm).get_data()
-                if self.has_mask is not None:
-                    outmat[i, :] = vol[mask_indices]
+                if mask_indices is not None:
+                    yield vol[mask_indices]
                 else:
-                    outmat[i, :] = vol.flatten()
+                    yield vol.flatten()
         except Exception as exc:
             raise Exception('Error when flattening file {0}'.format(nipy_img.file_path)) from exc
-        else:
-            return outmat, mask_indices, mask_shape
 
-    def to_file(self, output_file, smooth_fwhm=0, outdtype=None):
+    def to_file(self, output_file, smooth_fwhm=0, outdtype=None, stream=False, quantize=None):
         """Save the Numpy array created from to_matrix function to the output_file.
 
-        Will save into the file: outmat, mask_indices, vol_shape
+        Will save into the file: outmat, mask_runs, vol_shape
 
             data: Numpy array with shape N x prod(vol.shape)
                   containing the N files as flat vectors.
 
-            mask_indices: matrix with indices of the voxels in the mask
+            mask_runs: (n_runs, 2) matrix with the first and last + 1 flat indices of the runs of voxels
+                       in the mask, see boyle.nifti.mask.CompactMask.from_runs
 
             vol_shape: Tuple with shape of the volumes, for reshaping.
 
@@ -566,21 +1339,52 @@ class NiftiSubjectsSet(ItemSet):
         outdtype: dtype
             Type of the elements of the array, if None will obtain the dtype from
             the first nifti file.
+
+        stream: bool
+            If True, each subject row will be written into a chunked and resizable dataset
+            in `output_file` as soon as it is read, instead of building the whole matrix
+            in memory first. Only for HDF5 output files.
+
+        quantize: str
+            If not None, 'data' will be stored quantized, with its scale factors in 'scl_slope' and
+            'scl_inter'. See NeuroImageSet.to_file.
         """
-        outmat, mask_indices, mask_shape = self.to_matrix(smooth_fwhm, outdtype)
+        if quantize is not None:
+            outdtype = _get_quantize_dtype(quantize, outdtype)
+            if stream and quantize != 'subject':
+                raise ValueError("Only the 'subject' quantization can be used with `stream`, "
+                                 "got {}.".format(quantize))
+
+        if stream:
+            outdtype, mask_indices, mask_shape, n_voxels = self._get_matrix_info(outdtype)
+        else:
+            outmat, mask_indices, mask_shape = self.to_matrix(smooth_fwhm, outdtype, quantize=quantize)
 
         exporter = ExportData()
-        content = {'data':         outmat,
-                   'labels':       self.labels,
-                   'mask_indices': mask_indices,
+        content = {'labels':       np.asarray(self.labels),
+                   'mask_runs':    _get_mask_runs(get_img_data(self.mask_file) > 0 if self.has_mask else None),
                    'mask_shape':   mask_shape, }
 
+        if quantize is not None and not stream:
+            content['scl_slope'] = outmat.slope
+            content['scl_inter'] = outmat.inter
+            outmat = outmat.data
+
         if self.others:
             content.update(self.others)
 
         log.debug('Creating content in file {}.'.format(output_file))
 
         try:
-            exporter.save_variables(output_file, content)
+            if stream:
+                rows = self._iter_flat_rows(smooth_fwhm, mask_indices)
+                if quantize is not None:
+                    rows = _iter_quantized_rows(rows, outdtype, content)
+
+                exporter.save_rows(output_file, rows, (n_voxels, ),
+                                   outdtype, n_rows=self.n_subjs, variables=content)
+            else:
+                content['data'] = outmat
+                exporter.save_variables(output_file, content)
         except Exception as exc:
             raise Exception('Error saving variables to file {}.'.format(output_file)) from exc
@@ -1,14 +1,32 @@
 
+import os
+import hashlib
 import logging
+import tempfile
+import os.path          as op
+from   functools          import lru_cache
+from   concurrent.futures import ThreadPoolExecutor
+
 import numpy            as np
 import nibabel          as nib
 import scipy.ndimage    as ndimage
 from   six              import string_types
+from   nibabel.fileholders import FileHolder
 
 from   .check           import check_img
+from   .mask            import get_bounding_box
+from   .cache           import NiftiCache
 
 from   nilearn._utils       import check_niimg
-from   nilearn.image.image  import new_img_like, _fast_smooth_array
+from   nilearn.image.image  import new_img_like
+
+try:
+    # scipy >= 1.4, can use several threads
+    import scipy.fft    as fftpack
+    _fft_has_workers = True
+except ImportError:
+    import numpy.fft    as fftpack
+    _fft_has_workers = False
 
 
 log = logging.getLogger(__name__)
@@ -74,7 +92,483 @@ def smooth_volume(image, smoothmm):
     return smooth_imgs(image, smoothmm)
 
 
-def _smooth_data_array(arr, affine, fwhm, copy=True):
+# scipy.ndimage.gaussian_filter1d truncates the kernel at this many sigmas
+GAUSSIAN_TRUNCATE = 4.0
+
+# weight of each neighbour in the fwhm='fast' smoothing
+FAST_NEIGHBOR_WEIGHT = 0.2
+
+
+def _is_fast(fwhm):
+    """Return True if `fwhm` asks for the 'fast' smoothing."""
+    return isinstance(fwhm, string_types) and fwhm == 'fast'
+
+
+def has_smoothing(fwhm):
+    """Return True if `fwhm` is a smoothing kernel size, i.e., 'fast' or greater than 0.
+
+    Parameters
+    ----------
+    fwhm: scalar, numpy.ndarray, 'fast' or None
+
+    Returns
+    -------
+    bool
+    """
+    if fwhm is None:
+        return False
+
+    if _is_fast(fwhm):
+        return True
+
+    return bool(np.any(np.asarray(fwhm) > 0))
+
+
+def _fast_smooth_array(arr):
+    """Smooth in place the 3 first axes of `arr` with a separable [0.2, 1, 0.2] filter.
+
+    After the filter along each axis, each voxel is divided by the sum of the weights
+    of the neighbours it has along that axis, so the local average value is preserved,
+    also on the edges of the array.
+    Each axis is filtered in place, the normalization only needs a vector the length of the axis.
+
+    Parameters
+    ----------
+    arr: numpy.ndarray
+        3D or 4D float array. It will be modified.
+
+    Returns
+    -------
+    arr: numpy.ndarray
+    """
+    weights = [FAST_NEIGHBOR_WEIGHT, 1., FAST_NEIGHBOR_WEIGHT]
+    for axis in range(min(arr.ndim, 3)):
+        n = arr.shape[axis]
+        ndimage.correlate1d(arr, weights, axis=axis, output=arr, mode='constant', cval=0.)
+
+        # the sum of the weights of each voxel and its neighbours along this axis
+        norm = np.ones(n)
+        norm[1:]  += FAST_NEIGHBOR_WEIGHT
+        norm[:-1] += FAST_NEIGHBOR_WEIGHT
+
+        bshape = [1] * arr.ndim
+        bshape[axis] = n
+        arr /= norm.reshape(bshape).astype(arr.dtype)
+
+    return arr
+
+
+def _get_smoothing_sigma(affine, fwhm):
+    """Return the sigma of the Gaussian kernel in voxels along each of the 3 first axes.
+
+    Parameters
+    ----------
+    affine: numpy.ndarray
+        Image affine transformation matrix.
+
+    fwhm: scalar, numpy.ndarray
+        Smoothing kernel size, as Full-Width at Half Maximum (FWHM) in millimeters.
+
+    Returns
+    -------
+    sigma: numpy.ndarray
+    """
+    # Keep the 3D part of the affine.
+    affine = affine[:3, :3]
+
+    # Convert from FWHM in mm to a sigma.
+    fwhm_sigma_ratio = np.sqrt(8 * np.log(2))
+    vox_size         = np.sqrt(np.sum(affine ** 2, axis=0))
+    return fwhm / (fwhm_sigma_ratio * vox_size)
+
+
+def get_smoothing_box(mask_data, affine, fwhm):
+    """Return the bounding box of `mask_data` padded by the radius of the Gaussian kernel along
+    each axis, i.e., the part of the volume needed to smooth the voxels within the mask.
+
+    Parameters
+    ----------
+    mask_data: numpy.ndarray
+        3D mask array.
+
+    affine: numpy.ndarray
+        Image affine transformation matrix.
+
+    fwhm: scalar, numpy.ndarray or 'fast'
+        Smoothing kernel size, as Full-Width at Half Maximum (FWHM) in millimeters.
+
+    Returns
+    -------
+    slices: tuple of 3 slices
+    """
+    box = get_bounding_box(mask_data)
+    if _is_fast(fwhm):
+        radii = [1, 1, 1]
+    else:
+        radii = [int(GAUSSIAN_TRUNCATE * float(s) + 0.5) for s in _get_smoothing_sigma(affine, fwhm)]
+
+    slices = []
+    for sl, radius, size in zip(box, radii, mask_data.shape):
+        if sl.start == sl.stop:
+            return box
+
+        slices.append(slice(max(sl.start - radius, 0), min(sl.stop + radius, size)))
+
+    return tuple(slices)
+
+
+def _get_split_axis(shape, filter_axis):
+    """Return the axis along which to split an array of `shape` into independent chunks
+    when filtering along `filter_axis`: the time axis of 4D arrays, otherwise the largest
+    of the other spatial axes."""
+    if len(shape) > 3:
+        return 3
+
+    axes = [ax for ax in range(len(shape)) if ax != filter_axis]
+    return max(axes, key=lambda ax: shape[ax])
+
+
+def _gaussian_filter_axes(arr, sigma, n_threads=1, **kwargs):
+    """Apply in place a Gaussian filter along each of the first axes of `arr`,
+    one axis at a time with ndimage.gaussian_filter1d.
+
+    The filter along one axis is independent for each line of that axis, so with `n_threads` > 1
+    `arr` is split in chunks along another axis (time for 4D arrays) which are filtered in
+    a thread pool. The output is identical to filtering the whole array at once.
+
+    Parameters
+    ----------
+    arr: numpy.ndarray
+        3D or 4D float array. It will be modified.
+
+    sigma: sequence of scalars
+        Sigma of the Gaussian kernel in voxels for each of the first axes.
+
+    n_threads: int
+        Number of threads.
+
+    kwargs: keyword-arguments
+        Arguments for the ndimage.gaussian_filter1d function.
+
+    Returns
+    -------
+    arr: numpy.ndarray
+    """
+    if n_threads is None or n_threads <= 1:
+        for n, s in enumerate(sigma):
+            ndimage.gaussian_filter1d(arr, s, output=arr, axis=n, **kwargs)
+        return arr
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for n, s in enumerate(sigma):
+            split_axis = _get_split_axis(arr.shape, n)
+            bounds     = np.linspace(0, arr.shape[split_axis], min(n_threads, arr.shape[split_axis]) + 1).astype(int)
+
+            futures = []
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                index = [slice(None)] * arr.ndim
+                index[split_axis] = slice(start, stop)
+                chunk = arr[tuple(index)]
+                futures.append(executor.submit(ndimage.gaussian_filter1d, chunk, s, output=chunk, axis=n, **kwargs))
+
+            # the next axis must wait for all the chunks of this one
+            for future in futures:
+                future.result()
+
+    return arr
+
+
+def _gaussian_kernel1d(sigma, radius):
+    """Return the normalized 1D Gaussian kernel of ndimage.gaussian_filter1d."""
+    x   = np.arange(-radius, radius + 1, dtype=np.float64)
+    phi = np.exp(-0.5 / (float(sigma) ** 2) * x ** 2) if sigma > 0 else (x == 0).astype(np.float64)
+    return phi / phi.sum()
+
+
+@lru_cache(maxsize=2)
+def _get_fft_kernel(shape, affine, fwhm, truncate=GAUSSIAN_TRUNCATE, dtype=np.float64):
+    """Return the padding and frequency response of the Gaussian kernel to smooth
+    3D volumes of `shape`.
+
+    The results are cached for the last 2 combinations of parameters, so the images of
+    the same grid compute them only once. Each response takes as much memory as a volume
+    of `fft_shape`, so only a few are kept.
+
+    Parameters
+    ----------
+    shape: tuple of 3 int
+
+    affine: tuple of 9 float
+        The 3x3 part of the image affine matrix, flattened.
+
+    fwhm: tuple of 3 float
+        Smoothing kernel size, as Full-Width at Half Maximum (FWHM) in millimeters, along each axis.
+
+    truncate: float
+        Truncate the kernel at this many standard deviations.
+
+    dtype: numpy.float32 or numpy.float64
+        Type of the frequency response, the one of the arrays to smooth.
+
+    Returns
+    -------
+    radius, fft_shape, response
+        radius: tuple of 3 int
+            Kernel radius along each axis, the volumes must be padded by this.
+
+        fft_shape: tuple of 3 int
+            Shape of the transform, the padded shape rounded up to a fast length.
+
+        response: numpy.ndarray
+            Frequency response of the kernel, with the shape of the rfftn of `fft_shape`.
+            It is read-only, as it is shared by the calls with the same parameters.
+    """
+    sigma = _get_smoothing_sigma(np.reshape(affine, (3, 3)), np.array(fwhm))
+
+    radius    = tuple(int(truncate * float(s) + 0.5) for s in sigma)
+    fft_shape = tuple(_next_fast_len(n + 2 * r) for n, r in zip(shape, radius))
+
+    response = np.ones((1, 1, 1), dtype=dtype)
+    for axis, (s, r, n) in enumerate(zip(sigma, radius, fft_shape)):
+        # the kernel centered at 0, wrapped around
+        kernel = np.zeros(n)
+        kernel[:r + 1] = _gaussian_kernel1d(s, r)[r:]
+        if r > 0:
+            kernel[-r:] = _gaussian_kernel1d(s, r)[:r]
+
+        # the kernel is symmetric, its transform is real
+        if axis == 2:
+            axis_response = np.fft.rfft(kernel).real
+        else:
+            axis_response = np.fft.fft(kernel).real
+
+        bshape = [1, 1, 1]
+        bshape[axis] = len(axis_response)
+        response = response * axis_response.reshape(bshape).astype(dtype)
+
+    response.flags.writeable = False
+    return radius, fft_shape, response
+
+
+def _next_fast_len(n):
+    """Return the smallest length >= n which is a product of 2, 3 and 5."""
+    if hasattr(fftpack, 'next_fast_len'):
+        return fftpack.next_fast_len(n)
+
+    best = n
+    while True:
+        m = best
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return best
+        best += 1
+
+
+def _fft_gaussian_filter(arr, affine, fwhm, truncate=GAUSSIAN_TRUNCATE, n_threads=1):
+    """Apply in place a Gaussian filter along the 3 first axes of `arr` through the FFT.
+
+    The array is padded by the kernel radius as in the 'reflect' mode of ndimage.gaussian_filter1d,
+    so the result is the same as in _gaussian_filter_axes up to floating point precision.
+    The frequency response of the kernel is cached, see _get_fft_kernel.
+
+    Parameters
+    ----------
+    arr: numpy.ndarray
+        3D or 4D float array. It will be modified.
+
+    affine: numpy.ndarray
+        Image affine transformation matrix.
+
+    fwhm: scalar, numpy.ndarray
+        Smoothing kernel size, as Full-Width at Half Maximum (FWHM) in millimeters.
+
+    truncate: float
+        Truncate the kernel at this many standard deviations.
+
+    n_threads: int
+        Number of threads for the FFT, needs scipy >= 1.4.
+
+    Returns
+    -------
+    arr: numpy.ndarray
+    """
+    # single precision transforms for single precision arrays
+    dtype = np.float32 if arr.dtype == np.float32 else np.float64
+    fwhm  = np.broadcast_to(np.asarray(fwhm, dtype=np.float64), (3, ))
+    radius, fft_shape, response = _get_fft_kernel(tuple(arr.shape[:3]),
+                                                  tuple(np.asarray(affine, dtype=np.float64)[:3, :3].ravel()),
+                                                  tuple(fwhm), float(truncate), dtype)
+
+    padded = np.zeros(fft_shape + arr.shape[3:], dtype=dtype)
+    inner  = tuple(slice(r, r + n) for r, n in zip(radius, arr.shape[:3]))
+    padded[inner] = arr
+    for axis, (r, n) in enumerate(zip(radius, arr.shape[:3])):
+        if r == 0:
+            continue
+
+        # fill the borders of this axis reflecting the voxels, as in ndimage 'reflect' mode
+        padded = np.moveaxis(padded, axis, 0)
+        if r <= n:
+            padded[:r]             = padded[r:2 * r][::-1]
+            padded[r + n:2 * r + n] = padded[n:r + n][::-1]
+        else:
+            pad_width = [(r, r)] + [(0, 0)] * (padded.ndim - 1)
+            padded[:2 * r + n] = np.pad(padded[r:r + n], pad_width, mode='symmetric')
+        padded = np.moveaxis(padded, 0, axis)
+
+    kwargs = {'workers': n_threads} if _fft_has_workers else {}
+    if arr.ndim > 3:
+        response = response.reshape(response.shape + (1, ) * (arr.ndim - 3))
+
+    freq   = fftpack.rfftn(padded, axes=(0, 1, 2), **kwargs)
+    freq  *= response
+    padded = fftpack.irfftn(freq, s=fft_shape, axes=(0, 1, 2), **kwargs)
+
+    arr[...] = padded[inner]
+    return arr
+
+
+def _filter_array(arr, affine, fwhm, method='direct', n_threads=1, **kwargs):
+    """Apply in place a Gaussian filter along the 3 first axes of `arr` with the given method.
+
+    Parameters
+    ----------
+    arr: numpy.ndarray
+        3D or 4D float array. It will be modified.
+
+    affine: numpy.ndarray
+        Image affine transformation matrix.
+
+    fwhm: scalar, numpy.ndarray or 'fast'
+        Smoothing kernel size, as Full-Width at Half Maximum (FWHM) in millimeters.
+        If 'fast', see _fast_smooth_array, `method` and `kwargs` are ignored.
+
+    method: str
+        'direct' to convolve along each axis, see _gaussian_filter_axes.
+        'fft' to multiply in the frequency domain, see _fft_gaussian_filter. It is faster
+        for large kernels, e.g., FWHM >= 8mm on 1mm voxels.
+
+    n_threads: int
+        Number of threads.
+
+    kwargs: keyword-arguments
+        Arguments for the ndimage.gaussian_filter1d function. The 'fft' method accepts only `truncate`.
+
+    Returns
+    -------
+    arr: numpy.ndarray
+    """
+    if _is_fast(fwhm):
+        return _fast_smooth_array(arr)
+    elif method == 'direct':
+        return _gaussian_filter_axes(arr, _get_smoothing_sigma(affine, fwhm), n_threads=n_threads, **kwargs)
+    elif method == 'fft':
+        truncate = kwargs.pop('truncate', GAUSSIAN_TRUNCATE)
+        if kwargs:
+            raise ValueError('The fft smoothing method does not accept the arguments {}.'.format(list(kwargs)))
+        return _fft_gaussian_filter(arr, affine, fwhm, truncate=truncate, n_threads=n_threads)
+    else:
+        raise ValueError("Expected 'direct' or 'fft' as smoothing method, got {}.".format(method))
+
+
+# approximate size in bytes of the blocks in which the arrays are cast and scrubbed before smoothing
+PREPARE_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+class SmoothingBuffer(object):
+    """A float array reused to hold the data to smooth of several images of the same shape.
+
+    Examples
+    --------
+    >>> buffer = SmoothingBuffer()
+    >>> for img in imgs:
+    ...     smooth = _smooth_data_array(img.get_data(), img.get_affine(), 8, buffer=buffer)
+    ...     rows.append(smooth[mask_data])  # smooth is overwritten by the next image
+    """
+    def __init__(self):
+        self._arr = None
+
+    def get(self, shape, dtype):
+        """Return the buffer array with `shape` and `dtype`, allocating it if it does not match."""
+        shape, dtype = tuple(shape), np.dtype(dtype)
+        if self._arr is None or self._arr.shape != shape or self._arr.dtype != dtype:
+            self._arr = np.empty(shape, dtype=dtype)
+        return self._arr
+
+    def clear(self):
+        self._arr = None
+
+
+def _get_smoothing_dtype(dtype):
+    """Return the type of the array to smooth for data of `dtype`: floats for the integers."""
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'i':
+        if dtype == np.int64:
+            return np.dtype(np.float64)
+        else:
+            # We don't need crazy precision
+            return np.dtype(np.float32)
+    return dtype
+
+
+def _prepare_smoothing_array(arr, copy=True, ensure_finite=True, buffer=None):
+    """Return `arr` ready to be smoothed in place: cast to float, copied and with
+    the non-finite values zeroed.
+
+    All this is done in one pass over blocks of the first axis of `arr`, so the only full-size
+    array allocated is the output one, and only if it is needed.
+
+    Parameters
+    ----------
+    arr: numpy.ndarray
+
+    copy: bool
+        If False and `arr` does not need to be cast, `arr` is modified and returned.
+
+    ensure_finite: bool
+        If True, replace the non-finite values (like NaNs) by zero.
+
+    buffer: SmoothingBuffer
+        If given, the output array is taken from it instead of being allocated.
+
+    Returns
+    -------
+    arr: numpy.ndarray
+    """
+    dtype = _get_smoothing_dtype(arr.dtype)
+    if not copy and arr.dtype == dtype:
+        out = arr
+    elif buffer is not None:
+        out = buffer.get(arr.shape, dtype)
+    else:
+        out = np.empty(arr.shape, dtype=dtype)
+
+    # integer data is always finite
+    scrub = ensure_finite and arr.dtype.kind in 'fc'
+    if out is arr and not scrub:
+        return out
+
+    if arr.ndim == 0 or arr.size == 0:
+        np.copyto(out, arr, casting='unsafe')
+        return out
+
+    block_len = max(1, PREPARE_BLOCK_SIZE // max(out[0].nbytes, 1))
+    for start in range(0, arr.shape[0], block_len):
+        block = out[start:start + block_len]
+        if out is not arr:
+            np.copyto(block, arr[start:start + block_len], casting='unsafe')
+
+        if scrub:
+            # SPM tends to put NaNs in the data outside the brain
+            block[np.logical_not(np.isfinite(block))] = 0
+
+    return out
+
+
+def _smooth_data_array(arr, affine, fwhm, copy=True, mask=None, n_threads=1, method='direct',
+                       buffer=None):
     """Smooth images with a a Gaussian filter.
 
     Apply a Gaussian filter along the three first dimensions of arr.
@@ -87,47 +581,191 @@ def _smooth_data_array(arr, affine, fwhm, copy=True):
     affine: numpy.ndarray
         Image affine transformation matrix for image.
 
-    fwhm: scalar, numpy.ndarray
+    fwhm: scalar, numpy.ndarray or 'fast'
         Smoothing kernel size, as Full-Width at Half Maximum (FWHM) in millimeters.
         If a scalar is given, kernel width is identical on all three directions.
         A numpy.ndarray must have 3 elements, giving the FWHM along each axis.
+        If 'fast', a [0.2, 1, 0.2] filter is applied along each axis, see _fast_smooth_array.
 
     copy: bool
         if True, will make a copy of the input array. Otherwise will directly smooth the input array.
 
+    mask: numpy.ndarray
+        3D mask array. If given, only the part of `arr` within the bounding box of the mask
+        padded by the kernel radius is smoothed, see get_smoothing_box. The values
+        within the mask are the same as if the whole array was smoothed, the values far
+        from the mask are left as they are.
+
+    n_threads: int
+        Number of threads to smooth the array, see _gaussian_filter_axes.
+
+    method: str
+        'direct' or 'fft', see _filter_array.
+
+    buffer: SmoothingBuffer
+        If given, the smoothed array is written in this buffer instead of a new array,
+        it will be overwritten by the next use of the buffer.
+
     Returns
     -------
     smooth_arr: numpy.ndarray
     """
+    # Cast, copy and zeroe possible NaNs and Inf in the image.
+    arr = _prepare_smoothing_array(arr, copy=copy, buffer=buffer)
 
-    if arr.dtype.kind == 'i':
-        if arr.dtype == np.int64:
-            arr = arr.astype(np.float64)
-        else:
-            arr = arr.astype(np.float32)
-    if copy:
-        arr = arr.copy()
-
-    # Zeroe possible NaNs and Inf in the image.
-    arr[np.logical_not(np.isfinite(arr))] = 0
+    # the filters are applied in place in this view of arr
+    work = arr
+    if mask is not None:
+        work = arr[get_smoothing_box(mask, affine, fwhm)]
 
     try:
-        # Keep the 3D part of the affine.
-        affine = affine[:3, :3]
-
-        # Convert from FWHM in mm to a sigma.
-        fwhm_sigma_ratio = np.sqrt(8 * np.log(2))
-        vox_size         = np.sqrt(np.sum(affine ** 2, axis=0))
-        sigma            = fwhm / (fwhm_sigma_ratio * vox_size)
-        for n, s in enumerate(sigma):
-            ndimage.gaussian_filter1d(arr, s, output=arr, axis=n)
+        _filter_array(work, affine, fwhm, method=method, n_threads=n_threads, truncate=GAUSSIAN_TRUNCATE)
     except:
         raise ValueError('Error smoothing the array.')
     else:
         return arr
 
 
-def smooth_imgs(images, fwhm):
+# the SmoothedImageCache used by smooth_imgs, None if disabled
+_smoothing_cache = None
+
+
+class SmoothedImageCache(NiftiCache):
+    """A directory with the smoothed versions of Nifti files, stored as uncompressed float32
+    .nii files which are read with memory-mapped data.
+
+    Each smoothed file is keyed by the fingerprint of its source file (see NiftiCache.get_key),
+    its affine matrix, the FWHM and the smoothing method, and the least recently used ones
+    are removed when the cache exceeds `max_size`.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Path to the cache directory. It will be created if it does not exist.
+        Do not share it with a NiftiCache.
+
+    max_size: int
+        Maximum size in bytes of the cache directory. If None, the cache has no size limit.
+
+    Attributes
+    ----------
+    hits: int
+        Number of smoothed images read from the cache.
+
+    misses: int
+        Number of images smoothed and added to the cache.
+        The counters only include the calls made in the current process.
+    """
+    def __init__(self, cache_dir, max_size=None):
+        super(SmoothedImageCache, self).__init__(cache_dir, max_size=max_size)
+        self.hits   = 0
+        self.misses = 0
+
+    @staticmethod
+    def is_cacheable(image):
+        """Return True if `image` is a file path."""
+        return isinstance(image, string_types)
+
+    def get_smoothing_key(self, file_path, affine, fwhm, method='direct'):
+        """Return the cache key of `file_path` smoothed with `fwhm` and `method`."""
+        if _is_fast(fwhm):
+            fwhm = 'fast'
+        else:
+            fwhm = ','.join(repr(float(f)) for f in np.broadcast_to(np.asarray(fwhm, dtype=np.float64), (3, )))
+
+        affine = np.asarray(affine, dtype=np.float64).tobytes().hex()
+        key    = '{}:{}:{}:{}'.format(self.get_key(file_path), affine, fwhm, method)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def smooth(self, file_path, fwhm, method='direct', n_threads=1):
+        """Return the image in `file_path` smoothed, from the cache if it is there,
+        otherwise smoothing it and adding it to the cache.
+
+        Parameters
+        ----------
+        file_path: str
+            Path to a Nifti file.
+
+        fwhm: scalar, numpy.ndarray or 'fast'
+            Smoothing kernel size, see smooth_imgs.
+
+        method: str
+            'direct' or 'fft', see smooth_imgs.
+
+        n_threads: int
+            Number of threads to smooth the image if it is not in the cache.
+
+        Returns
+        -------
+        smooth_img: nibabel.Nifti1Image
+            With float32 memory-mapped data.
+        """
+        img        = check_img(file_path, use_cache=False)
+        affine     = img.get_affine()
+        cache_path = op.join(self.cache_dir, self.get_smoothing_key(file_path, affine, fwhm, method) + self.extension)
+        try:
+            # mark it as recently used
+            os.utime(cache_path, None)
+            smooth_img = self._open(cache_path)
+        except FileNotFoundError:
+            self.misses += 1
+            smooth = _smooth_data_array(img.get_data(), affine, fwhm=fwhm, copy=True, n_threads=n_threads,
+                                        method=method)
+            self._add_image(nib.Nifti1Image(smooth.astype(np.float32, copy=False), affine), cache_path)
+            self.evict(keep=cache_path)
+            smooth_img = self._open(cache_path)
+        else:
+            self.hits += 1
+
+        return smooth_img
+
+    def _add_image(self, img, cache_path):
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as fileobj:
+                img.to_file_map({'image': FileHolder(filename=tmp_path, fileobj=fileobj)})
+            os.replace(tmp_path, cache_path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def clear(self):
+        """Remove all the cached files and reset the counters."""
+        super(SmoothedImageCache, self).clear()
+        self.hits   = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return '<SmoothedImageCache {} hits={} misses={}>'.format(self.cache_dir, self.hits, self.misses)
+
+
+def set_smoothing_cache(cache_dir, max_size=None):
+    """Enable the cache of smoothed images used by smooth_imgs and by the
+    data matrices of boyle.nifti.sets.NeuroImageSet, for images given as file paths.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Path to the cache directory. If None, the cache is disabled.
+
+    max_size: int
+        Maximum size in bytes of the cache directory. If None, the cache has no size limit.
+
+    Returns
+    -------
+    cache: SmoothedImageCache or None
+    """
+    global _smoothing_cache
+    _smoothing_cache = SmoothedImageCache(cache_dir, max_size=max_size) if cache_dir is not None else None
+    return _smoothing_cache
+
+
+def get_smoothing_cache():
+    """Return the SmoothedImageCache used by smooth_imgs, None if it is disabled."""
+    return _smoothing_cache
+
+
+def smooth_imgs(images, fwhm, n_threads=1, method='direct'):
     """Smooth images using a Gaussian filter.
 
     Apply a Gaussian filter along the three first dimensions of each image in images.
@@ -137,19 +775,31 @@ def smooth_imgs(images, fwhm):
     ----------
     imgs: str or img-like object or iterable of img-like objects
         See boyle.nifti.read.read_img
-        Image(s) to smooth.
+        Image(s) to smooth. A boyle.nifti.read.ImagePrefetcher can be given to read
+        the next images in background threads while the current one is smoothed.
 
-    fwhm: scalar or numpy.ndarray
+    fwhm: scalar, numpy.ndarray or 'fast'
         Smoothing kernel size, as Full-Width at Half Maximum (FWHM) in millimeters.
         If a scalar is given, kernel width is identical on all three directions.
         A numpy.ndarray must have 3 elements, giving the FWHM along each axis.
+        If 'fast', a [0.2, 1, 0.2] filter is applied along each axis, see _fast_smooth_array.
+
+    n_threads: int
+        Number of threads to smooth each image.
+
+    method: str
+        'direct' to convolve along each axis or 'fft' to multiply in the frequency domain,
+        which is faster for large kernels. With 'fft' the kernel is computed once for all the
+        images of the same grid.
 
     Returns
     -------
     smooth_imgs: nibabel.Nifti1Image or list of.
         Smooth input image/s.
+        If the smoothing cache is enabled (see set_smoothing_cache), the images given as
+        file paths are float32 images read from the cache.
     """
-    if fwhm <= 0:
+    if not has_smoothing(fwhm):
         return images
 
     if not isinstance(images, string_types) and hasattr(images, '__iter__'):
@@ -158,11 +808,18 @@ def smooth_imgs(images, fwhm):
         only_one = True
         images = [images]
 
+    # each smoothed image is written directly into its own output array, see _prepare_smoothing_array
+    cache  = get_smoothing_cache()
     result = []
     for img in images:
+        if cache is not None and cache.is_cacheable(img):
+            result.append(cache.smooth(img, fwhm, method=method, n_threads=n_threads))
+            continue
+
         img    = check_img(img)
         affine = img.get_affine()
-        smooth = _smooth_data_array(img.get_data(), affine, fwhm=fwhm, copy=True)
+        smooth = _smooth_data_array(img.get_data(), affine, fwhm=fwhm, copy=True, n_threads=n_threads,
+                                    method=method)
         result.append(nib.Nifti1Image(smooth, affine))
 
     if only_one:
@@ -171,7 +828,8 @@ def smooth_imgs(images, fwhm):
         return result
 
 
-def _smooth_array(arr, affine, fwhm=None, ensure_finite=True, copy=True, **kwargs):
+def _smooth_array(arr, affine, fwhm=None, ensure_finite=True, copy=True, n_threads=1, method='direct',
+                  **kwargs):
     """Smooth images by applying a Gaussian filter.
     Apply a Gaussian filter along the three first dimensions of arr.
 
@@ -203,6 +861,10 @@ def _smooth_array(arr, affine, fwhm=None, ensure_finite=True, copy=True, **kwarg
     copy: bool
         if True, input array is not modified. False by default: the filtering
         is performed in-place.
+    n_threads: int
+        Number of threads for the Gaussian filter, see _gaussian_filter_axes.
+    method: str
+        'direct' or 'fft', see _filter_array.
     kwargs: keyword-arguments
         Arguments for the ndimage.gaussian_filter1d function.
 
@@ -215,36 +877,15 @@ def _smooth_array(arr, affine, fwhm=None, ensure_finite=True, copy=True, **kwarg
     This function is most efficient with arr in C order.
     """
 
-    if arr.dtype.kind == 'i':
-        if arr.dtype == np.int64:
-            arr = arr.astype(np.float64)
-        else:
-            # We don't need crazy precision
-            arr = arr.astype(np.float32)
-    if copy:
-        arr = arr.copy()
-
-    if ensure_finite:
-        # SPM tends to put NaNs in the data outside the brain
-        arr[np.logical_not(np.isfinite(arr))] = 0
-
-    if fwhm == 'fast':
-        arr = _fast_smooth_array(arr)
-    elif fwhm is not None:
-        # Keep only the scale part.
-        affine = affine[:3, :3]
-
-        # Convert from a FWHM to a sigma:
-        fwhm_over_sigma_ratio = np.sqrt(8 * np.log(2))
-        vox_size = np.sqrt(np.sum(affine ** 2, axis=0))
-        sigma = fwhm / (fwhm_over_sigma_ratio * vox_size)
-        for n, s in enumerate(sigma):
-            ndimage.gaussian_filter1d(arr, s, output=arr, axis=n, **kwargs)
+    arr = _prepare_smoothing_array(arr, copy=copy, ensure_finite=ensure_finite)
+
+    if fwhm is not None:
+        _filter_array(arr, affine, fwhm, method=method, n_threads=n_threads, **kwargs)
 
     return arr
 
 
-def smooth_img(imgs, fwhm, **kwargs):
+def smooth_img(imgs, fwhm, n_threads=1, method='direct', **kwargs):
     """Smooth images by applying a Gaussian filter.
     Apply a Gaussian filter along the three first dimensions of arr.
     In all cases, non-finite values in input image are replaced by zeros.
@@ -267,6 +908,10 @@ def smooth_img(imgs, fwhm, **kwargs):
         to preserve the scale.
         If fwhm is None, no filtering is performed (useful when just removal
         of non-finite values is needed)
+    n_threads: int
+        Number of threads to filter each image.
+    method: str
+        'direct' or 'fft', see boyle.nifti.smooth.smooth_imgs.
     Returns
     =======
     filtered_img: nibabel.Nifti1Image or list of.
@@ -288,7 +933,8 @@ def smooth_img(imgs, fwhm, **kwargs):
         img = check_niimg(img)
         affine = img.get_affine()
         filtered = _smooth_array(img.get_data(), affine, fwhm=fwhm,
-                                 ensure_finite=True, copy=True, **kwargs)
+                                 ensure_finite=True, copy=True, n_threads=n_threads,
+                                 method=method, **kwargs)
         ret.append(new_img_like(img, filtered, affine, copy_header=True))
 
     if single_img:
@@ -17,7 +17,7 @@ import numpy as np
 import nibabel as nib
 from scipy.signal import detrend
 
-from .read import read_img
+from .read import read_img, get_img_sources
 from .check import check_img_compatibility, check_img, is_img
 from .mask import vector_to_volume, apply_mask
 
@@ -27,7 +27,7 @@ def merge_images(images, axis='t'):
 
     Parameters
     ----------
-    images: list of str or img-like object.
+    images: list of str or img-like object or boyle.nifti.read.ImagePrefetcher
         See NeuroImage constructor docstring.
 
     axis: str
@@ -41,7 +41,7 @@ def merge_images(images, axis='t'):
     merged: img-like object
     """
     # check if images is not empty
-    if not images:
+    if not len(images):
         return None
 
     # the given axis name to axis idx
@@ -56,8 +56,9 @@ def merge_images(images, axis='t'):
         raise ValueError('Expected `axis` to be one of ({}), got {}.'.format(set(axis_dim.keys()), axis))
 
     # check if all images are compatible with each other
-    img1 = images[0]
-    for img in images:
+    sources = [check_img(img) for img in get_img_sources(images)]
+    img1 = sources[0]
+    for img in sources:
         check_img_compatibility(img1, img)
 
     # read the data of all the given images
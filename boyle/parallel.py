@@ -10,8 +10,12 @@
 # Use this at your own risk!
 # ------------------------------------------------------------------------------
 
+import os
+import tempfile
 from functools       import partial
-from multiprocessing import Pool
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
 
 
 def parallel_function(f, n_cpus=4):
@@ -28,3 +32,103 @@ def parallel_function(f, n_cpus=4):
     return partial(easy_parallize, f=f, n_cpus=n_cpus)
 
 # function.parallel = parallel_function(test_primes)
+
+
+def get_n_jobs(n_jobs):
+    """Return the number of worker processes to use for `n_jobs`.
+
+    Parameters
+    ----------
+    n_jobs: int
+        Number of jobs. Negative values are counted from the number of CPUs,
+        i.e., -1 means all CPUs, -2 all but one.
+
+    Returns
+    -------
+    n_jobs: int
+        A number of jobs higher than 0.
+    """
+    if n_jobs is None or n_jobs == 0:
+        return 1
+
+    if n_jobs < 0:
+        n_jobs = cpu_count() + 1 + n_jobs
+
+    return max(n_jobs, 1)
+
+
+def _is_empty(shape):
+    """Return True if an array of `shape` has no elements."""
+    return int(np.prod(shape)) == 0
+
+
+def create_shared_memmap(shape, dtype, dirpath=None):
+    """Create a zeroed numpy.memmap in a temporary file, so worker processes
+    can open it with `open_shared_memmap` and write their results directly in it.
+
+    Parameters
+    ----------
+    shape: tuple of int
+
+    dtype: numpy.dtype
+
+    dirpath: str
+        Directory where the temporary file will be created.
+        If None, will use the default temporary directory.
+
+    Returns
+    -------
+    memmap: numpy.memmap
+
+    file_path: str
+        Path to the file backing the memmap.
+        Remove it with `remove_shared_memmap` once the workers are done.
+        If `shape` has no elements, the file is empty and the returned array is not a memmap,
+        as an empty file can not be memory-mapped.
+    """
+    fd, file_path = tempfile.mkstemp(suffix='.dat', dir=dirpath)
+    os.close(fd)
+
+    if _is_empty(shape):
+        return np.zeros(shape, dtype=dtype), file_path
+
+    return np.memmap(file_path, dtype=dtype, mode='w+', shape=shape), file_path
+
+
+def open_shared_memmap(file_path, shape, dtype, mode='r+'):
+    """Open a memmap created with `create_shared_memmap` from a worker process.
+
+    Parameters
+    ----------
+    file_path: str
+
+    shape: tuple of int
+
+    dtype: numpy.dtype
+
+    mode: str
+        numpy.memmap access mode.
+
+    Returns
+    -------
+    memmap: numpy.memmap
+        An empty numpy.ndarray if `shape` has no elements, see `create_shared_memmap`.
+    """
+    if _is_empty(shape):
+        return np.zeros(shape, dtype=dtype)
+
+    return np.memmap(file_path, dtype=dtype, mode=mode, shape=shape)
+
+
+def remove_shared_memmap(file_path):
+    """Remove the file backing a shared memmap.
+    On POSIX systems the memmaps already open in this process remain valid.
+
+    Parameters
+    ----------
+    file_path: str
+    """
+    try:
+        os.remove(file_path)
+    except OSError:
+        pass
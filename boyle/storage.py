@@ -154,6 +154,48 @@ class ExportData(object):
         else:
             raise ValueError('Filename extension {0} not accepted.'.format(ext))
 
+    @staticmethod
+    def save_rows(filename, rows, row_shape, dtype, n_rows=0, variables=None, rows_varname='data'):
+        """Save the arrays in `rows` one by one as a matrix in a file, without building the whole
+        matrix in memory, then save the other given variables in the same file.
+        Valid extensions: '.hdf5' or '.h5' (HDF5 file)
+
+        Parameters
+        ----------
+        filename: str
+            Output file path.
+
+        rows: iterable of numpy.ndarray
+            Each item is one row of the matrix, with shape `row_shape`.
+
+        row_shape: tuple of int
+
+        dtype: numpy.dtype
+
+        n_rows: int
+            Expected number of rows.
+
+        variables: dict
+            Dictionary varname -> variable
+
+        rows_varname: str
+            Name of the matrix variable in the file.
+
+        Raises
+        ------
+        ValueError: if the extension of the filesname is not recognized.
+        """
+        ext = get_extension(filename).lower()
+        if ext != '.hdf5' and ext != '.h5':
+            raise ValueError('Filename extension {0} not accepted for saving rows, '
+                             'use .hdf5 or .h5.'.format(ext))
+
+        from .hdf5 import save_rows_to_hdf5, save_variables_to_hdf5
+        save_rows_to_hdf5(filename, rows, row_shape, dtype, n_rows=n_rows, dsname=rows_varname)
+
+        if variables:
+            save_variables_to_hdf5(filename, variables, mode='a')
+
     @staticmethod
     def save_varlist(filename, varnames, varlist):
         """
@@ -11,7 +11,10 @@ import shutil
 from distutils.version import LooseVersion
 
 import nibabel
-from sklearn.externals.joblib import Memory
+try:
+    from sklearn.externals.joblib import Memory
+except ImportError:
+    from joblib import Memory
 
 MEMORY_CLASSES = (Memory, )
 
@@ -21,18 +24,35 @@ try:
 except ImportError:
     pass
 
-import nilearn
+import boyle
 
 from .compat import _basestring
 
 __CACHE_CHECKED = dict()
 
 
+def _get_memory_location(memory):
+    """Return the cache directory of `memory`: its `location` in joblib >= 0.12,
+    its `cachedir` in older versions."""
+    location = getattr(memory, 'location', None)
+    if location is None:
+        location = getattr(memory, 'cachedir', None)
+    return location
+
+
+def _make_memory(location, verbose=0):
+    """Return a joblib.Memory with the cache directory `location`, for new and old joblib versions."""
+    try:
+        return Memory(location=location, verbose=verbose)
+    except TypeError:
+        return Memory(cachedir=location, verbose=verbose)
+
+
 def _safe_cache(memory, func, **kwargs):
     """ A wrapper for mem.cache that flushes the cache if the version
         number of nibabel has changed.
     """
-    cachedir = memory.cachedir
+    cachedir = _get_memory_location(memory)
 
     if cachedir is None or cachedir in __CACHE_CHECKED:
         return memory.cache(func, **kwargs)
@@ -53,10 +73,10 @@ def _safe_cache(memory, func, **kwargs):
 
     # Flush cache if version collision
     if len(collisions) > 0:
-        if nilearn.CHECK_CACHE_VERSION:
+        if boyle.CHECK_CACHE_VERSION:
             warnings.warn("Incompatible cache in %s: "
                           "different version of nibabel. Deleting "
-                          "the cache. Put nilearn.CHECK_CACHE_VERSION "
+                          "the cache. Put boyle.CHECK_CACHE_VERSION "
                           "to false to avoid this behavior."
                           % cachedir)
             try:
@@ -142,12 +162,12 @@ def cache(func, memory, func_memory_level=None, memory_level=None,
     if memory is not None and (func_memory_level is None or
                                memory_level >= func_memory_level):
         if isinstance(memory, _basestring):
-            memory = Memory(cachedir=memory, verbose=verbose)
+            memory = _make_memory(memory, verbose=verbose)
         if not isinstance(memory, MEMORY_CLASSES):
             raise TypeError("'memory' argument must be a string or a "
                             "joblib.Memory object. "
                             "%s %s was given." % (memory, type(memory)))
-        if (memory.cachedir is None and memory_level is not None
+        if (_get_memory_location(memory) is None and memory_level is not None
                 and memory_level > 1):
             warnings.warn("Caching has been enabled (memory_level = %d) "
                           "but no Memory object or path has been provided"
@@ -156,7 +176,7 @@ def cache(func, memory, func_memory_level=None, memory_level=None,
                           (memory_level, func.__name__),
                           stacklevel=2)
     else:
-        memory = Memory(cachedir=None, verbose=verbose)
+        memory = _make_memory(None, verbose=verbose)
     return _safe_cache(memory, func, **kwargs)
 
 
@@ -205,15 +225,15 @@ class CacheMixin(object):
         if not hasattr(self, "memory_level"):
             self.memory_level = 0
         if not hasattr(self, "memory"):
-            self.memory = Memory(cachedir=None, verbose=verbose)
+            self.memory = _make_memory(None, verbose=verbose)
         if isinstance(self.memory, _basestring):
-            self.memory = Memory(cachedir=self.memory, verbose=verbose)
+            self.memory = _make_memory(self.memory, verbose=verbose)
 
         # If cache level is 0 but a memory object has been provided, set
         # memory_level to 1 with a warning.
         if self.memory_level == 0:
             if (isinstance(self.memory, _basestring)
-                    or self.memory.cachedir is not None):
+                    or _get_memory_location(self.memory) is not None):
                 warnings.warn("memory_level is currently set to 0 but "
                               "a Memory object has been provided. "
                               "Setting memory_level to 1.")
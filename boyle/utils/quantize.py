@@ -0,0 +1,201 @@
+# coding=utf-8
+"""
+Linear quantization of float arrays into small integer types, as done in Nifti files
+with the scl_slope and scl_inter header fields: value = stored * slope + inter.
+"""
+# ------------------------------------------------------------------------------
+# Author: Alexandre Manhaes Savio <alexsavio@gmail.com>
+#
+# 2016, Alexandre Manhaes Savio
+# Use this at your own risk!
+# ------------------------------------------------------------------------------
+
+import numpy as np
+
+
+# number of values quantized at a time, to limit the size of the float temporaries
+_CHUNK_SIZE = 2 ** 22
+
+
+def get_value_range(arr, axis=None):
+    """Return the minimum and maximum of `arr`, ignoring NaNs, as quantize_array uses them.
+
+    Parameters
+    ----------
+    arr: numpy.ndarray
+
+    axis: int
+        Axis along which the range is computed for each index. If None, the range of the whole array.
+
+    Returns
+    -------
+    vmin, vmax: numpy.ndarray of float64
+        With the same number of dimensions as `arr`. 0 where there are only NaNs.
+    """
+    arr = np.asarray(arr)
+    if axis is None:
+        reduce_axes = tuple(range(arr.ndim))
+    else:
+        axis = axis % arr.ndim
+        reduce_axes = tuple(ax for ax in range(arr.ndim) if ax != axis)
+
+    if not arr.size:
+        return np.zeros((1, ) * arr.ndim), np.zeros((1, ) * arr.ndim)
+
+    vmin = np.nanmin(arr, axis=reduce_axes, keepdims=True).astype(np.float64)
+    vmax = np.nanmax(arr, axis=reduce_axes, keepdims=True).astype(np.float64)
+    vmin[~np.isfinite(vmin)] = 0
+    vmax[~np.isfinite(vmax)] = 0
+    return vmin, vmax
+
+
+def quantize_array(arr, dtype='int16', axis=None, vmin=None, vmax=None, out=None):
+    """Return `arr` linearly scaled into the range of the integer `dtype`.
+
+    The array is quantized by chunks of its first axis, in float32 for float32 data and integer types
+    of up to 16 bits, so the only full size array created is the quantized one.
+
+    Parameters
+    ----------
+    arr: numpy.ndarray
+
+    dtype: numpy.dtype
+        Integer type of the quantized array.
+
+    axis: int
+        Axis along which the scale factors change, i.e., there will be one slope and
+        intercept for each index of this axis.
+        If None, there will be one slope and intercept for the whole array.
+
+    vmin, vmax: numpy.ndarray
+        Range of the values to quantize, with the same number of dimensions as `arr` and
+        broadcastable to its shape.
+        If None, will use get_value_range(arr, axis). The values out of the range are clipped.
+
+    out: numpy.ndarray
+        Array of type `dtype` with the shape of `arr` where the quantized values are written.
+
+    Returns
+    -------
+    qarr, slope, inter
+        qarr: numpy.ndarray of type `dtype`
+            NaN values are stored as the minimum of their slice.
+
+        slope, inter: numpy.ndarray of float64
+            With the same number of dimensions as `arr`, so they broadcast against it.
+            arr ~= qarr * slope + inter
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind not in 'iu':
+        raise ValueError('Expected an integer dtype for quantization, got {}.'.format(dtype))
+
+    arr = np.asarray(arr)
+    if vmin is None or vmax is None:
+        vmin, vmax = get_value_range(arr, axis=axis)
+
+    info  = np.iinfo(dtype)
+    vmin  = np.asarray(vmin, dtype=np.float64)
+    slope = (np.asarray(vmax, dtype=np.float64) - vmin) / (float(info.max) - float(info.min))
+    slope[slope == 0] = 1
+    inter = vmin - info.min * slope
+
+    if out is None:
+        out = np.empty(arr.shape, dtype=dtype)
+    elif out.shape != arr.shape or out.dtype != dtype:
+        raise ValueError('Expected `out` of shape {} and type {}, got {} and {}.'.format(arr.shape, dtype,
+                                                                                       out.shape, out.dtype))
+
+    if arr.ndim == 0:
+        chunks = [Ellipsis]
+    else:
+        step   = max(1, _CHUNK_SIZE // max(1, arr[0].size))
+        chunks = [slice(start, start + step) for start in range(0, arr.shape[0], step)]
+
+    # float32 represents exactly all the integers of up to 16 bits, float64 data is not downcast
+    work_dtype = np.result_type(arr.dtype, np.float32) if dtype.itemsize <= 2 else np.float64
+    for chunk in chunks:
+        # the scale factors change along the first axis or are the same for all its indices
+        cmin   = (vmin[chunk] if vmin.ndim and vmin.shape[0] > 1 else vmin).astype(work_dtype)
+        cslope = slope[chunk] if slope.ndim and slope.shape[0] > 1 else slope
+
+        qchunk = np.subtract(arr[chunk], cmin, dtype=work_dtype)
+        np.divide(qchunk, cslope, out=qchunk, casting='same_kind')
+        np.rint(qchunk, out=qchunk)
+        qchunk += info.min
+        qchunk[np.isnan(qchunk)] = info.min
+        np.clip(qchunk, info.min, info.max, out=qchunk)
+        out[chunk] = qchunk
+
+    return out, slope, inter
+
+
+class QuantizedArray(object):
+    """A quantized array which is dequantized lazily, only the indexed part at a time.
+
+    Parameters
+    ----------
+    data: numpy.ndarray or h5py.Dataset
+        Integer array with the quantized values.
+
+    slope: numpy.ndarray
+        Scale factors, broadcastable to the shape of `data`.
+
+    inter: numpy.ndarray
+        Offsets, broadcastable to the shape of `data`.
+
+    dtype: numpy.dtype
+        Float type of the dequantized values.
+
+    Examples
+    --------
+    >>> qmat = QuantizedArray.from_array(outmat, 'int16', axis=0)
+    >>> qmat[10]  # the 11th row as float32
+    """
+    def __init__(self, data, slope, inter, dtype=np.float32):
+        self.data  = data
+        self.slope = np.asarray(slope)
+        self.inter = np.asarray(inter)
+        self.dtype = np.dtype(dtype)
+
+    @classmethod
+    def from_array(cls, arr, dtype='int16', axis=None, outdtype=None):
+        """Return a QuantizedArray of `arr`. See quantize_array.
+        If `outdtype` is None, will use the dtype of `arr` as float type for the dequantized values."""
+        arr = np.asarray(arr)
+        if outdtype is None:
+            outdtype = arr.dtype if arr.dtype.kind == 'f' else np.float32
+        data, slope, inter = quantize_array(arr, dtype=dtype, axis=axis)
+        return cls(data, slope, inter, dtype=outdtype)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def ndim(self):
+        return len(self.data.shape)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.slope.nbytes + self.inter.nbytes
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, item):
+        slope = np.broadcast_to(self.slope, self.shape)[item]
+        inter = np.broadcast_to(self.inter, self.shape)[item]
+        return (self.data[item] * slope + inter).astype(self.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[...]
+        if dtype is not None:
+            arr = arr.astype(dtype)
+        return arr
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __repr__(self):
+        return '<QuantizedArray shape={} dtype={} stored as {}>'.format(self.shape, self.dtype, self.data.dtype)
@@ -0,0 +1,17 @@
+"""
+Configuration of the tests.
+
+The log files of boyle are written to a temporary directory instead of the current one.
+This is done here, before boyle is imported by the test modules and sets up the logging.
+"""
+import os
+import tempfile
+import os.path as op
+
+_log_dir = tempfile.mkdtemp(prefix='boyle_test_logs_')
+_log_cfg = op.join(_log_dir, 'logger.yml')
+
+with open(op.join(op.dirname(__file__), '..', 'boyle', 'utils', 'logger.yml')) as src, open(_log_cfg, 'w') as dst:
+    dst.write(src.read().replace('filename: {0}_', 'filename: ' + op.join(_log_dir, '{0}_')))
+
+os.environ.setdefault('BOYLE_LOG_CFG', _log_cfg)
@@ -0,0 +1,74 @@
+"""
+Test the cache module
+"""
+import os
+
+import numpy   as np
+import nibabel as nib
+
+from boyle.nifti.cache import NiftiCache, set_nifti_cache
+from boyle.nifti.check import check_img, check_imgs_compatibility
+from boyle.nifti.read  import niftilist_to_array
+from boyle.nifti.sets  import _get_img_key
+
+
+def test_nifti_cache_load(tmpdir):
+    """ Check that an image read from the cache keeps the name of its source file and its data
+    after its cached copy is evicted.
+    """
+    data      = np.random.RandomState(0).rand(6, 7, 8).astype(np.float32)
+    file_path = str(tmpdir.join('subj.nii.gz'))
+    nib.save(nib.Nifti1Image(data, np.eye(4)), file_path)
+
+    cache = NiftiCache(str(tmpdir.join('cache')))
+    img   = cache.load(file_path)
+    assert img.get_filename() == file_path
+    assert os.path.exists(cache.get_cache_path(file_path))
+
+    cache.clear()
+    np.testing.assert_equal(np.asarray(img.dataobj), data)
+
+    try:
+        set_nifti_cache(str(tmpdir.join('cache')))
+        assert _get_img_key(check_img(file_path)) == os.path.abspath(file_path)
+    finally:
+        set_nifti_cache(None)
+
+
+def test_nifti_cache_load_scaled(tmpdir):
+    """ Check that an image with scale factors read from the cache keeps its class
+    and reads its data lazily from the cached copy.
+    """
+    data      = np.arange(6 * 7 * 8, dtype=np.int16).reshape((6, 7, 8))
+    file_path = str(tmpdir.join('subj.nii.gz'))
+    img       = nib.Nifti2Image(data, np.eye(4))
+    img.header.set_slope_inter(0.5, 10)
+    nib.save(img, file_path)
+
+    cache = NiftiCache(str(tmpdir.join('cache')))
+    img   = cache.load(file_path)
+    assert isinstance(img, nib.Nifti2Image)
+    assert not isinstance(img.dataobj, np.ndarray)
+
+    cache.clear()
+    np.testing.assert_equal(np.asarray(img.dataobj), data * 0.5 + 10)
+
+
+def test_nifti_cache_header_only(tmpdir):
+    """ Check that the files whose headers are checked are not copied into the cache,
+    and the files whose data is read are.
+    """
+    files = []
+    for idx in range(2):
+        files.append(str(tmpdir.join('subj{}.nii.gz'.format(idx))))
+        nib.save(nib.Nifti1Image(np.zeros((6, 7, 8), dtype=np.float32), np.eye(4)), files[-1])
+
+    try:
+        cache = set_nifti_cache(str(tmpdir.join('cache')))
+        check_imgs_compatibility(files)
+        assert cache.size == 0
+
+        niftilist_to_array(files)
+        assert len(os.listdir(cache.cache_dir)) == len(files)
+    finally:
+        set_nifti_cache(None)
@@ -0,0 +1,86 @@
+"""
+Test the header_index module
+"""
+import os
+
+import numpy   as np
+import nibabel as nib
+import pytest
+
+from boyle.exceptions         import NiftiFilesNotCompatible
+from boyle.nifti.header_index import HeaderIndex
+
+
+@pytest.fixture
+def img_files(tmpdir):
+    """Return the paths of 3 image files with the same shape and affine."""
+    files = []
+    for idx in range(3):
+        files.append(str(tmpdir.join('img{}.nii.gz'.format(idx))))
+        nib.save(nib.Nifti1Image(np.zeros((6, 7, 8), dtype=np.float32), np.eye(4)), files[-1])
+    return files
+
+
+def _count_reads(monkeypatch):
+    """Count the files whose header is read by HeaderIndex."""
+    reads = []
+    read_header = HeaderIndex._read_header
+
+    def counted(file_path, stat):
+        reads.append(file_path)
+        return read_header(file_path, stat)
+
+    monkeypatch.setattr(HeaderIndex, '_read_header', staticmethod(counted))
+    return reads
+
+
+def test_get_headers(img_files, tmpdir, monkeypatch):
+    """ Check that the headers are read again only for the files changed since they were indexed.
+    """
+    reads = _count_reads(monkeypatch)
+    index = HeaderIndex(str(tmpdir.join('headers.db')))
+
+    headers = index.get_headers(img_files)
+    assert len(reads) == len(img_files)
+    assert [hdr['path'] for hdr in headers] == [os.path.abspath(fp) for fp in img_files]
+    assert headers[0]['shape'] == (6, 7, 8)
+    np.testing.assert_equal(headers[0]['affine'], np.eye(4))
+
+    index.get_headers(img_files)
+    assert len(reads) == len(img_files)
+    index.close()
+
+    nib.save(nib.Nifti1Image(np.zeros((6, 7, 9), dtype=np.int16), np.eye(4)), img_files[1])
+    stat = os.stat(img_files[1])
+    os.utime(img_files[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    # the index is stored in its database file
+    index   = HeaderIndex(str(tmpdir.join('headers.db')))
+    headers = index.get_headers(img_files)
+    assert reads[len(img_files):] == [os.path.abspath(img_files[1])]
+    assert headers[1]['shape'] == (6, 7, 9)
+    assert headers[1]['dtype'] == np.int16
+    index.close()
+
+
+def test_check_compatibility(img_files, tmpdir):
+    """ Check that the files with a different affine matrix are not compatible,
+    unless only the shapes are checked.
+    """
+    affine = np.eye(4)
+    affine[0, 3] = 10
+    other_file = str(tmpdir.join('other.nii.gz'))
+    nib.save(nib.Nifti1Image(np.zeros((6, 7, 8), dtype=np.float32), affine), other_file)
+
+    index = HeaderIndex(':memory:')
+    assert len(index.check_compatibility(img_files)) == len(img_files)
+
+    with pytest.raises(NiftiFilesNotCompatible):
+        index.check_compatibility(img_files + [other_file])
+
+    with pytest.raises(NiftiFilesNotCompatible):
+        index.check_compatibility(img_files, ref_img=other_file)
+
+    assert len(index.check_compatibility(img_files + [other_file], check_affine=False)) == len(img_files) + 1
+    assert len(index.check_compatibility(img_files + [other_file], only_check_3d=True)) == len(img_files) + 1
+    index.close()
@@ -2,18 +2,21 @@
 import numpy   as np
 import nibabel as nib
 import boyle
+import boyle.image.base
 from   boyle.nifti.read import read_img
 from   boyle.nifti.mask import load_mask, load_mask_data
 from   boyle.nifti.mask import apply_mask, apply_mask_4d
 from   boyle.nifti.mask import vector_to_volume, matrix_to_4dvolume
+from   boyle.nifti.mask import get_bounding_box
+from   boyle.nifti.mask import union_mask, combine_masks, CompactMask
 from   test_data import msk2path, msk3path, brain2path, img4dpath
 
-NI_CLASES = (nib.Nifti1Image, boyle.nifti.NeuroImage)
+NI_CLASES = (nib.Nifti1Image, boyle.image.base.MedicalImage)
 
 
 def test_load_mask_loads():
     mask     = load_mask(msk2path)
-    assert(isinstance(mask, boyle.nifti.NeuroImage))
+    assert(isinstance(mask, NI_CLASES))
 
 
 def test_load_mask_loads_boolean_volume():
@@ -55,4 +58,50 @@ def test_matrix_to_4dvolume():
     np.testing.assert_equal   (vol.shape, std.shape)
 
 
+def test_get_bounding_box():
+    mask = np.zeros((6, 7, 8), dtype=bool)
+    mask[1:3, 2:5, 4] = True
+    mask[4, 3, 5]     = True
 
+    box = get_bounding_box(mask)
+    assert(box == (slice(1, 5), slice(2, 5), slice(4, 6)))
+    np.testing.assert_equal(mask[box][mask[box]], mask[mask])
+
+    empty_box = get_bounding_box(np.zeros((3, 3, 3)))
+    assert(np.zeros((3, 3, 3))[empty_box].size == 0)
+
+
+def test_combine_masks():
+    rng   = np.random.RandomState(0)
+    masks = [(rng.rand(6, 7, 8) > 0.5) * rng.randint(1, 100) for _ in range(5)]
+    imgs  = [nib.Nifti1Image(mask.astype(np.uint8), np.eye(4)) for mask in masks]
+    count = np.sum([mask > 0 for mask in masks], axis=0)
+
+    np.testing.assert_equal(union_mask(imgs), count > 0)
+    np.testing.assert_equal(combine_masks(imgs, 'intersection'), count == 5)
+    np.testing.assert_equal(combine_masks(imgs, 'majority'), count >= 3)
+    np.testing.assert_equal(combine_masks(imgs, min_count=2), count >= 2)
+
+
+def test_compact_mask():
+    rng  = np.random.RandomState(0)
+    one  = rng.rand(6, 7, 8) > 0.5
+    two  = rng.rand(6, 7, 8) > 0.5
+    data = rng.rand(6, 7, 8, 3)
+
+    mask = CompactMask.from_array(one)
+    np.testing.assert_equal(mask.to_array(), one)
+    np.testing.assert_equal(mask.indices, np.where(one))
+    assert(mask == CompactMask.from_indices(np.where(one), one.shape))
+    assert(mask == CompactMask.from_runs(mask.runs, one.shape))
+
+    np.testing.assert_equal(mask.apply(data), data[one])
+    np.testing.assert_equal(mask.apply(np.asfortranarray(data)), data[one])
+    np.testing.assert_equal(mask.apply(data[..., ::2]), data[..., ::2][one])
+    np.testing.assert_equal(mask.unmask(data[one]), data * one[..., np.newaxis])
+
+    other = CompactMask.from_array(two)
+    np.testing.assert_equal((mask | other).to_array(), one | two)
+    np.testing.assert_equal((mask & other).to_array(), one & two)
+    np.testing.assert_equal((mask - other).to_array(), one & ~two)
+    np.testing.assert_equal((~mask).to_array(), ~one)
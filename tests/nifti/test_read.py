@@ -1,5 +1,11 @@
 
-from   boyle.nifti.read import read_img
+import pytest
+import numpy   as np
+import nibabel as nib
+
+from   boyle.nifti.read import read_img, niftilist_to_array, ImagePrefetcher
+from   boyle.nifti.read import build_gzip_index, get_img_data_box, get_img_volumes, GZIP_INDEX_EXT
+from   boyle.nifti.read import _load_indexed_gzip_img, _close_indexed_gzip_img
 from   test_data import msk2path
 
 
@@ -14,6 +20,60 @@ def test_read_img_reads_img():
     img = read_img(imgp)
     assert(img is not None)
 
+def test_image_prefetcher():
+    files = [msk2path, msk2path, msk2path]
+    prefetcher = ImagePrefetcher(files, n_prefetch=2, max_memory=1)
+
+    assert(len(prefetcher) == 3)
+    assert(prefetcher[0] == msk2path)
+    assert(all(img.in_memory for img in prefetcher))
+
+    outmat, vol_shape = niftilist_to_array(prefetcher)
+    assert(np.array_equal(outmat, niftilist_to_array(files)[0]))
+
+
+def test_niftilist_to_array(tmpdir):
+    rng   = np.random.RandomState(0)
+    vols  = [rng.rand(6, 7, 8).astype(np.float32) for _ in range(3)]
+    files = [str(tmpdir.join('vol{}.nii.gz'.format(idx))) for idx in range(3)]
+    for vol, img_path in zip(vols, files):
+        nib.save(nib.Nifti1Image(vol, np.eye(4)), img_path)
+
+    outmat, vol_shape = niftilist_to_array(files)
+    assert(vol_shape == (6, 7, 8))
+    assert(outmat.dtype == np.float32)
+    assert(np.array_equal(outmat, np.array([vol.ravel() for vol in vols])))
+
+    outmat, _ = niftilist_to_array(files, outdtype=np.float64)
+    assert(outmat.dtype == np.float64)
+
+    other_path = str(tmpdir.join('other.nii.gz'))
+    nib.save(nib.Nifti1Image(vols[0][:5], np.eye(4)), other_path)
+    with pytest.raises(Exception):
+        niftilist_to_array(files + [other_path])
+
+
+def test_indexed_gzip(tmpdir):
+    pytest.importorskip('indexed_gzip')
+
+    img_path = str(tmpdir.join('vols.nii.gz'))
+    nib.save(nib.Nifti1Image(np.random.RandomState(0).rand(6, 7, 8, 5).astype(np.float32), np.eye(4)), img_path)
+    expected = nib.load(img_path).get_fdata(dtype=np.float32)
+
+    index_file = build_gzip_index(img_path)
+    img = _load_indexed_gzip_img(img_path, build_index=False)
+    assert(img is not None)
+    try:
+        box = (slice(1, 4), slice(2, 6), slice(0, 8), slice(2, 4))
+        assert(np.array_equal(get_img_data_box(img, box), expected[box]))
+    finally:
+        _close_indexed_gzip_img(img)
+    assert(img.file_map['image'].fileobj.closed)
+
+    assert(index_file == img_path + GZIP_INDEX_EXT)
+    assert(np.array_equal(get_img_volumes(img_path, 1, 3), expected[..., 1:3]))
+
+
 def test_read_img_raises():
     #imgpath = op.join(os.environ['FSLDIR'], 'data/standard/MNI152_T1_2mm_brain_mask')
     #assert_raises(read_img(imgpath))
@@ -1,11 +1,16 @@
 """
 Test the ndimage module
 """
+import os.path as op
+
 import pytest
 
-import numpy as np
+import numpy   as np
+import nibabel as nib
 
-from boyle.nifti.roi import largest_connected_component
+from boyle.nifti.roi import (largest_connected_component, _extract_timeseries_list, _partition_data, _isin_values,
+                             ROISummarizer, drain_rois, large_clusters_mask, pick_rois, AtlasIndex,
+                             get_rois_centers_of_mass, partition_timeseries, partition_timeseries_many)
 
 
 def test_largest_cc():
@@ -18,3 +23,173 @@ def test_largest_cc():
     b = a.copy()
     b[5, 5, 5] = 1
     np.testing.assert_equal(a, largest_connected_component(b))
+
+
+def test_extract_timeseries_list():
+    """ Check that the timeseries of all the ROIs are the same as extracted one by one.
+    """
+    rng  = np.random.RandomState(0)
+    rois = rng.randint(0, 5, (6, 7, 8))
+    ts   = rng.rand(6, 7, 8, 4)
+    ts[rois == 2] = 0
+    mask = rng.rand(6, 7, 8) > 0.3
+
+    for maskvol in (None, mask):
+        ts_list = _extract_timeseries_list(ts, rois, maskvol, roi_values=[4, 2, 1])
+        assert len(ts_list) == 3
+        np.testing.assert_equal(ts_list[0], _partition_data(ts, rois, 4, maskvol))
+        np.testing.assert_equal(ts_list[1], np.zeros(4))
+        np.testing.assert_equal(ts_list[2], _partition_data(ts, rois, 1, maskvol))
+
+
+def test_roi_summarizer():
+    """ Check the mean and median timeseries of the ROIs of many images.
+    """
+    rng  = np.random.RandomState(0)
+    rois = rng.randint(0, 5, (6, 7, 8)).astype(np.int16)
+    imgs = [nib.Nifti1Image(rng.rand(6, 7, 8, 4), np.eye(4)) for _ in range(3)]
+    imgs[0].get_data()[rois == 2] = 0
+
+    for strategy, func in (('mean', np.mean), ('median', np.median)):
+        summarizer = ROISummarizer(nib.Nifti1Image(rois, np.eye(4)), roi_values=[4, 2, 1], strategy=strategy)
+        summaries  = summarizer.transform_many(imgs, n_jobs=2)
+        assert summaries.shape == (3, 3, 4)
+
+        for img, summary in zip(imgs, summaries):
+            np.testing.assert_allclose(summary[0], func(_partition_data(img.get_data(), rois, 4), axis=0))
+            np.testing.assert_allclose(summary[2], func(_partition_data(img.get_data(), rois, 1), axis=0))
+
+        np.testing.assert_equal(summaries[0, 1], np.zeros(4))
+
+
+def test_roi_summarizer_zeroe():
+    """ Check that the mean of each ROI excludes the null timeseries voxels as partition_timeseries does,
+    also when their values are not all zero.
+    """
+    rng  = np.random.RandomState(0)
+    rois = rng.randint(0, 5, (6, 7, 8)).astype(np.int16)
+    data = rng.rand(6, 7, 8, 4)
+    null = (rois == 4) & (rng.rand(6, 7, 8) > 0.5)
+    data[null] = [1, -1, 2, -2]
+    img      = nib.Nifti1Image(data, np.eye(4))
+    rois_img = nib.Nifti1Image(rois, np.eye(4))
+
+    summarizer = ROISummarizer(rois_img, roi_values=[4, 2, 1], zeroe=True)
+    summary    = summarizer.transform(img)
+    expected   = partition_timeseries(img, rois_img, zeroe=True, roi_values=[4, 2, 1], outdict=True)
+
+    for roi_idx, roi_value in enumerate([4, 2, 1]):
+        np.testing.assert_allclose(summary[roi_idx], np.mean(expected[roi_value], axis=0))
+
+
+def test_isin_values():
+    """ Check the lookup table of _isin_values against np.isin for integer and boolean arrays.
+    """
+    rng = np.random.RandomState(0)
+    for arr in (rng.randint(0, 10, (6, 7)), rng.randint(-5, 5, (6, 7)).astype(np.int16),
+                rng.randint(0, 255, (6, 7)).astype(np.uint8), rng.rand(6, 7) > 0.5):
+        for values in ([1, 3, 4], [0], [True], [1.5, 2, 300]):
+            np.testing.assert_equal(_isin_values(arr, values), np.isin(arr, values))
+
+
+def test_drain_rois():
+    """ Check that only the border voxels of the ROIs are kept.
+    """
+    a = np.zeros((7, 7, 7), dtype=np.int16)
+    a[1:6, 1:6, 1:6] = 1
+    a[1:6, 1:6, 6]   = 2
+
+    drained  = drain_rois(nib.Nifti1Image(a, np.eye(4)))
+    expected = a.copy()
+    expected[2:5, 2:5, 2:5] = 0
+    np.testing.assert_equal(drained, expected)
+
+
+def test_large_clusters_mask():
+    """ Check that only the connected components with at least the minimum size are kept.
+    """
+    a = np.zeros((8, 8, 8))
+    a[0:2, 0:2, 0:2] = 1
+    a[4:7, 4:7, 4:7] = 1
+    a[7, 0, 7]       = 1
+
+    expected = np.zeros((8, 8, 8), dtype=int)
+    expected[4:7, 4:7, 4:7] = 1
+    np.testing.assert_equal(large_clusters_mask(a, 9), expected)
+
+    expected[0:2, 0:2, 0:2] = 1
+    np.testing.assert_equal(large_clusters_mask(a, 2), expected)
+
+
+def test_pick_rois():
+    """ Check that only the given ROI values are kept.
+    """
+    a = np.arange(4 * 5 * 6, dtype=np.int16).reshape((4, 5, 6)) % 7
+    picked = pick_rois(nib.Nifti1Image(a, np.eye(4)), [2, 5, 9]).get_data()
+    np.testing.assert_equal(picked, np.where(np.isin(a, [2, 5]), a, 0))
+
+
+def test_atlas_index(tmpdir):
+    """ Check that an AtlasIndex, also read from its sidecar file, gives the same ROIs as its atlas.
+    """
+    rng  = np.random.RandomState(0)
+    rois = rng.randint(0, 5, (6, 7, 8)).astype(np.int16)
+    rois[rois == 3] = 0
+    ts   = rng.rand(6, 7, 8, 4)
+    mask = rng.rand(6, 7, 8) > 0.3
+
+    atlas_file = str(tmpdir.join('atlas.nii.gz'))
+    nib.save(nib.Nifti1Image(rois, np.eye(4)), atlas_file)
+
+    atlas_index = AtlasIndex.for_file(atlas_file)
+    assert op.exists(atlas_file + '.atlasidx.npz')
+
+    atlas_index = AtlasIndex.for_file(atlas_file)
+    np.testing.assert_equal(atlas_index.roi_values, [1, 2, 4])
+    np.testing.assert_equal(atlas_index.get_data(), rois)
+    np.testing.assert_equal(atlas_index.bboxes[2], [[0, 6], [0, 7], [0, 8]])
+
+    centers = get_rois_centers_of_mass(rois)
+    for roi_value, center in get_rois_centers_of_mass(atlas_index).items():
+        np.testing.assert_allclose(center, centers[roi_value])
+
+    for maskvol in (None, mask):
+        ts_list = _extract_timeseries_list(ts, atlas_index, maskvol, roi_values=[4, 3, 1])
+        np.testing.assert_equal(ts_list[0], _partition_data(ts, rois, 4, maskvol))
+        np.testing.assert_equal(ts_list[1], np.zeros(4))
+        np.testing.assert_equal(ts_list[2], _partition_data(ts, rois, 1, maskvol))
+
+
+def test_partition_timeseries_many(tmpdir):
+    """ Check that the ROI timeseries of many images are the same as partitioned one by one,
+    and that the images which can not be partitioned are reported.
+    """
+    h5py = pytest.importorskip('h5py')
+
+    rng  = np.random.RandomState(0)
+    rois = rng.randint(0, 5, (6, 7, 8)).astype(np.int16)
+    roi_file = str(tmpdir.join('rois.nii.gz'))
+    nib.save(nib.Nifti1Image(rois, np.eye(4)), roi_file)
+
+    # the files are read in Fortran order, the last image is in memory in C order
+    files = []
+    for idx, (shape, zoom) in enumerate([((6, 7, 8, 4), 1), ((5, 7, 8, 4), 1), ((6, 7, 8, 4), 1),
+                                         ((6, 7, 8, 4), 2)]):
+        files.append(str(tmpdir.join('img{}.nii.gz'.format(idx))))
+        nib.save(nib.Nifti1Image(rng.rand(*shape), np.diag([zoom, zoom, zoom, 1])), files[-1])
+    images = files + [nib.Nifti1Image(np.ascontiguousarray(rng.rand(6, 7, 8, 4)), np.eye(4))]
+
+    with pytest.raises(Exception):
+        partition_timeseries(files[3], roi_file, roi_values=[4, 1])
+
+    output_file = str(tmpdir.join('rois.h5'))
+    errors = partition_timeseries_many(images, roi_file, output_file, roi_values=[4, 1], n_jobs=2)
+    assert list(errors) == [1, 3]
+
+    with h5py.File(output_file, 'r') as h5file:
+        np.testing.assert_equal(h5file['failed'][()], [1, 3])
+        assert '1' not in h5file['timeseries']
+        for idx in (0, 2, 4):
+            ts_list = partition_timeseries(images[idx], roi_file, roi_values=[4, 1])
+            np.testing.assert_equal(h5file['timeseries/{}/4'.format(idx)][()], ts_list[0])
+            np.testing.assert_equal(h5file['timeseries/{}/1'.format(idx)][()], ts_list[1])
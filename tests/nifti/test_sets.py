@@ -0,0 +1,223 @@
+"""
+Test the sets module
+"""
+import os
+
+import numpy   as np
+import nibabel as nib
+import pytest
+
+from boyle.nifti import sets
+from boyle.nifti.sets import NeuroImageSet
+
+
+@pytest.fixture
+def subject_files(tmpdir):
+    """Return the paths of 4 random subject files and of a mask file."""
+    rng   = np.random.RandomState(0)
+    files = []
+    for idx in range(4):
+        files.append(str(tmpdir.join('subj{}.nii.gz'.format(idx))))
+        nib.save(nib.Nifti1Image(rng.rand(6, 7, 8).astype(np.float32), np.eye(4)), files[-1])
+
+    mask = np.zeros((6, 7, 8), dtype=np.uint8)
+    mask[1:4, 2:6, 3:7] = 1
+    mask_file = str(tmpdir.join('mask.nii.gz'))
+    nib.save(nib.Nifti1Image(mask, np.eye(4)), mask_file)
+
+    return files, mask_file
+
+
+def _count_flattened(monkeypatch):
+    """Count the calls to sets._flatten_img, i.e., the subject files read to build a matrix."""
+    calls = []
+    flatten_img = sets._flatten_img
+
+    def counted(*args, **kwargs):
+        calls.append(args[0])
+        return flatten_img(*args, **kwargs)
+
+    monkeypatch.setattr(sets, '_flatten_img', counted)
+    return calls
+
+
+def test_to_matrix_memory(subject_files, tmpdir, monkeypatch):
+    """ Check that the data matrix of a set built with a memory is read from the cache the second time.
+    """
+    from joblib import Memory
+
+    files, mask_file = subject_files
+    calls  = _count_flattened(monkeypatch)
+    memory = Memory(str(tmpdir.join('cache')), verbose=0)
+
+    outmat, _, _ = NeuroImageSet(files, mask=mask_file, labels=[0, 1, 0, 1], memory=memory).to_matrix()
+    assert len(calls) == len(files)
+
+    cached, _, _ = NeuroImageSet(files, mask=mask_file, labels=[0, 1, 0, 1], memory=memory).to_matrix()
+    assert len(calls) == len(files)
+    np.testing.assert_equal(cached, outmat)
+
+
+def test_to_matrix_incremental(subject_files, monkeypatch):
+    """ Check that to_matrix only reads the subjects appended after the last call.
+    """
+    files, mask_file = subject_files
+    calls = _count_flattened(monkeypatch)
+
+    imgset = NeuroImageSet(files[:3], mask=mask_file, labels=[0, 1, 0])
+    imgset.to_matrix()
+    assert len(calls) == 3
+
+    imgset.append_image(files[3], label=1)
+    outmat, _, _ = imgset.to_matrix()
+    assert len(calls) == 4
+
+    imgset.remove_image(1)
+    removed, _, _ = imgset.to_matrix()
+    assert len(calls) == 4
+
+    expected, _, _ = NeuroImageSet([files[0], files[2], files[3]], mask=mask_file, labels=[0, 0, 1]).to_matrix()
+    np.testing.assert_equal(removed, expected)
+    np.testing.assert_equal(removed, outmat[[0, 2, 3]])
+
+
+def test_to_matrix_incremental_modified(subject_files, monkeypatch):
+    """ Check that to_matrix reads again the files rewritten after the last call,
+    and that the changes made by the caller to the returned matrix are not reused.
+    """
+    files, mask_file = subject_files
+    calls = _count_flattened(monkeypatch)
+
+    imgset = NeuroImageSet(files, mask=mask_file, labels=[0, 1, 0, 1])
+    outmat, _, _ = imgset.to_matrix()
+    outmat[:] = -1
+
+    data = np.random.RandomState(1).rand(6, 7, 8).astype(np.float32)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), files[1])
+    stat = os.stat(files[1])
+    os.utime(files[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    updated, _, _ = imgset.to_matrix()
+    assert len(calls) == len(files) + 1
+
+    expected, _, _ = NeuroImageSet(files, mask=mask_file, labels=[0, 1, 0, 1]).to_matrix()
+    np.testing.assert_equal(updated, expected)
+
+
+def test_to_file_update(subject_files, tmpdir, monkeypatch):
+    """ Check that to_file with update=True after appending and removing subjects only reads
+    the new subjects and leaves the labels in sync with the rows of the file.
+    """
+    h5py = pytest.importorskip('h5py')
+
+    files, mask_file = subject_files
+    output_file = str(tmpdir.join('subjects.h5'))
+
+    imgset = NeuroImageSet(files[:3], mask=mask_file, labels=[0, 1, 0])
+    imgset.to_file(output_file)
+
+    calls = _count_flattened(monkeypatch)
+    imgset.append_image(files[3], label=1)
+    imgset.to_file(output_file, update=True)
+    assert len(calls) == 1
+
+    imgset.remove_image(0)
+    imgset.to_file(output_file, update=True)
+    assert len(calls) == 1
+
+    expected, _, _ = NeuroImageSet(files[1:], mask=mask_file, labels=[1, 0, 1]).to_matrix()
+    with h5py.File(output_file, 'r') as h5file:
+        np.testing.assert_equal(h5file['labels'][()], [1, 0, 1])
+        assert len(h5file['row_keys']) == 3
+        np.testing.assert_equal(h5file['data'][()], expected)
+
+
+def test_to_matrix_quantize(subject_files):
+    """ Check the quantized data matrices against the float one.
+    """
+    files, mask_file = subject_files
+    imgset = NeuroImageSet(files, mask=mask_file, labels=[0, 1, 0, 1])
+    outmat, mask_indices, _ = imgset.to_matrix()
+
+    for quantize, axis in (('subject', 0), ('voxel', 1)):
+        qmat, qindices, _ = NeuroImageSet(files, mask=mask_file, labels=[0, 1, 0, 1]).to_matrix(quantize=quantize)
+        assert qmat.data.dtype == np.int16
+        assert qmat.slope.shape[axis] == outmat.shape[axis]
+        np.testing.assert_equal(qindices, mask_indices)
+        assert np.all(np.abs(qmat.data * qmat.slope + qmat.inter - outmat) <= qmat.slope * (0.5 + 2 ** -7))
+
+
+@pytest.mark.parametrize('smooth_fwhm', [0, 4])
+@pytest.mark.parametrize('with_mask', [True, False])
+def test_to_matrix_parallel(subject_files, smooth_fwhm, with_mask):
+    """ Check that the data matrix built by worker processes is the same as the one built serially.
+    """
+    files, mask_file = subject_files
+    mask = mask_file if with_mask else None
+
+    serial_set     = NeuroImageSet(files, mask=mask, labels=[0, 1, 0, 1])
+    parallel_set   = NeuroImageSet(files, mask=mask, labels=[0, 1, 0, 1])
+    serial, _, _   = serial_set.to_matrix(smooth_fwhm, n_jobs=1)
+    parallel, _, _ = parallel_set.to_matrix(smooth_fwhm, n_jobs=2)
+    assert serial.shape == (len(files), 6 * 7 * 8 if mask is None else 3 * 4 * 4)
+    np.testing.assert_array_equal(parallel, serial)
+    np.testing.assert_array_equal(parallel_set.labels, serial_set.labels)
+
+
+@pytest.mark.parametrize('smooth_fwhm', [0, 4])
+@pytest.mark.parametrize('with_mask', [True, False])
+def test_to_matrix_prefetcher(subject_files, monkeypatch, smooth_fwhm, with_mask):
+    """ Check that the subjects of a set built from an ImagePrefetcher are read by it,
+    with and without smoothing and mask, and give the same data matrix.
+    """
+    from boyle.nifti.read import ImagePrefetcher
+
+    files, mask_file = subject_files
+    mask = mask_file if with_mask else None
+    expected, _, _ = NeuroImageSet(files, mask=mask, labels=[0, 1, 0, 1]).to_matrix(smooth_fwhm)
+
+    calls = _count_flattened(monkeypatch)
+    imgset = NeuroImageSet(ImagePrefetcher(files, n_prefetch=2), mask=mask, labels=[0, 1, 0, 1])
+    outmat, _, _ = imgset.to_matrix(smooth_fwhm)
+    assert len(calls) == len(files)
+    assert not any(isinstance(image, str) for image in calls)
+    np.testing.assert_array_equal(outmat, expected)
+    np.testing.assert_array_equal(imgset.labels, [0, 1, 0, 1])
+
+
+def test_to_matrix_parallel_empty_mask(subject_files, tmpdir):
+    """ Check that the parallel data matrix of a set with an empty mask has no columns.
+    """
+    files, _ = subject_files
+    mask_file = str(tmpdir.join('empty_mask.nii.gz'))
+    nib.save(nib.Nifti1Image(np.zeros((6, 7, 8), dtype=np.uint8), np.eye(4)), mask_file)
+
+    for n_jobs in (1, 2):
+        outmat, _, _ = NeuroImageSet(files, mask=mask_file, labels=[0, 1, 0, 1]).to_matrix(n_jobs=n_jobs)
+        assert outmat.shape == (len(files), 0)
+
+
+def test_header_index(subject_files, tmpdir, monkeypatch):
+    """ Check that the subject files of a set checked with a header index are not opened
+    until their data is read, and give the same data matrix.
+    """
+    files, mask_file = subject_files
+    expected, _, _ = NeuroImageSet(files, mask=mask_file, labels=[0, 1, 0, 1]).to_matrix()
+
+    header_index = str(tmpdir.join('headers.db'))
+    NeuroImageSet(files, mask=mask_file, labels=[0, 1, 0, 1], header_index=header_index)
+
+    loads = []
+    load  = nib.load
+
+    def counted(file_path, *args, **kwargs):
+        loads.append(file_path)
+        return load(file_path, *args, **kwargs)
+
+    monkeypatch.setattr(nib, 'load', counted)
+    imgset = NeuroImageSet(files, mask=mask_file, labels=[0, 1, 0, 1], header_index=header_index)
+    assert loads == [mask_file]
+    assert imgset.items[0].shape == (6, 7, 8)
+
+    outmat, _, _ = imgset.to_matrix()
+    np.testing.assert_equal(outmat, expected)
@@ -0,0 +1,125 @@
+import numpy         as np
+import scipy.ndimage as ndimage
+
+from   boyle.nifti        import smooth
+from   boyle.nifti.smooth import _smooth_array, _smooth_data_array, _gaussian_filter_axes, _get_fft_kernel
+from   boyle.nifti.smooth import _prepare_smoothing_array, SmoothingBuffer
+
+
+def test_fast_smooth_keeps_uniform_arrays():
+    for shape in [(5, 6, 7), (1, 4, 3), (4, 3, 2, 3)]:
+        arr = np.ones(shape, dtype=np.float32)
+        smooth = _smooth_array(arr, None, fwhm='fast', copy=False)
+
+        assert(smooth is arr)
+        assert(np.allclose(smooth, 1))
+
+
+def test_fast_smooth_array():
+    arr = np.zeros((3, 3, 3))
+    arr[1, 1, 1] = 1
+    smooth = _smooth_array(arr, None, fwhm='fast')
+
+    assert(arr[1, 1, 1] == 1)
+    assert(np.isclose(smooth.sum(), (1 / 1.4 + 2 * 0.2 / 1.2) ** 3))
+    assert(np.isclose(smooth[1, 1, 1], 1 / 1.4 ** 3))
+    assert(np.isclose(smooth[0, 1, 1], 0.2 / 1.2 / 1.4 ** 2))
+
+
+def test_smooth_methods_are_equivalent():
+    arr    = np.random.RandomState(0).rand(12, 10, 8).astype(np.float32)
+    affine = np.diag([2, 3, 2, 1])
+    mask   = np.zeros(arr.shape, dtype=bool)
+    mask[4:7, 3:6, 2:5] = True
+
+    direct = _smooth_data_array(arr, affine, 6)
+    assert(np.allclose(direct, _smooth_data_array(arr, affine, 6, n_threads=3)))
+    assert(np.allclose(direct, _smooth_data_array(arr, affine, 6, method='fft'), atol=1e-5))
+    assert(np.array_equal(direct[mask], _smooth_data_array(arr, affine, 6, mask=mask)[mask]))
+
+
+def test_threaded_gaussian_filter():
+    rng = np.random.RandomState(0)
+    for shape in [(12, 10, 8), (9, 7, 5, 4), (3, 2, 2, 1)]:
+        arr   = rng.rand(*shape)
+        sigma = [1.5, 0.8, 2.]
+        expected = ndimage.gaussian_filter(arr, sigma + [0] * (arr.ndim - 3))
+
+        for n_threads in (1, 2, 3, 8):
+            smooth = _gaussian_filter_axes(arr.copy(), sigma, n_threads=n_threads)
+            assert(np.array_equal(smooth, _gaussian_filter_axes(arr.copy(), sigma)))
+            assert(np.allclose(smooth, expected))
+
+        assert(np.array_equal(_smooth_data_array(arr, np.diag([2, 3, 2, 1]), 5, n_threads=4),
+                              _smooth_data_array(arr, np.diag([2, 3, 2, 1]), 5)))
+
+
+def test_fft_smoothing_is_close_to_direct():
+    rng    = np.random.RandomState(0)
+    affine = np.diag([2, 3, 2, 1])
+    for arr, fwhm in [(rng.rand(12, 10, 8), 6),
+                      (rng.rand(9, 7, 5, 3).astype(np.float32), [4, 8, 6]),
+                      # kernels wider than the volume
+                      (rng.rand(4, 3, 2), 20)]:
+        direct = _smooth_data_array(arr, affine, fwhm)
+        fft    = _smooth_data_array(arr, affine, fwhm, method='fft')
+        assert(fft.dtype == direct.dtype)
+        assert(np.allclose(fft, direct, atol=1e-5 if arr.dtype == np.float32 else 1e-10))
+
+
+def test_fft_kernel_is_cached():
+    _get_fft_kernel.cache_clear()
+    arr = np.random.RandomState(0).rand(8, 8, 8)
+    for _ in range(3):
+        _smooth_data_array(arr, np.eye(4), 4, method='fft')
+    assert(_get_fft_kernel.cache_info().misses == 1)
+    assert(_get_fft_kernel.cache_info().hits == 2)
+
+    # the responses are cached in the type of the arrays
+    _smooth_data_array(arr.astype(np.float32), np.eye(4), 4, method='fft')
+    assert(_get_fft_kernel.cache_info().misses == 2)
+    for dtype in (np.float32, np.float64):
+        _, _, response = _get_fft_kernel((8, 8, 8), tuple(np.eye(3).ravel()), (4.0, 4.0, 4.0), dtype=dtype)
+        assert(response.dtype == dtype)
+        assert(not response.flags.writeable)
+
+
+def test_prepare_smoothing_array(monkeypatch):
+    # small blocks, so the arrays are prepared in several of them
+    monkeypatch.setattr(smooth, 'PREPARE_BLOCK_SIZE', 100)
+
+    arr = np.random.RandomState(0).rand(6, 5, 4)
+    arr[1, 2, 3] = np.nan
+    arr[4, 0, 0] = -np.inf
+    expected = np.nan_to_num(arr, nan=0, posinf=0, neginf=0)
+
+    prepared = _prepare_smoothing_array(arr)
+    assert(prepared is not arr)
+    assert(np.array_equal(prepared, expected))
+    assert(np.isnan(arr[1, 2, 3]))
+
+    int_arr = np.arange(120).reshape((6, 5, 4))
+    for dtype, out_dtype in [(np.int16, np.float32), (np.int64, np.float64)]:
+        prepared = _prepare_smoothing_array(int_arr.astype(dtype), copy=False)
+        assert(prepared.dtype == out_dtype)
+        assert(np.array_equal(prepared, int_arr))
+
+    float_arr = arr.astype(np.float32)
+    prepared  = _prepare_smoothing_array(float_arr, copy=False)
+    assert(prepared is float_arr)
+    assert(np.array_equal(prepared, expected.astype(np.float32)))
+
+
+def test_smoothing_buffer():
+    rng    = np.random.RandomState(0)
+    buffer = SmoothingBuffer()
+    arrs   = [rng.rand(6, 5, 4).astype(np.float32) for _ in range(2)]
+
+    for arr in arrs:
+        smoothed = _smooth_data_array(arr, np.eye(4), 4, buffer=buffer)
+        assert(smoothed is buffer.get((6, 5, 4), np.float32))
+        assert(np.array_equal(smoothed, _smooth_data_array(arr, np.eye(4), 4)))
+
+    assert(buffer.get((6, 5, 3), np.float32).shape == (6, 5, 3))
+    assert(buffer.get((6, 5, 3), np.float64).dtype == np.float64)
+    buffer.clear()
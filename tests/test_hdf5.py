@@ -0,0 +1,69 @@
+"""
+Test the hdf5 module
+"""
+import pytest
+import numpy as np
+
+h5py = pytest.importorskip('h5py')
+
+from boyle.hdf5 import save_rows_to_hdf5, update_rows_in_hdf5, save_variables_to_hdf5
+
+
+@pytest.mark.parametrize('n_rows', [0, 3, 5, 8])
+def test_save_rows_to_hdf5(tmpdir, n_rows):
+    """ Check that the dataset has as many rows as written, whatever the expected number of rows.
+    """
+    file_path = str(tmpdir.join('rows.h5'))
+    rows      = np.random.RandomState(0).rand(5, 4, 2).astype(np.float32)
+
+    assert save_rows_to_hdf5(file_path, iter(rows), (4, 2), np.float32, n_rows=n_rows) == len(rows)
+    with h5py.File(file_path, 'r') as h5file:
+        np.testing.assert_equal(h5file['data'][()], rows)
+
+
+def _save_keyed_rows(file_path, rows, keys):
+    save_rows_to_hdf5(file_path, iter(rows), rows.shape[1:], rows.dtype, n_rows=len(rows))
+    save_variables_to_hdf5(file_path, {'row_keys': np.array(keys, dtype=h5py.special_dtype(vlen=str)),
+                                       'smooth_fwhm': 4}, mode='a')
+
+
+@pytest.mark.parametrize('new_keys', [['a', 'b', 'c', 'd', 'e'],
+                                      ['c', 'a', 'e', 'b'],
+                                      ['d', 'c'],
+                                      []])
+def test_update_rows_in_hdf5(tmpdir, new_keys):
+    """ Check that the updated dataset has the rows of `new_keys` in order, appended, reordered or
+    removed, and that only the rows of the new keys are requested.
+    """
+    file_path = str(tmpdir.join('rows.h5'))
+    rng       = np.random.RandomState(0)
+    all_rows  = dict(zip('abcde', rng.rand(5, 3).astype(np.float32)))
+    _save_keyed_rows(file_path, np.array([all_rows[key] for key in 'abc']), list('abc'))
+
+    requested = []
+
+    def get_rows(row_idx):
+        requested.extend(new_keys[idx] for idx in row_idx)
+        return [all_rows[new_keys[idx]] for idx in row_idx]
+
+    n_new = update_rows_in_hdf5(file_path, new_keys, get_rows, (3, ), np.float32, checks={'smooth_fwhm': 4})
+    assert n_new == len(requested)
+    assert sorted(requested) == sorted(set(new_keys) - set('abc'))
+
+    with h5py.File(file_path, 'r') as h5file:
+        assert [key.decode() if isinstance(key, bytes) else key for key in h5file['row_keys'][()]] == new_keys
+        np.testing.assert_equal(h5file['data'][()], np.array([all_rows[key] for key in new_keys]).reshape((-1, 3)))
+
+
+def test_update_rows_in_hdf5_checks(tmpdir):
+    """ Check that the file is not updated if its content or row shape do not match.
+    """
+    file_path = str(tmpdir.join('rows.h5'))
+    _save_keyed_rows(file_path, np.zeros((2, 3), dtype=np.float32), ['a', 'b'])
+
+    def get_rows(row_idx):
+        raise AssertionError('No rows should be requested.')
+
+    assert update_rows_in_hdf5(file_path, ['a', 'c'], get_rows, (3, ), np.float32, checks={'smooth_fwhm': 8}) is None
+    assert update_rows_in_hdf5(file_path, ['a', 'c'], get_rows, (4, ), np.float32) is None
+    assert update_rows_in_hdf5(file_path, ['a', 'c'], get_rows, (3, ), np.float64) is None
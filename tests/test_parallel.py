@@ -0,0 +1,25 @@
+"""
+Test the parallel module
+"""
+import numpy as np
+
+from boyle.parallel import create_shared_memmap, open_shared_memmap, remove_shared_memmap
+
+
+def test_shared_memmap():
+    outmat, file_path = create_shared_memmap((3, 4), np.float32)
+    try:
+        open_shared_memmap(file_path, (3, 4), np.float32)[1] = 2
+        np.testing.assert_equal(outmat[1], 2)
+        np.testing.assert_equal(outmat[0], 0)
+    finally:
+        remove_shared_memmap(file_path)
+
+
+def test_empty_shared_memmap():
+    outmat, file_path = create_shared_memmap((3, 0), np.float32)
+    try:
+        assert outmat.shape == (3, 0)
+        assert open_shared_memmap(file_path, (3, 0), np.float32).shape == (3, 0)
+    finally:
+        remove_shared_memmap(file_path)
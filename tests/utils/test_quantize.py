@@ -0,0 +1,69 @@
+"""
+Test the quantize module
+"""
+import pytest
+
+import numpy as np
+
+from boyle.utils.quantize import quantize_array, QuantizedArray
+
+
+def test_quantize_array():
+    arr = np.random.RandomState(0).rand(10, 20) * 100
+
+    qarr, slope, inter = quantize_array(arr, 'int16', axis=0)
+    assert qarr.dtype == np.int16
+    assert slope.shape == (10, 1)
+    assert np.abs(qarr * slope + inter - arr).max() <= slope.max()
+
+    with pytest.raises(ValueError):
+        quantize_array(arr, 'float32')
+
+
+def test_quantize_constant_array():
+    arr = np.ones((4, 5)) * 3
+
+    qarr, slope, inter = quantize_array(arr, 'uint8')
+    assert np.allclose(qarr * slope + inter, arr)
+
+
+def test_quantized_array():
+    arr  = np.random.RandomState(0).rand(10, 20).astype(np.float32)
+    qarr = QuantizedArray.from_array(arr, 'uint8', axis=1)
+
+    assert qarr.shape == arr.shape
+    assert qarr[3].dtype == np.float32
+    assert np.allclose(qarr[3], np.asarray(qarr)[3])
+    assert np.abs(np.asarray(qarr) - arr).max() <= qarr.slope.max()
+    assert qarr.nbytes < arr.nbytes
+
+
+def test_quantize_round_trip():
+    """ Check that the quantization error is at most half of a quantization step, also for float32 data
+    far from zero, which is quantized in float32.
+    """
+    rng = np.random.RandomState(0)
+    for arr in (rng.rand(50, 30) * 100, (rng.rand(50, 30) * 10 + 1000).astype(np.float32)):
+        # the rounding of the scaled values, up to 2**16, in the precision of arr
+        rounding = np.spacing(np.array(2 ** 16, dtype=arr.dtype))
+        for axis in (None, 0, 1):
+            qarr  = QuantizedArray.from_array(arr, 'int16', axis=axis)
+            error = np.abs(qarr.data * qarr.slope + qarr.inter - arr)
+            assert np.all(error <= qarr.slope * (0.5 + rounding))
+
+
+def test_quantize_array_chunks(monkeypatch):
+    """ Check that quantizing by chunks of rows gives the same result as at once.
+    """
+    from boyle.utils import quantize
+
+    arr = np.random.RandomState(0).rand(10, 20)
+    arr[3, 4] = np.nan
+    expected = quantize_array(arr, 'uint8', axis=0)
+
+    monkeypatch.setattr(quantize, '_CHUNK_SIZE', 30)
+    out = np.zeros(arr.shape, dtype=np.uint8)
+    qarr, slope, inter = quantize_array(arr, 'uint8', axis=0, out=out)
+    assert qarr is out
+    for one, other in zip((qarr, slope, inter), expected):
+        np.testing.assert_equal(one, other)